@@ -19,21 +19,113 @@ Next, you should check out the following files:
 
 from os import getcwd, getenv
 from os.path import abspath
+from threading import Lock
 from eve import Eve
 from flask import Config
-
-from backend.security import APIAuth, only_own_nethz
-from backend.validation import APIValidator
+from pymongo.errors import OperationFailure
+
+from backend.cache import TTLCache, SingleFlight
+from backend.security import (
+    APIAuth,
+    only_own_nethz,
+    logout,
+    init_admin_group,
+    create_session,
+    CircuitBreaker,
+)
+from backend.catalog import init_catalog
+from backend.schedules import init_schedules
+from backend.planning import init_planning, conflicts
+from backend.metrics import register_query_counter, instrumented, init_metrics
+from backend.commands import register_commands
+from backend.stats import stats
+from backend.data import APIMongo, DUPLICATE_KEY, without_unique_indexes
+from backend.validation import APIValidator, clear_documents
 from backend.signups import (
     new_signups,
     deleted_signup,
     patched_signup,
     patched_course,
     block_course_deletion,
-    mark_as_paid,
-    mark_as_unpaid,
+    init_spot_counters,
+)
+from backend.payments import (
+    create_payment,
+    process_payments,
+    block_payment_deletion,
+    deleted_payment,
+    init_payments,
 )
-from backend.payments import create_payment
+from backend.settlements import settlements_endpoint
+from backend.pricing import init_pricing
+from backend.intervals import normalize_courses, normalize_course
+from backend.occupancy import (
+    inserted_courses,
+    updated_course,
+    replaced_course,
+    deleted_course,
+    deleted_courses,
+    init_occupancy,
+)
+
+
+def create_eve(config, validator):
+    """Create the Eve app, which creates all indexes.
+
+    If a unique index cannot be created because the database contains
+    duplicates, the app is created without unique indexes, so that the
+    duplicates can be removed (see `data.py`).
+    """
+    try:
+        return Eve(auth=APIAuth, validator=validator, data=APIMongo,
+                   settings=config)
+    except OperationFailure as error:
+        if error.code != DUPLICATE_KEY:
+            raise
+        config['DOMAIN'] = without_unique_indexes(config['DOMAIN'])
+        application = Eve(auth=APIAuth, validator=validator, data=APIMongo,
+                          settings=config)
+        application.logger.error(
+            "Unique indexes not created, the database contains duplicates "
+            "(%s). Until they are removed with `flask duplicates --delete`, "
+            "they are only prevented by validation.", error)
+        return application
+
+
+def register_hooks(application):
+    """Add filtering, pre- and postprocessing to the resources."""
+    # Eve provides hooks at several points of the request,
+    # we use this do add dynamic filtering
+    for resource in ['signups', 'selections']:
+        for method in ['GET', 'PATCH', 'DELETE']:
+            event = getattr(application,
+                            'on_pre_%s_%s' % (method, resource))
+            event += only_own_nethz
+
+    # Also use hooks to add pre- and postprocessing to resources
+    application.on_inserted_signups += new_signups
+    application.on_deleted_item_signups += deleted_signup
+    application.on_updated_signups += patched_signup
+
+    application.on_updated_courses += patched_course
+    application.on_delete_item_courses += block_course_deletion
+
+    # All time slots are stored in UTC
+    application.on_insert_courses += normalize_courses
+    application.on_update_courses += normalize_course
+    application.on_replace_courses += normalize_course
+
+    # Room and assistant occupancy for booking validation
+    application.on_inserted_courses += inserted_courses
+    application.on_updated_courses += updated_course
+    application.on_replaced_courses += replaced_course
+    application.on_deleted_item_courses += deleted_course
+    application.on_deleted_resource_courses += deleted_courses
+
+    application.on_insert_payments += create_payment
+    application.on_inserted_payments += process_payments
+    application.on_delete_item_payments += block_payment_deletion
+    application.on_deleted_item_payments += deleted_payment
 
 
 def create_app(config_file=None, **kwargs):
@@ -67,29 +159,78 @@ def create_app(config_file=None, **kwargs):
 
     config.update(kwargs)
 
+    # Optionally, measure the time and queries of every validation rule
+    validator = APIValidator
+    if config['VALIDATION_METRICS']:
+        register_query_counter()  # Before the database client is created
+        validator = instrumented(APIValidator)
+
     # Create the app object
-    application = Eve(auth=APIAuth, validator=APIValidator, settings=config)
+    application = create_eve(config, validator)
     application.logger.info(config_status)
 
-    # Eve provides hooks at several points of the request,
-    # we use this do add dynamic filtering
-    for resource in ['signups', 'selections']:
-        for method in ['GET', 'PATCH', 'DELETE']:
-            event = getattr(application,
-                            'on_pre_%s_%s' % (method, resource))
-            event += only_own_nethz
-
-    # Also use hooks to add pre- and postprocessing to resources
-    application.on_post_POST_signups += new_signups
-    application.on_deleted_item_signups += deleted_signup
-    application.on_updated_signups += patched_signup
-
-    application.on_updated_courses += patched_course
-    application.on_delete_item_courses += block_course_deletion
-
-    application.on_insert_payments += create_payment
-    application.on_inserted_payments += mark_as_paid
-    application.on_deleted_item_payments += mark_as_unpaid
+    # Connection pool and process-wide cache for AMIVAPI requests,
+    # shared by all requests
+    application.amivapi = create_session(application.config)
+    application.amivapi_breaker = CircuitBreaker(
+        application.config['AMIVAPI_BREAKER_THRESHOLD'],
+        application.config['AMIVAPI_BREAKER_TIMEOUT'])
+    application.user_cache = TTLCache(
+        application.config['AMIVAPI_CACHE_TTL'],
+        application.config['AMIVAPI_CACHE_SIZE'],
+        stale=application.config['AMIVAPI_CACHE_STALE'])
+    application.rejected_tokens = TTLCache(
+        application.config['AMIVAPI_REJECTED_TTL'],
+        application.config['AMIVAPI_REJECTED_SIZE'])
+    application.amivapi_lookups = SingleFlight()
+    application.revalidating = set()
+    application.revalidation_lock = Lock()
+    application.add_url_rule('%s/logout' % application.api_prefix, 'logout',
+                             view_func=logout, methods=['POST'])
+    init_admin_group(application)
+
+    # Public reads of lectures, courses and assistants are cached
+    init_catalog(application)
+
+    # Chosen courses of every user, to check for timing conflicts
+    init_schedules(application)
+
+    # Maintenance commands (Indexes are created by Eve, see settings)
+    register_commands(application)
+
+    # Admin-only statistics
+    application.add_url_rule('%s/stats' % application.api_prefix, 'stats',
+                             view_func=stats, methods=['GET'])
+
+    # Course prices, cached until courses or lectures change
+    init_pricing(application)
+
+    # Stripe charges in the background
+    init_payments(application)
+
+    # Admin-only bulk payments without Stripe
+    application.add_url_rule('%s/settlements' % application.api_prefix,
+                             'settlements', view_func=settlements_endpoint,
+                             methods=['POST'])
+
+    # Admin-only validation metrics, if enabled
+    if application.config['VALIDATION_METRICS']:
+        init_metrics(application)
+
+    # Admin-only conflict report for semester planning
+    init_planning(application)
+    application.add_url_rule('%s/planning/conflicts' % application.api_prefix,
+                             'conflicts', view_func=conflicts, methods=['GET'])
+
+    # Documents prefetched for validation only live as long as the request
+    application.teardown_request(clear_documents)
+
+    register_hooks(application)
+
+    # Count the spots of courses created before the counters existed
+    init_spot_counters(application)
+    # Book the rooms and assistants of existing courses
+    init_occupancy(application)
 
     return application
 
@@ -0,0 +1,231 @@
+"""In-process caches.
+
+The backend runs as a single long-lived process (bjoern), so simple
+in-memory caches shared by all requests go a long way to avoid repeating the
+same requests to AMIVAPI or the database over and over again.
+
+All caches in here are thread-safe and count their hits and misses, such
+that their effectiveness can be monitored.
+
+Values loaded from the database are kept in a `LoaderCache`, which is
+cleared whenever documents of the resources they depend on change.
+
+Caches don't help if the same value is requested several times in parallel
+before the first result has arrived, e.g. if the browser of a user sends
+several requests at once on page load. For this, `SingleFlight` lets
+concurrent callers share a single call.
+"""
+
+from collections import OrderedDict
+from threading import Event, Lock
+from time import monotonic
+
+
+class TTLCache:  # pylint: disable=too-many-instance-attributes
+    """Size-bounded LRU cache whose entries expire after `ttl` seconds.
+
+    If the cache is full, the least recently used entry is removed.
+    A `maxsize` of 0 disables the cache.
+
+    Expired entries are kept for another `stale` seconds. They are not
+    returned by `get`, but can be retrieved with `get_stale` if nothing
+    better is available.
+    """
+
+    def __init__(self, ttl, maxsize, stale=0):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stale = stale
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the cached value, or `default` if missing or expired."""
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            now = monotonic()
+            if expires <= now:
+                if expires + self.stale <= now:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_stale(self, key, default=None):
+        """Return the cached value even if expired, unless it's too old."""
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expires + self.stale <= monotonic():
+                del self._data[key]
+                return default
+
+            self.stale_hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store value, removing the least recently used items if full."""
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key, value):
+        """Store value, the lock must be held."""
+        self._data[key] = (monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        """Remove key from the cache (if it exists)."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove everything."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Return size and hit/miss counters."""
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'stale': self.stale,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+        }
+
+
+# Eve events after which documents of a resource have changed
+CHANGE_EVENTS = ('on_inserted', 'on_updated', 'on_replaced',
+                 'on_deleted_item', 'on_deleted_resource')
+
+
+class LoaderCache(TTLCache):
+    """`TTLCache` for values loaded from the database.
+
+    Every `clear` and `pop` increments a generation counter. A value is only
+    stored if the cache has not changed since loading started, so values
+    loaded before a change are not stored afterwards.
+    """
+
+    def __init__(self, ttl, maxsize):
+        super(LoaderCache, self).__init__(ttl, maxsize)
+        self.generation = 0
+
+    def set_if_unchanged(self, key, value, generation):
+        """Store value, unless the cache has changed since `generation`."""
+        with self._lock:
+            if generation == self.generation:
+                self._set(key, value)
+
+    def pop(self, key):
+        """Remove key from the cache (if it exists)."""
+        with self._lock:
+            self.generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove everything."""
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def get_or_load(self, key, load):
+        """Return the cached value, or call `load` and store the result."""
+        value = self.get(key)
+        if value is None:
+            generation = self.generation
+            value = load()
+            self.set_if_unchanged(key, value, generation)
+        return value
+
+    def invalidate_on(self, app, resources):
+        """Clear the cache whenever documents of the resources change."""
+        def _invalidate(resource, *_):
+            if resource in resources:
+                self.clear()
+
+        for name in CHANGE_EVENTS:
+            event = getattr(app, name)
+            event += _invalidate
+
+
+class _Call:
+    """A running call of a `SingleFlight` and its outcome."""
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one call.
+
+    The first caller for a key executes the function. Everyone calling with
+    the same key while it is running waits and gets the same result, or the
+    same exception is raised.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._running = {}
+        self._lock = Lock()
+
+    def call(self, key, function, *args, **kwargs):
+        """Call function, unless a call with the same key is running."""
+        with self._lock:
+            call = self._running.get(key)
+            if call is None:
+                call = self._running[key] = _Call()
+                leader = True
+                self.calls += 1
+            else:
+                leader = False
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except Exception as error:  # pylint: disable=broad-except
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._running[key]
+            call.done.set()
+
+    def stats(self):
+        """Return number of executed and shared calls."""
+        return {
+            'running': len(self._running),
+            'calls': self.calls,
+            'shared': self.shared,
+        }
@@ -0,0 +1,88 @@
+"""Public Catalog.
+
+Lectures, courses and assistants are the same for everyone and make up most
+of the traffic, as every student browses them. These resources allow
+anonymous reads (configured with `public_methods` in `settings.py`), so no
+request to AMIVAPI is needed.
+
+On top of that, the rendered responses are kept in memory. Any change to one
+of the public resources clears the cache, since courses may embed lectures
+and assistants. A generation counter ensures that responses computed before
+a change are not stored afterwards.
+"""
+
+from flask import current_app, g, request
+
+from backend.cache import LoaderCache
+
+
+def _public_resource():
+    """Return the resource if the request is a public read, None otherwise."""
+    if request.method != 'GET' or not request.endpoint:
+        return None
+
+    resource, _, kind = request.endpoint.partition('|')
+    settings = current_app.config['DOMAIN'].get(resource)
+    if settings is None:
+        return None
+
+    public = {
+        'resource': settings.get('public_methods', []),
+        'item_lookup': settings.get('public_item_methods', []),
+    }.get(kind, [])
+    return resource if 'GET' in public else None
+
+
+def _cacheable():
+    """Only cache public reads without conditional headers."""
+    return (_public_resource() is not None and
+            'If-None-Match' not in request.headers and
+            'If-Modified-Since' not in request.headers)
+
+
+def _cache_key():
+    """Responses depend on the query and on the origin (CORS headers)."""
+    return (request.full_path, request.headers.get('Origin'))
+
+
+def serve_from_cache():
+    """Before request: Return the cached response if possible."""
+    if not _cacheable():
+        return None
+
+    # Remember generation to detect changes while the request is processed
+    g.catalog_generation = current_app.catalog_cache.generation
+
+    cached = current_app.catalog_cache.get(_cache_key())
+    if cached is None:
+        return None
+
+    g.catalog_cached = True
+    data, status, headers = cached
+    return current_app.response_class(data, status=status, headers=headers)
+
+
+def store_in_cache(response):
+    """After request: Store successful public responses."""
+    if (response.status_code == 200 and
+            not g.get('catalog_cached') and
+            g.get('catalog_generation') is not None and
+            _cacheable()):
+        current_app.catalog_cache.set_if_unchanged(_cache_key(), (
+            response.get_data(),
+            response.status_code,
+            list(response.headers),
+        ), g.catalog_generation)
+    return response
+
+
+def init_catalog(app):
+    """Create the cache, cleared if any public resource changes."""
+    app.catalog_cache = LoaderCache(app.config['CATALOG_CACHE_TTL'],
+                                    app.config['CATALOG_CACHE_SIZE'])
+    app.catalog_cache.invalidate_on(app, [
+        resource for (resource, settings) in app.config['DOMAIN'].items()
+        if 'GET' in settings.get('public_methods', [])])
+
+    app.before_request(serve_from_cache)
+    app.after_request(store_in_cache)
@@ -0,0 +1,248 @@
+"""Command Line Interface.
+
+Maintenance tasks are available as Flask commands. Point Flask to the app
+and run them from the Backend directory, e.g.:
+
+> FLASK_APP=backend/app.py flask indexes
+
+Run `flask --help` to see all commands.
+"""
+
+from copy import deepcopy
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import UpdateOne
+
+from backend.data import find_duplicates
+from backend.intervals import normalize
+from backend.occupancy import rebuild_occupancy
+from backend.planning import conflict_report
+from backend.reconciliation import reconcile
+from backend.signups import recount_spots, update_waiting_lists
+
+
+# Of several signups of a user for the same course, the first one is kept
+STATUS_ORDER = ['accepted', 'reserved', 'waiting']
+
+
+def _collection(resource):
+    """Return the database collection of a resource."""
+    source = current_app.config['SOURCES'][resource]['source']
+    return current_app.data.driver.db[source]
+
+
+def _used_indexes(plan):
+    """Find the names of all indexes used in a query plan."""
+    names = set()
+    if isinstance(plan, dict):
+        if 'indexName' in plan:
+            names.add(plan['indexName'])
+        for value in plan.values():
+            names |= _used_indexes(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            names |= _used_indexes(value)
+    return names
+
+
+def _stages(plan):
+    """Describe the stages of a query plan, e.g. 'FETCH > IXSCAN'."""
+    stage = plan.get('stage', '?')
+    if 'inputStage' in plan:
+        return '%s > %s' % (stage, _stages(plan['inputStage']))
+    if plan.get('inputStages'):
+        inputs = [_stages(input_stage) for input_stage in plan['inputStages']]
+        return '%s(%s)' % (stage, ', '.join(inputs))
+    return stage
+
+
+@click.command('indexes')
+@with_appcontext
+def indexes():
+    """Show the configured indexes and check that queries can use them.
+
+    For every index, a query sorted by the index keys is explained. If the
+    index exists and works, the query planner chooses it.
+    """
+    valid = True
+    for resource, settings in sorted(current_app.config['DOMAIN'].items()):
+        for name, definition in sorted(settings['mongo_indexes'].items()):
+            (keys, options) = definition if isinstance(definition, tuple) \
+                else (definition, {})
+            collection = _collection(resource)
+
+            # Partial indexes can only be used for queries matching the filter
+            lookup = options.get('partialFilterExpression', {})
+            exists = name in collection.index_information()
+            plan = collection.find(lookup).sort(keys).explain()
+            winning = plan['queryPlanner']['winningPlan']
+            used = _used_indexes(winning)
+
+            valid = valid and exists and name in used
+            click.echo('%s.%s %s' % (resource, name, keys))
+            click.echo('    exists: %s, used by query plan: %s' %
+                       (exists, ', '.join(sorted(used)) or 'none'))
+            click.echo('    winning plan: %s' % _stages(winning))
+
+    if not valid:
+        raise click.ClickException('Some indexes are missing or unused.')
+
+
+@click.command('recount-spots')
+@with_appcontext
+def recount_spots_command():
+    """Recompute the spot counters of all courses from the signups.
+
+    Normally, the counters are always kept up to date, and courses without
+    counter are counted when the app starts. Use this after modifying
+    signups in the database directly.
+    """
+    modified = recount_spots()
+    for course_id, count in modified.items():
+        click.echo('Course %s: %s spots taken.' % (course_id, count))
+    click.echo('%d counter(s) corrected.' % len(modified))
+
+
+@click.command('update-waiting-lists')
+@click.argument('course_ids', nargs=-1)
+@with_appcontext
+def update_waiting_lists_command(course_ids):
+    """Give free spots to the waiting lists of courses.
+
+    If no course ids are given, all courses are updated in one batch.
+    """
+    if not course_ids:
+        course_ids = current_app.data.driver.db['courses'].distinct('_id')
+    reserved = update_waiting_lists(course_ids)
+    click.echo('%d signup(s) reserved.' % len(reserved))
+
+
+@click.command('rebuild-occupancy')
+@with_appcontext
+def rebuild_occupancy_command():
+    """Rebuild the room and assistant occupancy from all courses.
+
+    The occupancy is kept in sync by the course hooks. Use this after
+    modifying courses in the database directly, or to initialize it for
+    existing courses.
+    """
+    click.echo('%d time slot(s) booked.' % rebuild_occupancy())
+
+
+@click.command('normalize-timespans')
+@with_appcontext
+def normalize_timespans_command():
+    """Store the time slots of all courses in UTC and whole seconds.
+
+    New and modified courses are normalized by hooks. Use this once for
+    existing courses. Afterwards, the occupancy is rebuilt. Restart the
+    server, its caches still contain the old time slots.
+    """
+    courses = current_app.data.driver.db['courses']
+    updates = []
+    for course in courses.find({}, {'signup': 1, 'datetimes': 1}):
+        normalized = normalize(deepcopy(course))
+        if normalized != course:
+            updates.append(UpdateOne({'_id': course['_id']}, {'$set': {
+                key: normalized[key] for key in ('signup', 'datetimes')
+                if key in normalized
+            }}))
+
+    if updates:
+        courses.bulk_write(updates, ordered=False)
+    click.echo('%d course(s) normalized.' % len(updates))
+    click.echo('%d time slot(s) booked.' % rebuild_occupancy())
+
+
+@click.command('conflicts')
+@with_appcontext
+def conflicts_command():
+    """Show courses of the same department and year at the same time."""
+    for group in conflict_report()['groups']:
+        click.echo('%s, year %s: %d course(s), %d conflict(s)' % (
+            group['department'] or 'no lecture', group['year'] or '-',
+            len(group['courses']), len(group['conflicts'])))
+        for (first, second) in group['conflicts']:
+            click.echo('    %s and %s' % (group['courses'][first],
+                                          group['courses'][second]))
+
+
+@click.command('reconcile')
+@click.option('--repair', is_flag=True,
+              help='Repair the problems found, where possible.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Number of charges and payments checked at once.')
+@with_appcontext
+def reconcile_command(repair, batch_size):
+    """Compare all Stripe charges with the payments.
+
+    Reports charges without payment, payments without (successful) charge
+    and payments with signups that are not accepted.
+    """
+    problems = 0
+    for problem in reconcile(batch_size, repair):
+        problems += 1
+        click.echo('%s: payment %s, charge %s%s' % (
+            problem['problem'], problem['payment'] or '-',
+            problem['charge'] or '-',
+            ' (repaired)' if problem['repaired'] else ''))
+    click.echo('%d problem(s) found.' % problems)
+
+
+def _duplicate_order(document):
+    """Sort by status, then by age (ObjectIds start with a timestamp)."""
+    status = document.get('status')
+    rank = STATUS_ORDER.index(status) if status in STATUS_ORDER \
+        else len(STATUS_ORDER)
+    return (rank, document['_id'])
+
+
+@click.command('duplicates')
+@click.option('--delete', is_flag=True,
+              help='Delete all duplicates without payment.')
+@with_appcontext
+def duplicates_command(delete):
+    """Find documents of the same user for the same course.
+
+    Duplicates prevent the unique indexes from being created (see
+    `data.py`). Of every group, the signup with the best status (or else the
+    oldest document) is kept. Signups with a payment are never deleted.
+    Restart the server afterwards to create the indexes and to clear its
+    caches.
+    """
+    paid = set(current_app.data.driver.db['payments'].distinct('signups'))
+    deleted = 0
+    courses = set()
+    for (resource, values, documents) in find_duplicates():
+        documents.sort(key=_duplicate_order)
+        removable = [document['_id'] for document in documents[1:]
+                     if document['_id'] not in paid]
+        click.echo('%s %s: %d document(s), keeping %s' % (
+            resource, ', '.join('%s=%s' % item for item in
+                                sorted(values.items())),
+            len(documents), documents[0]['_id']))
+
+        if delete and removable:
+            _collection(resource).delete_many({'_id': {'$in': removable}})
+            deleted += len(removable)
+            if resource == 'signups':
+                courses.add(values['course'])
+
+    if courses:
+        recount_spots(courses)
+        update_waiting_lists(courses)
+    click.echo('%d document(s) deleted.' % deleted)
+
+
+def register_commands(app):
+    """Add all commands to the app."""
+    app.cli.add_command(indexes)
+    app.cli.add_command(recount_spots_command)
+    app.cli.add_command(update_waiting_lists_command)
+    app.cli.add_command(rebuild_occupancy_command)
+    app.cli.add_command(normalize_timespans_command)
+    app.cli.add_command(conflicts_command)
+    app.cli.add_command(reconcile_command)
+    app.cli.add_command(duplicates_command)
@@ -0,0 +1,125 @@
+"""Data Layer.
+
+We use the MongoDB data layer of Eve, with one change: Unique combinations
+of fields (the `unique_combination` rule, e.g. only one signup per user and
+course) are enforced by unique indexes instead of checking the database
+before every insert (see `settings.py` and `validation.py`).
+
+If the database rejects a new document because of such an index, Eve would
+respond with `409 Conflict`. Instead, we respond exactly as if validation
+had failed, so clients see the same `422` error as before, but no request
+can slip through in between, e.g. if a user double-clicks.
+
+A unique index can only be created if the database contains no duplicates,
+e.g. signups stored before the index existed. In this case, the app starts
+without unique indexes (and validation checks the database again), until
+the duplicates are removed with `flask duplicates --delete`.
+"""
+
+import re
+
+from flask import abort, current_app
+from pymongo.errors import BulkWriteError
+from eve.io.mongo import Mongo
+from eve.render import send_response
+from eve.utils import config
+
+from backend.validation import unique_index, combination_error
+
+
+DUPLICATE_KEY = 11000
+INDEX_NAME = re.compile(r'index: (\S+)')
+
+
+def combination_issues(resource, message):
+    """Find the unique combination violated according to the error message.
+
+    Returns:
+        dict: The validation issues, or None if no combination matches.
+    """
+    match = INDEX_NAME.search(message or '')
+    if match is None:
+        return None
+
+    schema = current_app.config['DOMAIN'][resource]['schema']
+    for (field, rules) in schema.items():
+        combination = rules.get('unique_combination')
+        if (combination and unique_index(resource, [field] + combination) ==
+                match.group(1)):
+            return {field: combination_error(combination)}
+    return None
+
+
+class APIMongo(Mongo):
+    """Eve's MongoDB data layer, reporting duplicate combinations as 422."""
+
+    def insert(self, resource, doc_or_docs):
+        """Insert documents, same as Eve except for duplicate combinations."""
+        datasource, _, _, _ = self._datasource_ex(resource)
+        coll = self.get_collection_with_write_concern(datasource, resource)
+
+        if isinstance(doc_or_docs, dict):
+            doc_or_docs = [doc_or_docs]
+
+        try:
+            result = coll.insert_many(doc_or_docs, ordered=True)
+        except BulkWriteError as error:
+            duplicates = [write_error for write_error
+                          in error.details['writeErrors']
+                          if write_error['code'] == DUPLICATE_KEY]
+
+            for duplicate in duplicates:
+                issues = combination_issues(resource, duplicate['errmsg'])
+                if issues:
+                    abort(send_response(resource, ({
+                        config.STATUS: config.STATUS_ERR,
+                        config.ISSUES: issues,
+                        config.ERROR: {
+                            'code': config.VALIDATION_ERROR_STATUS,
+                            'message': "Insertion failure: 1 document(s) "
+                                       "contain(s) error(s)",
+                        },
+                    }, None, None, config.VALIDATION_ERROR_STATUS)))
+
+            # Everything else is handled like Eve does
+            self.app.logger.exception(error)
+            abort(409 if duplicates else 500)
+        return result.inserted_ids
+
+
+def without_unique_indexes(domain):
+    """Copy the domain settings without any unique indexes."""
+    def _unique(index):
+        return isinstance(index, tuple) and index[1].get('unique')
+
+    return {resource: dict(settings, mongo_indexes={
+        name: index for (name, index)
+        in settings.get('mongo_indexes', {}).items() if not _unique(index)
+    }) for (resource, settings) in domain.items()}
+
+
+def find_duplicates():
+    """Find documents violating a unique combination.
+
+    E.g. several signups of the same user for the same course.
+
+    Yields:
+        tuple: The resource, the duplicated values and all their documents.
+    """
+    for (resource, settings) in sorted(current_app.config['DOMAIN'].items()):
+        for (field, rules) in settings['schema'].items():
+            if not rules.get('unique_combination'):
+                continue
+            fields = [field] + rules['unique_combination']
+            source = current_app.config['SOURCES'][resource]['source']
+            groups = current_app.data.driver.db[source].aggregate([
+                {'$match': {key: {'$exists': True} for key in fields}},
+                {'$group': {
+                    '_id': {key: '$' + key for key in fields},
+                    'documents': {'$push': '$$ROOT'},
+                    'count': {'$sum': 1},
+                }},
+                {'$match': {'count': {'$gt': 1}}},
+            ], allowDiskUse=True)
+            for group in groups:
+                yield (resource, group['_id'], group['documents'])
@@ -0,0 +1,102 @@
+"""Time slots and overlap detection.
+
+Time slots are dicts with a `start` and an `end` datetime, as used for the
+`datetimes` and `signup` fields of courses. They are stored in UTC without
+timezone (see the hooks at the end), and for comparisons they are converted
+once to intervals: tuples of start and end as integer seconds since the
+epoch. The occupancy and the cached schedules store intervals directly.
+
+Two intervals overlap if one starts before the other has ended, touching
+intervals (one ends when the next starts) are fine.
+
+Instead of comparing every pair of intervals, they are sorted by start once
+and then swept from left to right, remembering only the interval which ends
+last so far. This needs O(n log n) instead of O(n²) comparisons, which makes
+a difference for rooms with dozens of courses with several slots each.
+"""
+
+from calendar import timegm
+from datetime import datetime, timezone
+from itertools import chain
+
+
+def utc(value):
+    """Return the datetime in UTC without timezone, in whole seconds."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.replace(microsecond=0)
+
+
+def to_interval(timeslot):
+    """Convert a time slot to a tuple of start and end in epoch seconds.
+
+    Datetimes without timezone are UTC.
+    """
+    return (timegm(utc(timeslot['start']).utctimetuple()),
+            timegm(utc(timeslot['end']).utctimetuple()))
+
+
+def find_overlap(intervals, others=()):
+    """Find overlapping intervals.
+
+    Every interval in `intervals` is compared with all other intervals.
+    The intervals in `others` are only compared with `intervals`, but not
+    among each other (e.g. slots of other courses in the same room).
+
+    Args:
+        intervals (iterable): Intervals that must not overlap with anything.
+        others (iterable): Further intervals to compare against.
+
+    Returns:
+        tuple: The first pair of overlapping intervals found, the one
+            starting earlier first, or None if there is no overlap.
+    """
+    items = sorted(chain(((interval, True) for interval in intervals),
+                         ((interval, False) for interval in others)),
+                   key=lambda item: item[0])
+
+    # Interval ending last so far, separately for both groups (initially an
+    # empty interval which overlaps with nothing)
+    nothing = (float('-inf'), float('-inf'))
+    last = {True: nothing, False: nothing}
+
+    for (interval, own) in items:
+        # Own intervals are compared with everything, others only with own
+        for previous in (last[True], last[False]) if own else (last[True],):
+            if interval[0] < previous[1]:
+                return (previous, interval)
+
+        if interval[1] > last[own][1]:
+            last[own] = interval
+
+    return None
+
+
+def describe(interval):
+    """Format an interval for error messages."""
+    return '%s to %s' % tuple(datetime.utcfromtimestamp(value).isoformat(' ')
+                              for value in interval)
+
+
+# Hooks to store all time slots of courses in UTC
+
+def normalize(course):
+    """Convert all time slots of the course (or update) to UTC in place."""
+    timeslots = [course['signup']] if course.get('signup') else []
+    timeslots += course.get('datetimes') or []
+    for timeslot in timeslots:
+        for key in ('start', 'end'):
+            if isinstance(timeslot.get(key), datetime):
+                timeslot[key] = utc(timeslot[key])
+    return course
+
+
+def normalize_courses(courses):
+    """Before inserting courses, convert time slots to UTC."""
+    for course in courses:
+        normalize(course)
+
+
+def normalize_course(updates, _):
+    """Before updating or replacing a course, convert time slots to UTC."""
+    normalize(updates)
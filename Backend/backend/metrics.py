@@ -0,0 +1,178 @@
+"""Validation Metrics.
+
+Validation rules can be expensive, many of them query the database. To find
+out which rules dominate the latency of requests, every `_validate_*` rule of
+the validator can be instrumented: its duration and the number of MongoDB
+commands it sends are recorded in histograms per resource and rule.
+
+This is optional and disabled by default, enable it with the setting
+`VALIDATION_METRICS`. Admins can then get the histograms at `/metrics`, and
+every response to an admin request contains a header with the timing of
+the rules of this request:
+
+    X-Validation-Timing: signups.no_course_overlap=1.52ms/2q, ...
+
+Rules containing other rules (e.g. `schema` for lists and dicts) include
+the time of the rules inside.
+
+MongoDB commands are counted with a command listener of pymongo, which only
+counts commands sent by the thread while it runs a rule.
+"""
+
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock, local
+from time import perf_counter
+
+from flask import current_app, g, request
+from pymongo import monitoring
+from eve.render import send_response
+
+from backend.security import admin_only
+
+
+# Upper bounds of the histogram buckets in milliseconds
+BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    """Distribution of durations, and the total number of queries."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.queries = 0
+        self._lock = Lock()
+
+    def add(self, duration, queries):
+        """Record one call, duration in milliseconds."""
+        with self._lock:
+            self.counts[bisect_left(BUCKETS, duration)] += 1
+            self.count += 1
+            self.total += duration
+            self.max = max(self.max, duration)
+            self.queries += queries
+
+    def stats(self):
+        """Return the histogram with mean and total values."""
+        labels = ['<=%s' % bound for bound in BUCKETS] + ['>%s' % BUCKETS[-1]]
+        return {
+            'count': self.count,
+            'total_ms': round(self.total, 3),
+            'mean_ms': round(self.total / self.count, 3) if self.count else 0,
+            'max_ms': round(self.max, 3),
+            'queries': self.queries,
+            'buckets_ms': dict(zip(labels, self.counts)),
+        }
+
+
+class QueryCounter(monitoring.CommandListener):
+    """Count the MongoDB commands started by each thread."""
+
+    def __init__(self):
+        self._local = local()
+        self._lock = Lock()
+        self.registered = False
+
+    @property
+    def count(self):
+        """Number of commands started by the current thread."""
+        return getattr(self._local, 'count', 0)
+
+    def register(self):
+        """Register the listener once, before the client is created."""
+        with self._lock:
+            if not self.registered:
+                monitoring.register(self)
+                self.registered = True
+
+    def started(self, _event):
+        """Count a command sent by the current thread."""
+        self._local.count = self.count + 1
+
+    def succeeded(self, _event):
+        """Nothing to do, only started commands are counted."""
+
+    def failed(self, _event):
+        """Nothing to do, only started commands are counted."""
+
+
+QUERY_COUNTER = QueryCounter()
+
+
+def register_query_counter():
+    """Register the listener, must happen before the client is created."""
+    QUERY_COUNTER.register()
+
+
+def _instrument(rule, method):
+    """Wrap a rule to record its duration and queries."""
+    @wraps(method)
+    def _timed(self, *args, **kwargs):
+        queries = QUERY_COUNTER.count
+        start = perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            duration = (perf_counter() - start) * 1000
+            queries = QUERY_COUNTER.count - queries
+            resource = (getattr(self, 'resource', None) or
+                        (request.endpoint or '').partition('|')[0])
+            record(resource, rule, duration, queries)
+    return _timed
+
+
+def instrumented(validator):
+    """Create a subclass of the validator with all rules instrumented."""
+    methods = {name: _instrument(name[len('_validate_'):],
+                                 getattr(validator, name))
+               for name in dir(validator)
+               if name.startswith('_validate_') and
+               callable(getattr(validator, name))}
+    return type(validator.__name__, (validator,), methods)
+
+
+def record(resource, rule, duration, queries):
+    """Add a measurement to the histogram and to the current request."""
+    key = (resource, rule)
+    with current_app.metrics_lock:
+        histogram = current_app.validation_metrics.get(key)
+        if histogram is None:
+            histogram = current_app.validation_metrics[key] = Histogram()
+    histogram.add(duration, queries)
+
+    timing = g.setdefault('validation_timing', {})
+    (total, total_queries) = timing.get(key, (0.0, 0))
+    timing[key] = (total + duration, total_queries + queries)
+
+
+def add_timing_header(response):
+    """After request: Show admins the timing of the rules."""
+    timing = g.pop('validation_timing', None)
+    if timing and g.get('admin'):
+        response.headers['X-Validation-Timing'] = ', '.join(
+            '%s.%s=%.2fms/%dq' % (resource, rule, duration, queries)
+            for ((resource, rule), (duration, queries))
+            in sorted(timing.items(), key=lambda item: -item[1][0]))
+    return response
+
+
+@admin_only
+def metrics():
+    """Endpoint to return the validation histograms."""
+    data = {}
+    for ((resource, rule), histogram) in sorted(
+            current_app.validation_metrics.items()):
+        data.setdefault(resource, {})[rule] = histogram.stats()
+    return send_response(None, (data,))
+
+
+def init_metrics(app):
+    """Prepare the histograms and register the endpoint and header."""
+    app.validation_metrics = {}
+    app.metrics_lock = Lock()
+    app.after_request(add_timing_header)
+    app.add_url_rule('%s/metrics' % app.api_prefix, 'metrics',
+                     view_func=metrics, methods=['GET'])
@@ -0,0 +1,131 @@
+"""Occupancy of rooms and assistants.
+
+A room or an assistant can not be booked by several courses at the same time.
+To check this quickly, every time slot of every course is stored as its own
+document in the internal `occupancy` collection (see `settings.py`), together
+with the room and assistant of the course, and start and end as seconds
+since the epoch (see `intervals.py`):
+
+    {'course': ..., 'room': ..., 'assistant': ..., 'start': ..., 'end': ...}
+
+With the indexes on room/assistant, start and end, finding a conflicting
+booking is a single range query instead of loading all courses in the room.
+
+The collection is kept in sync by the course hooks below, and built when the
+app starts if it is empty (e.g. on an existing deployment). If courses are
+modified in the database directly, use `flask rebuild-occupancy`.
+"""
+
+from itertools import chain
+
+from flask import current_app
+
+from backend.intervals import find_overlap, to_interval
+
+
+def _occupancy():
+    """Return the occupancy collection."""
+    return current_app.data.driver.db['occupancy']
+
+
+def _bookings(course):
+    """Create one occupancy document per time slot of the course."""
+    return [{
+        'course': course['_id'],
+        'room': course.get('room'),
+        'assistant': course.get('assistant'),
+        'start': start,
+        'end': end,
+    } for (start, end) in map(to_interval, course.get('datetimes') or [])]
+
+
+def rebuild_occupancy(course_ids=None):
+    """Replace the occupancy of the courses (all if None) from the courses.
+
+    Returns:
+        int: The number of stored time slots.
+    """
+    if course_ids is None:
+        _occupancy().delete_many({})
+        lookup = {}
+    else:
+        course_ids = list(course_ids)
+        _occupancy().delete_many({'course': {'$in': course_ids}})
+        lookup = {'_id': {'$in': course_ids}}
+
+    courses = current_app.data.driver.db['courses'].find(
+        lookup, {'room': 1, 'assistant': 1, 'datetimes': 1})
+    bookings = list(chain.from_iterable(_bookings(course)
+                                        for course in courses))
+    if bookings:
+        _occupancy().insert_many(bookings)
+    return len(bookings)
+
+
+def find_booking_conflict(field, value, intervals, course_id=None):
+    """Find an interval overlapping with a booking of the room or assistant.
+
+    Args:
+        field (str): 'room' or 'assistant'.
+        value: The room or assistant _id.
+        intervals (list): The intervals to book.
+        course_id: The course to ignore, i.e. the course being modified.
+
+    Returns:
+        tuple: The first conflicting pair of intervals (new and booked),
+            or None if there is no conflict.
+    """
+    if not intervals:
+        return None
+
+    lookup = {field: value,
+              '$or': [{'start': {'$lt': end}, 'end': {'$gt': start}}
+                      for (start, end) in intervals]}
+    if course_id is not None:
+        lookup['course'] = {'$ne': course_id}
+
+    booking = _occupancy().find_one(lookup)
+    if booking is None:
+        return None
+
+    booked = (booking['start'], booking['end'])
+    return next(((interval, booked) for interval in intervals
+                 if find_overlap([interval], [booked])), None)
+
+
+def init_occupancy(app):
+    """Build the occupancy if it is empty, but there are courses."""
+    with app.app_context():
+        courses = current_app.data.driver.db['courses']
+        if (_occupancy().find_one({}, {'_id': 1}) is None and
+                courses.find_one({'datetimes.0': {'$exists': True}},
+                                 {'_id': 1}) is not None):
+            rebuild_occupancy()
+
+
+# Hooks to keep the occupancy in sync with the courses
+
+def inserted_courses(courses):
+    """Add the time slots of new courses."""
+    rebuild_occupancy(course['_id'] for course in courses)
+
+
+def updated_course(updates, original):
+    """Update the time slots if room, assistant or times have changed."""
+    if {'room', 'assistant', 'datetimes'} & set(updates):
+        rebuild_occupancy([original['_id']])
+
+
+def replaced_course(_, original):
+    """Update the time slots of a replaced course."""
+    rebuild_occupancy([original['_id']])
+
+
+def deleted_course(course):
+    """Remove the time slots of a deleted course."""
+    _occupancy().delete_many({'course': course['_id']})
+
+
+def deleted_courses(_):
+    """All courses have been deleted, so nothing is booked anymore."""
+    _occupancy().delete_many({})
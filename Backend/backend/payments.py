@@ -1,16 +1,135 @@
-"""Handle Stripe API interactions."""
-from flask import abort
+"""Handle Stripe API interactions.
+
+Charging a card takes a round trip to Stripe, which can take seconds. To not
+block the server for this time, payments are processed in the background:
+
+1. A new payment is stored as `pending` (`create_payment`).
+2. A worker thread claims the payment by atomically setting it to
+   `processing`, so only one worker charges it, and charges the card
+   (`charge_payment`). Every payment has a deterministic idempotency key
+   derived from token and signups, so if the same payment is charged again
+   (e.g. after a restart of the server, once the claim has expired), Stripe
+   returns the original charge instead of charging the card twice.
+3. The payment is updated to `succeeded` (and the signups are marked as
+   paid) or `failed` with an error message.
+
+Clients poll the payment until it is no longer pending or processing.
+
+With the setting `STRIPE_ASYNC = False` the charge is performed right away
+in the request instead, which is handy for tests.
+`STRIPE_API_BASE` allows to use a local Stripe stub.
+
+All calls to Stripe go through `StripeCalls`, which limits the number of
+concurrent calls per process and retries calls that hit Stripe's rate limit
+(or could not connect) with jittered exponential backoff. Thanks to the
+idempotency key, a retry never charges a card twice.
+"""
+
+from datetime import datetime, timedelta
+from hashlib import sha256
+from queue import Queue
+from random import uniform
+from threading import BoundedSemaphore, Lock, Thread, Timer
+from time import sleep
+
+from bson import ObjectId
+from flask import abort, current_app
+from eve.methods.common import resolve_document_etag
+from pymongo import ReturnDocument
 import stripe
 
-from backend.settings import COURSE_PRICE, STRIPE_API_KEY
-from backend.signups import mark_as_paid
+from backend.pricing import payment_amount
+from backend.signups import mark_as_paid, mark_as_unpaid
+from backend.validation import get_documents
+
+
+# Error messages for the payment, the first matching error is used
+STRIPE_ERRORS = [
+    # Something's wrong with the card
+    (stripe.error.CardError, 'Card declined'),
+    # Too many requests made to the API too quickly
+    (stripe.error.RateLimitError, 'Too many requests'),
+    # Invalid parameters were supplied to Stripe's API
+    (stripe.error.InvalidRequestError, 'Invalid call to Stripe API'),
+    # Authentication with Stripe's API failed
+    (stripe.error.AuthenticationError,
+     'Authentication with Stripe API failed'),
+    # Network communication with Stripe failed
+    (stripe.error.APIConnectionError, 'Failed to connect to Stripe API'),
+    # Some error to do with Stripe
+    (stripe.error.StripeError, 'Stripe payment processing failed'),
+]
+
+
+# Errors after which the call is retried
+RETRY_ERRORS = (stripe.error.RateLimitError, stripe.error.APIConnectionError)
+
+
+class StripeCalls:
+    """Limit concurrent calls to Stripe and retry rate limited calls.
+
+    A call is retried up to `retries` times. Before the n-th retry, we wait
+    a random time between 0 and `backoff * 2^n` seconds (at most
+    `max_backoff`), so retries of parallel calls don't arrive all at once.
+    """
+
+    def __init__(self, concurrency, retries, backoff, max_backoff):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.counters = dict.fromkeys(
+            ['calls', 'retried', 'succeeded', 'failed', 'exhausted'], 0)
+        self._limiter = BoundedSemaphore(concurrency)
+        self._lock = Lock()
+
+    def _count(self, *names):
+        """Increment counters."""
+        with self._lock:
+            for name in names:
+                self.counters[name] += 1
 
+    def delay(self, retry):
+        """Return the seconds to wait before the retry (starting at 0)."""
+        return uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
 
-stripe.api_key = STRIPE_API_KEY
+    def call(self, function, **kwargs):
+        """Call the Stripe API function, retrying if necessary."""
+        self._count('calls')
+
+        retry = 0
+        while True:
+            try:
+                with self._limiter:
+                    result = function(**kwargs)
+            except RETRY_ERRORS:
+                if retry == self.retries:
+                    self._count('failed', 'exhausted')
+                    raise
+                self._count('retried')
+                sleep(self.delay(retry))
+                retry += 1
+            except stripe.error.StripeError:
+                self._count('failed')
+                raise
+            else:
+                self._count('succeeded')
+                return result
+
+    def stats(self):
+        """Return the counters."""
+        with self._lock:
+            return dict(self.counters)
+
+
+def idempotency_key(payment):
+    """Derive the idempotency key for Stripe from token and signups."""
+    signups = ','.join(sorted(str(signup) for signup in payment['signups']))
+    content = '%s:%s' % (payment['token'], signups)
+    return 'payment-%s' % sha256(content.encode()).hexdigest()
 
 
 def create_payment(payments):
-    """Create a charge with the Stripe API.
+    """Prepare the payment, the charge is made later.
 
     on_insert_payments hook
 
@@ -24,44 +143,227 @@ def create_payment(payments):
     if not payment['signups']:
         abort(400, 'Payment must be for at least one signup')
 
-    # For now we assume a constant price per course
-    amount = len(payment['signups']) * COURSE_PRICE
+    # The signups have already been loaded for validation
+    signups = get_documents('signups', payment['signups'])
+    payment['amount'] = payment_amount(signups.values())
 
     # If no token is set, we're dealing with an admin payment
     # Thus, no call to the Stripe API is made
     if not payment.get('token'):
-        return True
+        payment['status'] = 'succeeded'
+    else:
+        payment['status'] = 'pending'
+        payment['idempotency_key'] = idempotency_key(payment)
+
+
+def process_payments(payments):
+    """Mark admin payments as paid, charge all others.
+
+    on_inserted_payments hook
+    """
+    mark_as_paid([payment for payment in payments
+                  if payment['status'] == 'succeeded'])
+
+    for payment in payments:
+        if payment['status'] == 'pending':
+            if current_app.config['STRIPE_ASYNC']:
+                current_app.charge_workers.submit(payment['_id'])
+            else:
+                # Update the payment in place, so the response shows it
+                payment.update(charge_payment(payment['_id']) or {})
+
+
+def block_payment_deletion(payment):
+    """A payment can't be deleted while its card may still be charged.
+
+    on_delete_item_payments hook
+    """
+    if payment.get('status') in ('pending', 'processing'):
+        abort(409, "Payment cannot be deleted while it is processed.")
+
+
+def deleted_payment(payment):
+    """If a succeeded payment is deleted, the signups are unpaid again.
+
+    on_deleted_item_payments hook
+    """
+    if payment.get('status') == 'succeeded':
+        mark_as_unpaid([payment])
+
+
+def claim_payment(payment_id):
+    """Set a pending payment to processing, so no one else charges it.
+
+    A payment processing for longer than `STRIPE_CLAIM_TIMEOUT` can be
+    claimed again.
+
+    Returns:
+        dict: The claimed payment, or None if it is not pending.
+    """
+    now = datetime.utcnow().replace(microsecond=0)
+    expired = now - timedelta(
+        seconds=current_app.config['STRIPE_CLAIM_TIMEOUT'])
+    return current_app.data.driver.db['payments'].find_one_and_update(
+        {'_id': ObjectId(payment_id), '$or': [
+            {'status': 'pending'},
+            {'status': 'processing', '_updated': {'$lt': expired}},
+        ]},
+        {'$set': {'status': 'processing', '_updated': now}},
+        return_document=ReturnDocument.AFTER)
+
+
+def charge_payment(payment_id):
+    """Claim a pending payment, charge the card and store the outcome.
+
+    Returns:
+        dict: The updates of the payment, or None if it is not pending.
+    """
+    payment = claim_payment(payment_id)
+    if payment is None:
+        return None
 
-    # Create a new charge
     try:
-        charge = stripe.Charge.create(
-            amount=amount,
+        charge = current_app.stripe_calls.call(
+            stripe.Charge.create,
+            amount=payment['amount'],
             currency='CHF',
             source=payment['token'],
+            metadata={'payment': str(payment['_id'])},
+            idempotency_key=payment['idempotency_key'],
         )
-    except stripe.error.CardError:
-        # Something's wrong with the card
-        abort(422, 'Card declined')
-    except stripe.error.RateLimitError:
-        # Too many requests made to the API too quickly
-        abort(429, 'Too many requests')
-    except stripe.error.InvalidRequestError:
-        # Invalid parameters were supplied to Stripe's API
-        abort(500, 'Invalid call to Stripe API')
-    except stripe.error.AuthenticationError:
-        # Authentication with Stripe's API failed
-        abort(500, 'Authentication with Stripe API failed')
-    except stripe.error.APIConnectionError:
-        # Network communication with Stripe failed
-        abort(500, 'Failed to connect to Stripe API')
-    except stripe.error.StripeError:
-        # Some error to do with Stripe
-        abort(500, 'Stripe payment processing failed')
-
-    # Charge succeeded, save the charge id in the database
-    payment['charge_id'] = charge.id
-
-    # Mark corresponding signups as paid
-    mark_as_paid([payment])
+    except stripe.error.StripeError as error:
+        message = next(message for (error_type, message) in STRIPE_ERRORS
+                       if isinstance(error, error_type))
+        current_app.logger.info("Payment %s failed: %s", payment_id, error)
+        updates = {'status': 'failed', 'error': message}
+    else:
+        updates = {'status': 'succeeded', 'charge_id': charge.id}
+
+    store_outcome(payment, updates)
+    return updates
+
+
+def store_outcome(payment, updates, expected='processing'):
+    """Update the payment if it still has the expected status.
+
+    Like a PATCH, `_updated` and `_etag` are updated as well (`updates` is
+    modified in place). If the payment succeeds, the signups are marked as
+    paid, if a succeeded payment fails, they are marked as unpaid.
+
+    Returns:
+        bool: True if the payment has been updated.
+    """
+    updates['_updated'] = datetime.utcnow().replace(microsecond=0)
+    updated = dict(payment, **updates)
+    resolve_document_etag(updated, 'payments')
+    updates['_etag'] = updated['_etag']
 
+    # If the payment has been processed in the meantime, don't do it again
+    result = current_app.data.driver.db['payments'].update_one(
+        {'_id': payment['_id'], 'status': expected}, {'$set': updates})
+    if not result.modified_count:
+        return False
+
+    if updates['status'] == 'succeeded':
+        mark_as_paid([payment])
+    elif expected == 'succeeded':
+        mark_as_unpaid([payment])
     return True
+
+
+class ChargeWorkers:
+    """Threads processing pending payments in the background.
+
+    The threads are started before the first request. Then, all payments
+    still pending or processing from earlier (e.g. before a restart) are
+    queued as well. A payment claimed by someone else is queued again when
+    the claim expires, in case the claim was left by a crashed server.
+    """
+
+    def __init__(self, app, number):
+        self.app = app
+        self.number = number
+        self.queue = Queue()
+        self._threads = []
+        self._lock = Lock()
+
+    def submit(self, payment_id):
+        """Queue a payment to be charged."""
+        self.start(skip=payment_id)
+        self.queue.put(payment_id)
+
+    def start(self, skip=None):
+        """Start threads and queue all unfinished payments (except `skip`).
+
+        Does nothing if the threads are already running.
+        """
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.number):
+                thread = Thread(target=self._work, daemon=True,
+                                name='charges-%d' % index)
+                thread.start()
+                self._threads.append(thread)
+
+            lookup = {'status': {'$in': ['pending', 'processing']}}
+            if skip is not None:
+                lookup['_id'] = {'$ne': ObjectId(skip)}
+            unfinished = self.app.data.driver.db['payments'].find(
+                lookup, {'_id': 1})
+            for payment in unfinished:
+                self.queue.put(payment['_id'])
+
+    def _retry_later(self, payment_id):
+        """Queue the payment again when its claim expires, if processing."""
+        payment = self.app.data.driver.db['payments'].find_one(
+            {'_id': ObjectId(payment_id), 'status': 'processing'},
+            {'_updated': 1})
+        if payment is None:
+            return  # Done
+
+        claimed = payment['_updated'].replace(tzinfo=None)
+        expires = claimed + timedelta(
+            seconds=self.app.config['STRIPE_CLAIM_TIMEOUT'])
+        delay = (expires - datetime.utcnow()).total_seconds()
+        timer = Timer(max(delay, 0) + 1, self.queue.put, [payment_id])
+        timer.daemon = True
+        timer.start()
+
+    def _work(self):
+        """Process queued payments forever."""
+        while True:
+            payment_id = self.queue.get()
+            try:
+                with self.app.app_context():
+                    if charge_payment(payment_id) is None:
+                        self._retry_later(payment_id)
+            except Exception:  # pylint: disable=broad-except
+                # Stays processing and is retried when the claim expires
+                self.app.logger.exception("Charging payment %s failed",
+                                          payment_id)
+                with self.app.app_context():
+                    self._retry_later(payment_id)
+            finally:
+                self.queue.task_done()
+
+    def stats(self):
+        """Return number of threads and queued payments."""
+        return {
+            'threads': len(self._threads),
+            'queued': self.queue.qsize(),
+        }
+
+
+def init_payments(app):
+    """Configure Stripe and prepare the workers."""
+    stripe.api_key = app.config['STRIPE_API_KEY']
+    stripe.api_base = app.config['STRIPE_API_BASE']
+    app.stripe_calls = StripeCalls(app.config['STRIPE_CONCURRENCY'],
+                                   app.config['STRIPE_RETRIES'],
+                                   app.config['STRIPE_BACKOFF'],
+                                   app.config['STRIPE_MAX_BACKOFF'])
+    app.charge_workers = ChargeWorkers(app, app.config['STRIPE_WORKERS'])
+    if app.config['STRIPE_ASYNC']:
+        # Payments left over from before a restart are charged right away
+        app.before_first_request(app.charge_workers.start)
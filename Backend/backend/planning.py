@@ -0,0 +1,133 @@
+"""Semester Planning.
+
+When planning a semester, admins need to know which courses take place at
+the same time, e.g. to avoid parallel courses for lectures of the same
+department and year, which students are likely to take together.
+
+The report groups the courses by department and year of their lecture and
+only lists the conflicts within each group. For every group, the time slots
+of its courses are loaded into NumPy arrays, and the overlap of the time
+slots is computed in chunks and reduced to a course × course conflict
+matrix, so memory does not grow quadratically with the number of slots.
+
+The report is cached until any course or lecture changes.
+"""
+
+import numpy as np
+from flask import current_app
+from eve.render import send_response
+
+from backend.cache import LoaderCache
+from backend.intervals import to_interval
+from backend.security import admin_only
+
+
+def conflict_matrix(intervals, chunk_size=1024):
+    """Compute which courses overlap in time.
+
+    The overlap of the time slots is computed for `chunk_size` slots at a
+    time against all others, and directly reduced to courses. So memory
+    only grows linearly with the number of slots.
+
+    Args:
+        intervals (list): For every course, a list of its intervals.
+        chunk_size (int): Number of time slots compared at once.
+
+    Returns:
+        numpy.ndarray: Boolean matrix, True at (i, j) if the courses i and j
+            have overlapping intervals. The diagonal is False.
+    """
+    matrix = np.zeros((len(intervals), len(intervals)), dtype=bool)
+
+    # The slots are ordered by course
+    owners = np.array([index for (index, course) in enumerate(intervals)
+                       for _ in course], dtype=np.intp)
+    if not owners.size:
+        return matrix
+    slots = np.array([interval for course in intervals
+                      for interval in course], dtype=np.int64).reshape(-1, 2)
+    starts = slots[:, 0]
+    ends = slots[:, 1]
+
+    # Courses with slots, and the index of their first slot
+    (courses, firsts) = np.unique(owners, return_index=True)
+
+    for begin in range(0, owners.size, chunk_size):
+        rows = slice(begin, begin + chunk_size)
+        # Overlap of the slots of the chunk with all slots: each starts
+        # before the other ends
+        overlapping = ((starts[rows, np.newaxis] < ends[np.newaxis, :]) &
+                       (starts[np.newaxis, :] < ends[rows, np.newaxis]))
+
+        # Combine the columns, then the rows of the same course
+        (row_courses, row_firsts) = np.unique(owners[rows],
+                                              return_index=True)
+        overlaps = np.logical_or.reduceat(
+            np.logical_or.reduceat(overlapping, firsts, axis=1), row_firsts,
+            axis=0)
+        matrix[np.ix_(row_courses, courses)] |= overlaps
+
+    np.fill_diagonal(matrix, False)
+    return matrix
+
+
+def conflict_report():
+    """Find conflicting courses for every department and year.
+
+    Returns:
+        dict: For every group, the ids of the courses and the conflicts as
+            pairs of indices into the list of courses.
+    """
+    database = current_app.data.driver.db
+    lectures = {lecture['_id']: lecture for lecture in
+                database['lectures'].find({}, {'department': 1, 'year': 1})}
+    courses = list(database['courses'].find({}, {'lecture': 1,
+                                                 'datetimes': 1}))
+
+    intervals = [[to_interval(timeslot)
+                  for timeslot in course.get('datetimes') or []]
+                 for course in courses]
+
+    groups = {}
+    for (index, course) in enumerate(courses):
+        lecture = lectures.get(course.get('lecture'), {})
+        groups.setdefault((lecture.get('department'), lecture.get('year')),
+                          []).append(index)
+
+    def _order(key):
+        """Sort groups, courses without lecture last."""
+        (department, year) = key
+        return (department is None, department or '', year or 0)
+
+    report = []
+    for (department, year) in sorted(groups, key=_order):
+        indices = groups[(department, year)]
+        # Only the upper triangle, every conflict is listed once
+        within = np.triu(conflict_matrix([intervals[index]
+                                          for index in indices]), 1)
+        report.append({
+            'department': department,
+            'year': year,
+            'courses': [str(courses[index]['_id']) for index in indices],
+            'conflicts': np.argwhere(within).tolist(),
+        })
+
+    return {'courses': len(courses), 'groups': report}
+
+
+def cached_conflict_report():
+    """Return the report, computing it only if anything has changed."""
+    return current_app.planning_cache.get_or_load('conflicts',
+                                                  conflict_report)
+
+
+@admin_only
+def conflicts():
+    """Endpoint to return the conflict report."""
+    return send_response(None, (cached_conflict_report(),))
+
+
+def init_planning(app):
+    """Create the cache, cleared if courses or lectures change."""
+    app.planning_cache = LoaderCache(app.config['PLANNING_CACHE_TTL'], 1)
+    app.planning_cache.invalidate_on(app, ['courses', 'lectures'])
@@ -0,0 +1,59 @@
+"""Course Prices.
+
+The price of a course (in "rappen") is the price of its lecture, or the
+price of the department of the lecture (`DEPARTMENT_PRICES`), or the default
+`COURSE_PRICE`. A course can have a discount in percent of this price.
+
+To not look up courses and lectures for every payment, the prices of all
+courses are computed at once with one query for lectures and one for
+courses, and cached until any course or lecture changes. The amount of a
+payment then only needs one lookup in the cached prices per signup.
+"""
+
+from flask import current_app
+
+from backend.cache import LoaderCache
+
+
+def compute_prices():
+    """Compute the price of every course.
+
+    Returns:
+        dict: The price of every course by its _id.
+    """
+    database = current_app.data.driver.db
+    default = current_app.config['COURSE_PRICE']
+    departments = current_app.config['DEPARTMENT_PRICES']
+
+    lectures = {}
+    for lecture in database['lectures'].find({}, {'department': 1, 'price': 1}):
+        price = lecture.get('price')
+        if price is None:
+            price = departments.get(lecture.get('department'), default)
+        lectures[lecture['_id']] = price
+
+    prices = {}
+    for course in database['courses'].find({}, {'lecture': 1, 'discount': 1}):
+        price = lectures.get(course.get('lecture'), default)
+        discount = course.get('discount') or 0
+        prices[course['_id']] = price * (100 - discount) // 100
+    return prices
+
+
+def get_prices():
+    """Return the prices of all courses, computing them only if needed."""
+    return current_app.pricing_cache.get_or_load('prices', compute_prices)
+
+
+def payment_amount(signups):
+    """Return the total price of the courses of the signups."""
+    prices = get_prices()
+    default = current_app.config['COURSE_PRICE']
+    return sum(prices.get(signup.get('course'), default)
+               for signup in signups)
+
+
+def init_pricing(app):
+    """Create the cache, cleared if courses or lectures change."""
+    app.pricing_cache = LoaderCache(app.config['PRICING_CACHE_TTL'], 1)
+    app.pricing_cache.invalidate_on(app, ['courses', 'lectures'])
@@ -0,0 +1,157 @@
+"""Reconciliation of payments with Stripe.
+
+Every successful charge in Stripe should belong to a succeeded payment, and
+the other way round. Also, the signups of every succeeded payment should be
+accepted. `reconcile` checks this in two passes:
+
+1. All charges are paged through from Stripe, every page with a separate
+   call, so each one is rate limited and retried. Every batch of charges is
+   joined with the payments by `charge_id` (or the payment id stored in
+   the metadata of the charge, if the outcome of the charge could not be
+   stored, e.g. because the server crashed).
+2. All succeeded payments are paged through from the database. Every batch
+   is checked for charges that Stripe does not know and for signups that
+   are not accepted.
+
+Only the ids of the charges seen in the first pass are kept in memory, so
+a whole semester of payments can be checked at once.
+
+Every problem found is yielded right away. If requested, problems are
+repaired where possible, using the same functions as the payment hooks.
+"""
+
+from itertools import islice
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import current_app
+import stripe
+
+from backend.payments import store_outcome
+from backend.signups import mark_as_paid
+
+
+def _batches(iterable, size):
+    """Split an iterable into lists of at most `size` items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _metadata_id(charge):
+    """Return the payment id from the metadata of a charge, if any."""
+    try:
+        return ObjectId((charge.get('metadata') or {}).get('payment'))
+    except (InvalidId, TypeError):
+        return None
+
+
+def _problem(problem, payment=None, charge=None, repaired=False):
+    """Describe a mismatch between a payment and a charge."""
+    return {
+        'problem': problem,
+        'payment': str(payment['_id']) if payment else None,
+        'charge': charge['id'] if charge else None,
+        'repaired': repaired,
+    }
+
+
+def _charges(page_size=100):
+    """Page through all Stripe charges, newest first."""
+    starting_after = None
+    while True:
+        page = current_app.stripe_calls.call(stripe.Charge.list,
+                                             limit=page_size,
+                                             starting_after=starting_after)
+        yield from page.data
+        if not page.has_more or not page.data:
+            return
+        starting_after = page.data[-1]['id']
+
+
+def _check_charges(charges, repair):
+    """Join a batch of Stripe charges with the payments."""
+    payments = current_app.data.driver.db['payments']
+    by_charge = {payment['charge_id']: payment for payment in payments.find(
+        {'charge_id': {'$in': [charge['id'] for charge in charges]}})}
+
+    # Charges without payment may have been made for a processing payment
+    orphans = [charge for charge in charges
+               if charge['id'] not in by_charge and
+               charge.get('status') == 'succeeded' and
+               not charge.get('refunded')]
+    by_id = {payment['_id']: payment for payment in payments.find(
+        {'_id': {'$in': [_metadata_id(charge) for charge in orphans]}})}
+
+    for charge in charges:
+        paid = charge.get('status') == 'succeeded' and \
+            not charge.get('refunded')
+        payment = by_charge.get(charge['id'])
+
+        if payment is None:
+            if not paid:
+                continue  # Failed charges have no payment, that's fine
+            payment = by_id.get(_metadata_id(charge))
+            if payment and payment['status'] == 'succeeded':
+                # Paid with another charge, needs a refund by hand
+                yield _problem('duplicate charge', payment, charge)
+                continue
+            repaired = bool(
+                repair and payment and
+                store_outcome(payment, {'status': 'succeeded',
+                                        'charge_id': charge['id']},
+                              expected=payment['status']))
+            yield _problem('charge without payment', payment, charge,
+                           repaired)
+
+        elif payment['status'] == 'succeeded' and not paid:
+            problem = 'charge refunded' if charge.get('refunded') \
+                else 'charge not successful'
+            repaired = repair and store_outcome(
+                payment, {'status': 'failed', 'error': problem.capitalize()},
+                expected='succeeded')
+            yield _problem(problem, payment, charge, repaired)
+
+        elif payment['status'] == 'succeeded' and \
+                charge['amount'] != payment.get('amount', charge['amount']):
+            yield _problem('amount mismatch', payment, charge)
+
+
+def _check_payments(payments, charge_ids, repair):
+    """Check a batch of succeeded payments against charges and signups."""
+    for payment in payments:
+        if payment.get('charge_id') and payment['charge_id'] not in charge_ids:
+            yield _problem('payment without charge', payment)
+
+    signup_ids = [signup for payment in payments
+                  for signup in payment['signups']]
+    unpaid = set(current_app.data.driver.db['signups'].distinct(
+        '_id', {'_id': {'$in': signup_ids}, 'status': {'$ne': 'accepted'}}))
+
+    for payment in payments:
+        if unpaid & set(payment['signups']):
+            if repair:
+                mark_as_paid([payment])
+            yield _problem('signups not paid', payment, repaired=repair)
+
+
+def reconcile(batch_size=1000, repair=False):
+    """Compare all Stripe charges with all payments.
+
+    Yields:
+        dict: Every problem found, with payment and charge id.
+    """
+    charge_ids = set()
+    for batch in _batches(_charges(), batch_size):
+        charge_ids.update(charge['id'] for charge in batch)
+        yield from _check_charges(batch, repair)
+
+    payments = current_app.data.driver.db['payments'].find(
+        {'status': 'succeeded'},
+        {'signups': 1, 'charge_id': 1, 'status': 1},
+        batch_size=batch_size)
+    for batch in _batches(payments, batch_size):
+        yield from _check_payments(batch, charge_ids, repair)
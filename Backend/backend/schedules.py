@@ -0,0 +1,96 @@
+"""Schedules of users.
+
+Users may not sign up for (or select) courses at the same time. To check
+this, we need the time slots of all courses a user has already chosen.
+Students choose several courses in a row when signups open, so the schedule
+of every user is kept in memory: a dict mapping the ids of the chosen
+courses to their time slots as intervals (see `intervals.py`), separately
+for signups and selections. The intervals of single courses are cached as
+well.
+
+A change to signups or selections removes the schedules of the affected
+users, any change to courses removes everything. Like for the catalog, a
+generation counter ensures that schedules loaded before a change are not
+stored afterwards.
+"""
+
+from flask import current_app
+
+from backend.cache import LoaderCache, CHANGE_EVENTS
+from backend.intervals import to_interval
+
+
+def _intervals(course):
+    """Return the intervals of all time slots of a course."""
+    return [to_interval(timeslot)
+            for timeslot in (course or {}).get('datetimes') or []]
+
+
+def course_times(course_id):
+    """Return the intervals of a course (empty if it does not exist)."""
+    def load():
+        return _intervals(current_app.data.driver.db['courses'].find_one(
+            {'_id': course_id}, {'datetimes': 1}))
+
+    return current_app.schedule_cache.get_or_load(('courses', course_id),
+                                                  load)
+
+
+def get_schedule(resource, nethz):
+    """Return the intervals of all courses of the user's signups/selections.
+
+    Args:
+        resource (str): 'signups' or 'selections'.
+        nethz (str): The user.
+
+    Returns:
+        dict: Course ids mapped to the intervals of the course.
+    """
+    def load():
+        database = current_app.data.driver.db
+        items = database[resource].find({'nethz': nethz}, {'course': 1})
+        course_ids = list({item['course'] for item in items})
+        courses = database['courses'].find({'_id': {'$in': course_ids}},
+                                           {'datetimes': 1})
+        return {course['_id']: _intervals(course) for course in courses}
+
+    return current_app.schedule_cache.get_or_load((resource, nethz), load)
+
+
+def _users(documents):
+    """Find the nethz of all documents in the hook arguments."""
+    users = set()
+    for document in documents:
+        for item in document if isinstance(document, list) else [document]:
+            if isinstance(item, dict) and item.get('nethz'):
+                users.add(item['nethz'])
+    return users
+
+
+def invalidate_schedules(resource, *documents):
+    """Remove the schedules of the users whose signups/selections changed.
+
+    Can be used for all `on_inserted`, `on_updated`, `on_replaced`,
+    `on_deleted_item` and `on_deleted_resource` events.
+    """
+    if resource in ('signups', 'selections'):
+        if not documents:
+            clear_schedules()
+        for nethz in _users(documents):
+            current_app.schedule_cache.pop((resource, nethz))
+
+
+def clear_schedules():
+    """Remove all cached schedules and time slots."""
+    current_app.schedule_cache.clear()
+
+
+def init_schedules(app):
+    """Create the cache and register all required hooks."""
+    app.schedule_cache = LoaderCache(app.config['SCHEDULE_CACHE_TTL'],
+                                     app.config['SCHEDULE_CACHE_SIZE'])
+    app.schedule_cache.invalidate_on(app, ['courses'])
+
+    for name in CHANGE_EVENTS:
+        event = getattr(app, name)
+        event += invalidate_schedules
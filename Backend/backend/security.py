@@ -11,6 +11,22 @@ The important bits are:
   need to worry about sending a request twice. Furthermore, we can directly set
   the values in `g` to avoid API requests during unittests.
 
+  Across requests, results are kept in the `user_cache` of the app, which
+  maps tokens to user data and admin status. Users send many requests with
+  the same token, so most of them never need to contact AMIVAPI at all.
+  The id of the admin group is resolved at startup and kept in the app as
+  well, so checking admin permissions needs only one request.
+  All requests share a connection pool, avoiding a new TCP and TLS handshake
+  for every request.
+  Invalid tokens are remembered for a short time in `rejected_tokens`, as
+  clients tend to retry several times with the same expired token.
+  Finally, concurrent lookups for the same token are coalesced, such that
+  only one of them actually sends a request.
+
+  If AMIVAPI is down, a circuit breaker stops sending requests for a while.
+  In the meantime, known users are served from the cache even if their
+  data is expired, and refreshed in the background once AMIVAPI is back.
+
 - Authentication class working with tokens.
 
   Take a look at the [Eve docs](http://python-eve.org/authentication.html) for
@@ -19,21 +35,158 @@ The important bits are:
 
 from functools import wraps
 import json
+from threading import Lock, Thread, Timer
+from time import monotonic
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from eve.auth import TokenAuth
-from flask import g, current_app, abort
+from flask import g, current_app, abort, request
 
 
 # Requests to AMIVAPI
 
-def api_get(endpoint, **params):
-    """Format and send a GET request to AMIVAPI. Return json data or None."""
+def create_session(config):
+    """Create a HTTP session to re-use connections to AMIVAPI.
+
+    Failed GET requests (connection errors and gateway errors) are retried.
+    """
+    retries = Retry(total=config['AMIVAPI_RETRIES'],
+                    backoff_factor=0.1,
+                    status_forcelist=[502, 503, 504],
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=config['AMIVAPI_POOL_SIZE'],
+                          max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def pool_stats(session):
+    """Return number of created connections and sent requests per host.
+
+    With working keep-alive, there are many more requests than connections.
+    """
+    stats = {}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['%s://%s' % (pool.scheme, pool.host)] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'maxsize': pool.pool.maxsize if pool.pool else 0,
+            }
+    return stats
+
+
+class APIUnavailable(Exception):
+    """AMIVAPI could not be reached or failed to process the request."""
+
+
+class CircuitBreaker:
+    """Stop sending requests to AMIVAPI after several failures in a row.
+
+    After `threshold` consecutive failures, the breaker is open and all
+    requests fail immediately for `timeout` seconds. Afterwards, a single
+    request is let through to check whether AMIVAPI has recovered. If it
+    succeeds, the breaker closes, otherwise it stays open for another
+    `timeout` seconds.
+    """
+
+    def __init__(self, threshold, timeout):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self._opened = None
+        self._lock = Lock()
+
+    @property
+    def state(self):
+        """Either 'closed', 'open' or 'half-open'."""
+        if self._opened is None:
+            return 'closed'
+        if monotonic() - self._opened < self.timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """Return True if a request may be sent."""
+        with self._lock:
+            state = self.state
+            if state == 'half-open':
+                # Let one request through, block the others until it's done
+                self._opened = monotonic()
+                return True
+            if state == 'open':
+                self.rejected += 1
+                return False
+            return True
+
+    def success(self):
+        """Request succeeded, close the breaker."""
+        with self._lock:
+            self.failures = 0
+            self._opened = None
+
+    def failure(self):
+        """Request failed, open the breaker if there are too many failures."""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self._opened is None:
+                    self.trips += 1
+                self._opened = monotonic()
+
+    def stats(self):
+        """Return state and counters."""
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'trips': self.trips,
+            'rejected': self.rejected,
+        }
+
+
+def api_get(endpoint, token=None, **params):
+    """Format and send a GET request to AMIVAPI. Return json data or None.
+
+    By default, the token of the current request is used.
+    The request uses the connection pool of the app.
+
+    Raises APIUnavailable if AMIVAPI does not respond or has an internal
+    error, as we can't tell whether the data exists in this case.
+    This also happens without sending a request if the circuit breaker
+    of the app is open.
+    """
     url = requests.compat.urljoin(current_app.config['AMIVAPI_URL'], endpoint)
-    headers = {'Authorization': "Token %s" % g.token}
+    token = token or g.get('token')
+    headers = {'Authorization': "Token %s" % token} if token else {}
 
     formatted = {key: json.dumps(value) for (key, value) in params.items()}
 
-    response = requests.get(url, params=formatted, headers=headers)
+    breaker = current_app.amivapi_breaker
+    if not breaker.allow():
+        raise APIUnavailable("circuit breaker open")
+
+    try:
+        response = current_app.amivapi.get(
+            url, params=formatted, headers=headers,
+            timeout=current_app.config['AMIVAPI_TIMEOUT'])
+    except requests.RequestException as error:
+        breaker.failure()
+        current_app.logger.error("Request to AMIVAPI failed: %s" % error)
+        raise APIUnavailable(str(error))
+
+    if response.status_code >= 500:
+        breaker.failure()
+        current_app.logger.error("AMIVAPI error: %s" % response.status_code)
+        raise APIUnavailable(response.status_code)
+
+    breaker.success()
     return response.json() if (response.status_code == 200) else None
 
 
@@ -52,18 +205,97 @@ def request_cache(key):
     return _decorator
 
 
+def get_token():
+    """Extract the token from the Authorization header, like Eve does."""
+    if hasattr(request.authorization, 'username'):
+        return request.authorization.username
+
+    token = request.headers.get('Authorization', '').strip()
+    if token.lower().startswith(('token', 'bearer')):
+        token = token.split(' ')[-1]
+    return token or None
+
+
+def forget_token(token):
+    """Remove all cached data for a token."""
+    current_app.user_cache.pop(token)
+
+
+def logout():
+    """Endpoint to remove the token of the request from the cache.
+
+    Call this after deleting a session in AMIVAPI, such that the token
+    is not accepted anymore until the cached data would expire.
+    """
+    token = get_token()
+    if token is not None:
+        forget_token(token)
+    return '', 204
+
+
+def admin_only(function):
+    """Use as decorator: Only admins can access a custom endpoint.
+
+    The Eve endpoints use `APIAuth` instead.
+    """
+    @wraps(function)
+    def _wrapper(*args, **kwargs):
+        g.token = get_token()
+        if get_user() is None:
+            abort(401)
+        if not is_admin():
+            abort(403)
+        return function(*args, **kwargs)
+    return _wrapper
+
+
 @request_cache('apiuser')
 def get_user():
     """Return user data if the token is valid, None otherwise."""
-    if g.get('token') is not None:
-        response = api_get(
-            'sessions',
-            where={'token': g.get('token', '')},
-            projection={'user': 1},
-            embedded={'user': 1}
-        )
-        if response:
-            return response['_items'][0]['user']
+    token = g.get('token')
+    if token is None:
+        return None
+
+    cached = current_app.user_cache.get(token)
+    if cached is not None:
+        return cached['user']
+
+    # Clients often retry with invalid tokens, don't ask AMIVAPI every time
+    if current_app.rejected_tokens.get(token):
+        return None
+
+    try:
+        # Parallel requests with the same token share one lookup
+        return current_app.amivapi_lookups.call(('user', token),
+                                                _lookup_user, token)
+    except APIUnavailable:
+        # If we have seen the user before, we can continue with the old
+        # data. Otherwise we can't know whether the token is valid.
+        stale = current_app.user_cache.get_stale(token)
+        if stale is None:
+            abort(503, "AMIVAPI is unavailable, please try again later.")
+        app = current_app._get_current_object()  # pylint: disable=W0212
+        revalidate_later(app, token)
+        return stale['user']
+
+
+def _lookup_user(token):
+    """Ask AMIVAPI for the user of a token and cache the result."""
+    response = api_get(
+        'sessions',
+        token=token,
+        where={'token': token},
+        projection={'user': 1},
+        embedded={'user': 1}
+    )
+    if response:
+        user = response['_items'][0]['user']
+        current_app.user_cache.set(token, {'user': user})
+        return user
+
+    # Token is not (or no longer) valid
+    forget_token(token)
+    current_app.rejected_tokens.set(token, True)
     return None
 
 
@@ -73,30 +305,144 @@ def is_admin():
 
     The result is saved in g, to avoid checking twice, so there is no
     performance loss if is_admin is called multiple times during a request.
+    Additionally, it is stored in the user cache next to the user data.
     """
     user = get_user()
-    if user is not None:
-        # Find Group with correct name, return list of members
-        groups = api_get(
-            'groups',
-            where={'name': current_app.config['ADMIN_GROUP_NAME']},
-            projection={'_id': 1}
-        )
-        if groups and groups['_items']:
-            group_id = groups['_items'][0]['_id']
-
-            membership = api_get(
-                'groupmemberships',
-                where={'user': user['_id'], 'group': group_id},
-                # This Projection currectly crashes AMIVAPI
-                # https://github.com/amiv-eth/amivapi/issues/206
-                # projection={'_id': 1}
-            )
-
-            return bool(membership and membership['_items'])
-
-    # In all other cases, user is not an admin.
-    return False
+    if user is None:
+        return False
+
+    token = g.get('token')
+    cached = current_app.user_cache.get(token)
+    if cached is not None and 'admin' in cached:
+        return cached['admin']
+
+    try:
+        admin = current_app.amivapi_lookups.call(('admin', user['_id']),
+                                                 _check_admin_group, user)
+    except APIUnavailable:
+        # Use old data if possible, but don't cache, try again next time
+        stale = current_app.user_cache.get_stale(token)
+        return stale.get('admin', False) if stale is not None else False
+
+    current_app.user_cache.set(token, {'user': user, 'admin': admin})
+    return admin
+
+
+def revalidate_later(app, token):
+    """Refresh stale data of a token when AMIVAPI is available again.
+
+    Only one refresh per token is scheduled at a time. If AMIVAPI is still
+    unavailable, try again later until the stale data has expired.
+    """
+    with app.revalidation_lock:
+        if token in app.revalidating:
+            return
+        app.revalidating.add(token)
+
+    timer = Timer(app.config['AMIVAPI_BREAKER_TIMEOUT'],
+                  _revalidate, args=(app, token))
+    timer.daemon = True
+    timer.start()
+
+
+def _revalidate(app, token):
+    """Look up the token again, reschedule if AMIVAPI is still unavailable."""
+    with app.revalidation_lock:
+        app.revalidating.discard(token)
+
+    with app.app_context():
+        try:
+            app.amivapi_lookups.call(('user', token), _lookup_user, token)
+        except APIUnavailable:
+            if app.user_cache.get_stale(token) is not None:
+                revalidate_later(app, token)
+
+
+def _check_admin_group(user):
+    """Ask AMIVAPI whether the user is in the admin group."""
+    group_id = current_app.admin_group_id or resolve_admin_group()
+    if group_id is None:
+        # Without admin group, nobody is an admin
+        return False
+
+    membership = api_get(
+        'groupmemberships',
+        where={'user': user['_id'], 'group': group_id},
+        # This Projection currectly crashes AMIVAPI
+        # https://github.com/amiv-eth/amivapi/issues/206
+        # projection={'_id': 1}
+    )
+
+    return bool(membership and membership['_items'])
+
+
+# Admin group
+
+def resolve_admin_group(token=None):
+    """Look up the id of the admin group and store it in the app.
+
+    If the group is not found, the previously known id is kept.
+    Returns the id of the admin group, None if it's unknown.
+    """
+    groups = api_get(
+        'groups',
+        token=token,
+        where={'name': current_app.config['ADMIN_GROUP_NAME']},
+        projection={'_id': 1}
+    )
+    if groups and groups['_items']:
+        current_app.admin_group_id = groups['_items'][0]['_id']
+    return current_app.admin_group_id
+
+
+def init_admin_group(app):
+    """Resolve the admin group in the background and refresh it regularly.
+
+    Creating the app does not contact AMIVAPI: the first lookup runs in a
+    background thread once the app handles its first request, so importing
+    the app (e.g. for commands or tests) neither blocks nor starts threads.
+    Until the group is known, it is resolved with the token of the first
+    request that checks admin rights.
+    """
+    app.admin_group_id = None
+    if app.config['ADMIN_GROUP_REFRESH']:
+        app.before_first_request(lambda: _start_admin_group_refresh(app))
+
+
+def _start_admin_group_refresh(app):
+    """Resolve the admin group right away, in the background."""
+    thread = Thread(target=_refresh_admin_group, args=(app,),
+                    name='admin-group', daemon=True)
+    thread.start()
+
+
+def _try_resolve_admin_group(app):
+    """Resolve the admin group outside of requests, ignore failures."""
+    with app.app_context():
+        try:
+            group_id = resolve_admin_group(app.config['AMIVAPI_TOKEN'])
+        except APIUnavailable:
+            group_id = app.admin_group_id
+        if group_id is None:
+            app.logger.warning("Admin group '%s' could not be resolved."
+                               % app.config['ADMIN_GROUP_NAME'])
+        return group_id
+
+
+def _schedule_admin_group_refresh(app):
+    """Refresh the admin group in the background after some time."""
+    timer = Timer(app.config['ADMIN_GROUP_REFRESH'],
+                  _refresh_admin_group, args=(app,))
+    timer.daemon = True  # Don't keep the process alive
+    timer.start()
+
+
+def _refresh_admin_group(app):
+    """Resolve the admin group again and schedule the next refresh."""
+    try:
+        _try_resolve_admin_group(app)
+    finally:
+        _schedule_admin_group_refresh(app)
 
 
 # Auth
@@ -19,6 +19,35 @@ X_HEADERS = ['Authorization', 'If-Match', 'If-Modified-Since', 'Content-Type']
 AMIVAPI_URL = 'https://api.amiv.ethz.ch'
 ADMIN_GROUP_NAME = 'PVK Admins'
 
+# The id of the admin group is resolved in the background after the first
+# request and refreshed regularly (interval in seconds). Set to 0 to only
+# resolve it on the first admin check.
+# If AMIVAPI does not allow reading groups publicly, provide a token.
+ADMIN_GROUP_REFRESH = 3600
+AMIVAPI_TOKEN = None
+
+# Connections to AMIVAPI: Maximum number of kept-alive connections,
+# timeout (connect, read) in seconds and retries for failed requests
+AMIVAPI_POOL_SIZE = 10
+AMIVAPI_TIMEOUT = (3.05, 10)
+AMIVAPI_RETRIES = 2
+
+# Stop sending requests to AMIVAPI for some time (seconds) after several
+# failed requests in a row
+AMIVAPI_BREAKER_THRESHOLD = 5
+AMIVAPI_BREAKER_TIMEOUT = 30
+
+# Cache user data and admin status per token to avoid requests to AMIVAPI.
+# Lifetime of an entry in seconds and maximum number of cached tokens
+AMIVAPI_CACHE_TTL = 300
+AMIVAPI_CACHE_SIZE = 10000
+# If AMIVAPI is unavailable, expired data may still be used for a while
+AMIVAPI_CACHE_STALE = 3600
+
+# Invalid tokens are remembered separately for a shorter time
+AMIVAPI_REJECTED_TTL = 10
+AMIVAPI_REJECTED_SIZE = 1000
+
 # DB (can be set by env for easier CI tests)
 MONGO_HOST = environ.get('MONGO_HOST', 'localhost')
 MONGO_PORT = environ.get('MONGO_PORT', 27017)
@@ -39,9 +68,35 @@ ITEM_METHODS = ['GET', 'PATCH', 'DELETE']
 # TODO: Not a good idea to keep this in the repo
 STRIPE_API_KEY = 'sk_test_KUiZO8E2VKGMmm94u4t5YPnL'
 
-
-# Price per course in "rappen"
+# Charges are made by background threads (see `payments.py`). If disabled,
+# the charge is made during the request. The API base can be changed to use
+# a local Stripe stub.
+STRIPE_ASYNC = True
+STRIPE_WORKERS = 4
+STRIPE_API_BASE = 'https://api.stripe.com'
+
+# A payment is claimed by one worker before it is charged. If the worker
+# does not finish (e.g. the server crashed), the payment can be claimed
+# again after STRIPE_CLAIM_TIMEOUT seconds.
+STRIPE_CLAIM_TIMEOUT = 600
+
+# At most STRIPE_CONCURRENCY calls to Stripe at the same time per process.
+# Rate limited calls are retried STRIPE_RETRIES times, waiting up to
+# STRIPE_BACKOFF * 2^n seconds before the n-th retry (at most
+# STRIPE_MAX_BACKOFF seconds).
+STRIPE_CONCURRENCY = 4
+STRIPE_RETRIES = 3
+STRIPE_BACKOFF = 0.5
+STRIPE_MAX_BACKOFF = 8
+
+
+# Price per course in "rappen", unless the lecture has a price or there is a
+# price for its department. Courses can have a discount in percent.
+# The prices of all courses are cached until courses or lectures change
+# (see `pricing.py`).
 COURSE_PRICE = 1000
+DEPARTMENT_PRICES = {}
+PRICING_CACHE_TTL = 86400
 
 
 # ISO 8601 time format instead of rfc1123
@@ -80,14 +135,51 @@ TIMESPAN_SCHEMA = {
 }
 
 
-# Same as Eve, but include 403
-STANDARD_ERRORS = [400, 401, 403, 404, 405, 406, 409, 410, 412, 422, 428]
+# Resources with public GET (see `public_methods` in the DOMAIN) are the
+# same for everyone, their responses are cached until anything changes
+CATALOG_CACHE_TTL = 600
+CATALOG_CACHE_SIZE = 1000
+
+# The courses chosen by every user are kept in memory to check for timing
+# conflicts, they are removed as soon as signups, selections or courses change
+SCHEDULE_CACHE_TTL = 600
+SCHEDULE_CACHE_SIZE = 10000
+
+# The conflict report for semester planning is computed for all courses at
+# once and cached until courses or lectures change
+PLANNING_CACHE_TTL = 86400
+
+# Measure duration and database queries of every validation rule, available
+# for admins at `/metrics` and in the `X-Validation-Timing` header
+# (see `metrics.py`). Adds a little overhead to every request.
+VALIDATION_METRICS = False
+
+
+# Indexes are defined per resource with `mongo_indexes` and created by Eve
+# when the app starts (if they don't exist yet). Building them in the
+# background does not block the database.
+# Use `flask indexes` to check them (see `commands.py`).
+INDEX_OPTIONS = {'background': True}
+
+# Unique per user, e.g. only one signup per course and user. Enforces the
+# `unique_combination` rule (see `data.py`). Only documents with a nethz are
+# included, every document created via the API has one.
+UNIQUE_PER_USER_OPTIONS = dict(INDEX_OPTIONS, unique=True,
+                               partialFilterExpression={
+                                   'nethz': {'$exists': True}})
+
+
+# Same as Eve, but include 403 and 503 (AMIVAPI unavailable)
+STANDARD_ERRORS = [400, 401, 403, 404, 405, 406, 409, 410, 412, 422, 428,
+                   503]
 
 
 # Resources
 DOMAIN = {
     'assistants': {
         'user_methods': ['GET'],
+        'public_methods': ['GET'],
+        'public_item_methods': ['GET'],
 
         'schema': {
             'name': {
@@ -111,6 +203,8 @@ DOMAIN = {
     'lectures': {
 
         'user_methods': ['GET'],
+        'public_methods': ['GET'],
+        'public_item_methods': ['GET'],
 
         'schema': {
             'title': {
@@ -133,12 +227,26 @@ DOMAIN = {
                 'max': 3,
                 'required': True
             },
+            'price': {  # In "rappen", see `COURSE_PRICE`
+                'type': 'integer',
+                'min': 0,
+                'nullable': True,
+            },
         },
     },
 
     'courses': {
 
         'user_methods': ['GET'],
+        'public_methods': ['GET'],
+        'public_item_methods': ['GET'],
+
+        'mongo_indexes': {
+            # Filtering courses by room and assistant (booking validation
+            # uses the occupancy, see below)
+            'room': ([('room', 1)], INDEX_OPTIONS),
+            'assistant': ([('assistant', 1)], INDEX_OPTIONS),
+        },
 
         'schema': {
             'lecture': {
@@ -182,7 +290,13 @@ DOMAIN = {
                 'min': 1,
                 'required': True,
                 'nullable': False,
-            }
+            },
+            'discount': {  # In percent of the lecture price
+                'type': 'integer',
+                'min': 0,
+                'max': 100,
+                'nullable': True,
+            },
         },
     },
 
@@ -191,6 +305,24 @@ DOMAIN = {
 
         'user_methods': ['GET', 'POST', 'PATCH', 'DELETE'],
 
+        'mongo_indexes': {
+            # Waiting list: filter by course and status, sort by _updated
+            # and nethz. Also used to count signups per course.
+            'course_status_updated_nethz': ([
+                ('course', 1),
+                ('status', 1),
+                ('_updated', 1),
+                ('nethz', 1),
+            ], INDEX_OPTIONS),
+            # Users only see their own signups
+            'nethz': ([('nethz', 1)], INDEX_OPTIONS),
+            # Only one signup per course and user
+            'course_nethz': ([
+                ('course', 1),
+                ('nethz', 1),
+            ], UNIQUE_PER_USER_OPTIONS),
+        },
+
         'schema': {
             'nethz': {
                 'type': 'string',
@@ -227,6 +359,16 @@ DOMAIN = {
 
         'user_methods': ['GET', 'POST', 'PATCH', 'DELETE'],
 
+        'mongo_indexes': {
+            # Users only see their own selections
+            'nethz': ([('nethz', 1)], INDEX_OPTIONS),
+            # Only one selection per course and user
+            'course_nethz': ([
+                ('course', 1),
+                ('nethz', 1),
+            ], UNIQUE_PER_USER_OPTIONS),
+        },
+
         'schema': {
             'nethz': {
                 'type': 'string',
@@ -261,6 +403,16 @@ DOMAIN = {
         # Also, there is no reason to ever change a payment.
         'user_methods': ['GET', 'POST'],
 
+        'mongo_indexes': {
+            # Signups with a payment in progress can't be paid again
+            'signups_status': ([
+                ('signups', 1),
+                ('status', 1),
+            ], INDEX_OPTIONS),
+            # Reconciliation joins payments with Stripe charges
+            'charge_id': ([('charge_id', 1)], INDEX_OPTIONS),
+        },
+
         'schema': {
             'signups': {
                 'type': 'list',
@@ -277,6 +429,8 @@ DOMAIN = {
                     'no_accepted': True,
                 },
                 'no_copies': True,
+                # No signups which are part of a pending payment
+                'no_pending': True,
                 'required': True,
                 'nullable': False,
             },
@@ -299,7 +453,49 @@ DOMAIN = {
                 'type': 'integer',
                 'required': False,
                 'nullable': True,
-            }
+            },
+            'status': {  # Set by payment backend, see `payments.py`
+                'type': 'string',
+                'allowed': ['pending', 'processing', 'succeeded',
+                            'failed'],
+                'readonly': True,
+            },
+            'error': {  # Set by payment backend if the charge failed
+                'type': 'string',
+                'readonly': True,
+            },
         }
-    }
+    },
+
+    'occupancy': {
+        # Booked time slots of rooms and assistants, one document per time
+        # slot of every course. Not accessible via the API, it is kept in
+        # sync with the courses by hooks (see `occupancy.py`) and used for
+        # room and assistant booking validation.
+        'internal_resource': True,
+
+        'mongo_indexes': {
+            # Overlap queries: start < new end and end > new start
+            'room_start_end': ([
+                ('room', 1),
+                ('start', 1),
+                ('end', 1),
+            ], INDEX_OPTIONS),
+            'assistant_start_end': ([
+                ('assistant', 1),
+                ('start', 1),
+                ('end', 1),
+            ], INDEX_OPTIONS),
+            'course': ([('course', 1)], INDEX_OPTIONS),
+        },
+
+        'schema': {
+            'course': {'type': 'objectid'},
+            'room': {'type': 'string', 'nullable': True},
+            'assistant': {'type': 'objectid', 'nullable': True},
+            # Seconds since the epoch (UTC)
+            'start': {'type': 'integer'},
+            'end': {'type': 'integer'},
+        },
+    },
 }
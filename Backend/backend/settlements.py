@@ -0,0 +1,153 @@
+"""Bulk Settlements.
+
+Admins record cash and invoice payments as payments without token. At the
+start of the semester, there are hundreds of them, and posting them one by
+one to `/payments` validates and writes every payment on its own.
+
+Instead, admins can post all of them at once to `/settlements`:
+
+    {"settlements": [{"nethz": "pvkuser", "signups": ["<signup _id>", ...]},
+                     ...]}
+
+All signups are loaded with a single query and validated together, with the
+same rules as for payments. Only if all of them are valid, all payments are
+stored with a single insert, and all signups are marked as paid with a
+single bulk write (by the `on_inserted` hooks of payments). Otherwise, the
+issues of every invalid settlement are returned and nothing is stored.
+"""
+
+from datetime import datetime
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import abort, current_app, request
+from eve.methods.common import resolve_document_etag
+from eve.render import send_response
+from eve.utils import config
+
+from backend.pricing import payment_amount
+from backend.security import admin_only
+
+
+def _parse(settlements):
+    """Check the structure of the request and convert all signup ids."""
+    if not isinstance(settlements, list) or not settlements:
+        abort(400, "'settlements' must be a non-empty list")
+
+    parsed = []
+    for settlement in settlements:
+        if (not isinstance(settlement, dict) or
+                not isinstance(settlement.get('nethz'), str) or
+                not isinstance(settlement.get('signups'), list) or
+                not settlement['signups']):
+            abort(400, "every settlement needs a 'nethz' and a non-empty "
+                       "list of 'signups'")
+        try:
+            signups = [ObjectId(signup) for signup in settlement['signups']]
+        except (InvalidId, TypeError):
+            abort(400, "'signups' must only contain signup ids")
+        parsed.append((settlement['nethz'], signups))
+    return parsed
+
+
+def load_signups(settlements):
+    """Load all signups of the settlements with a single query."""
+    signup_ids = [signup for (_, signups) in settlements
+                  for signup in signups]
+    return {signup['_id']: signup for signup in
+            current_app.data.driver.db['signups'].find(
+                {'_id': {'$in': signup_ids}},
+                {'nethz': 1, 'status': 1, 'course': 1})}
+
+
+def find_issues(settlements, signups):
+    """Validate all settlements at once.
+
+    Returns:
+        dict: The issues of every invalid settlement by its index.
+    """
+    pending = set(current_app.data.driver.db['payments'].distinct(
+        'signups', {'signups': {'$in': list(signups)},
+                    'status': {'$in': ['pending', 'processing']}}))
+
+    issues = {}
+    seen = set()
+    for (index, (nethz, ids)) in enumerate(settlements):
+        errors = []
+        for signup_id in ids:
+            signup = signups.get(signup_id)
+            if signup_id in seen:
+                errors.append("signup %s appears several times" % signup_id)
+            elif signup is None:
+                errors.append("signup %s does not exist" % signup_id)
+            elif signup['nethz'] != nethz:
+                errors.append("signup %s belongs to another user" %
+                              signup_id)
+            elif signup['status'] == 'waiting':
+                errors.append("signup %s is still on the waiting list" %
+                              signup_id)
+            elif signup['status'] == 'accepted':
+                errors.append("signup %s has already been paid" % signup_id)
+            elif signup_id in pending:
+                errors.append("signup %s has a payment in progress" %
+                              signup_id)
+            seen.add(signup_id)
+        if errors:
+            issues[str(index)] = {'signups': errors}
+    return issues
+
+
+def settle(settlements, signups):
+    """Store a payment for every settlement and mark the signups as paid.
+
+    Returns:
+        list: The stored payments.
+    """
+    now = datetime.utcnow().replace(microsecond=0)  # Same precision as Eve
+
+    payments = []
+    for (_, ids) in settlements:
+        payment = {
+            'signups': ids,
+            'token': None,
+            'amount': payment_amount(signups[_id] for _id in ids),
+            'status': 'succeeded',
+            config.DATE_CREATED: now,
+            config.LAST_UPDATED: now,
+        }
+        resolve_document_etag(payment, 'payments')
+        payments.append(payment)
+
+    current_app.data.driver.db['payments'].insert_many(payments)
+
+    # Like Eve after a POST, the hooks mark all signups as paid at once
+    current_app.on_inserted('payments', payments)
+    current_app.on_inserted_payments(payments)
+    return payments
+
+
+@admin_only
+def settlements_endpoint():
+    """Endpoint to settle many payments at once."""
+    data = request.get_json(silent=True)
+    settlements = _parse(data.get('settlements')
+                         if isinstance(data, dict) else None)
+
+    signups = load_signups(settlements)
+    issues = find_issues(settlements, signups)
+    if issues:
+        return send_response(None, ({
+            config.STATUS: config.STATUS_ERR,
+            config.ISSUES: issues,
+            config.ERROR: {
+                'code': config.VALIDATION_ERROR_STATUS,
+                'message': "Settlement failure: %d settlement(s) contain(s) "
+                           "error(s)" % len(issues),
+            },
+        }, None, None, config.VALIDATION_ERROR_STATUS))
+
+    payments = settle(settlements, signups)
+    return send_response(None, ({
+        config.STATUS: config.STATUS_OK,
+        config.ITEMS: payments,
+    }, None, None, 201))
@@ -9,34 +9,25 @@ to be implemented.
 TODO: Send notification mails
 """
 
-import json
-from functools import wraps
-from itertools import chain
+from copy import deepcopy
+from datetime import datetime
 
 from bson import ObjectId
+from pymongo import UpdateOne
 from flask import current_app, abort
-from eve.methods.patch import patch_internal
+from eve.methods.common import resolve_document_etag
 
 
-def wrap_response(function):
-    """Wrapper to modify payload for successful requests (status 2xx)."""
-    @wraps(function)
-    def _wrapped(_, response):
-        if response.status_code // 100 == 2:
-            payload = json.loads(response.get_data(as_text=True))
-
-            if '_items' in payload:
-                function(payload['_items'])
-            else:
-                function([payload])
-
-            response.set_data(json.dumps(payload))
-    return _wrapped
+def new_signups(signups):
+    """Try to reserve a spot for every new signup.
 
+    `on_inserted_signups` hook: The signups are already stored, but the
+    response has not been rendered yet. The response contains the same
+    documents, so we only need to update their status.
 
-@wrap_response
-def new_signups(signups):
-    """Update the status for all signups to a course."""
+    If a course has free spots, its waiting list is empty, so new signups
+    can directly take a spot without looking at other signups.
+    """
     def get_id(course):
         """Return the course id, necessary to cope with embedding.
 
@@ -45,39 +36,46 @@ def new_signups(signups):
         """
         return course['_id'] if isinstance(course, dict) else course
 
-    # Remove duplicates by using a set
-    courses = set(get_id(item['course']) for item in signups)
-    # Re-format signups into a dict so we can update them easier later
-    signups_by_id = {str(item['_id']): item for item in signups}
+    reserved = [item for item in signups
+                if claim_spots(get_id(item['course']))]
 
-    modified = chain.from_iterable(update_signups(course)
-                                   for course in courses)
+    if reserved:
+        current_app.data.driver.db['signups'].update_many(
+            {'_id': {'$in': [item['_id'] for item in reserved]}},
+            {'$set': {'status': 'reserved'}})
 
-    for _id in modified:
-        # Update response payload if needed
-        try:
-            signups_by_id[_id]['status'] = 'reserved'
-        except AttributeError:
-            pass  # Not in response, nothing to do
+        # Update response payload
+        for item in reserved:
+            item['status'] = 'reserved'
 
 
 def deleted_signup(signup):
-    """Update status of course the signup belonged to."""
-    update_signups(signup['course'])
+    """Free the spot of the signup and update the waiting list."""
+    if signup.get('status') != 'waiting':
+        release_spots(signup['course'])
+    update_waiting_lists([signup['course']])
 
 
 def patched_signup(update, original):
-    """Update status of all signups of the original and new course."""
+    """Update the waiting lists if the course is changed.
+
+    A signup with a spot keeps its status (a paid signup stays paid) and
+    takes a spot in the new course, even if the course is already full.
+    """
     # Only need to do something if course is changed
     if 'course' in update:
-        update_signups(update['course'])
-        update_signups(original['course'])
+        if original.get('status') != 'waiting':
+            if not claim_spots(update['course']):
+                overbook_spots(update['course'])
+            release_spots(original['course'])
+
+        update_waiting_lists([update['course'], original['course']])
 
 
 def patched_course(update, original):
     """If the number of spots changed, update signups of course."""
     if 'spots' in update:
-        update_signups(original['_id'])
+        update_waiting_lists([original['_id']])
 
 
 def block_course_deletion(course):
@@ -90,77 +88,283 @@ def block_course_deletion(course):
         abort(409, "Course cannot be deleted as long as it has signups.")
 
 
+# Spot counters
+
+# Every course keeps track of the number of its signups which are not on the
+# waiting list in the field `taken`. It is not part of the schema, so it is
+# neither visible nor writable through the API.
+# All changes are atomic and conditional, so concurrent requests can never
+# reserve more spots than available.
+# Courses without counter (e.g. created before the counters existed) are
+# counted when the app starts.
+
+def _taken():
+    """Number of taken spots, courses without counter have no signups."""
+    return {'$ifNull': ['$taken', 0]}
+
+
+def claim_spots(course_id, number=1):
+    """Take spots of a course if enough are free. Return True on success."""
+    result = current_app.data.driver.db['courses'].update_one({
+        '_id': ObjectId(course_id),
+        '$expr': {'$lte': [{'$add': [_taken(), number]}, '$spots']},
+    }, {
+        '$inc': {'taken': number},
+    })
+    return result.modified_count == 1
+
+
+def overbook_spots(course_id, number=1):
+    """Take spots of a course, even if there are not enough free spots."""
+    current_app.data.driver.db['courses'].update_one(
+        {'_id': ObjectId(course_id)}, {'$inc': {'taken': number}})
+
+
+def release_spots(course_id, number=1):
+    """Free taken spots of a course (never below zero)."""
+    if number > 0:
+        current_app.data.driver.db['courses'].update_one({
+            '_id': ObjectId(course_id),
+            'taken': {'$gte': number},
+        }, {
+            '$inc': {'taken': -number},
+        })
+
+
+def recount_spots(course_ids=None):
+    """Recompute the spot counters from the signups.
+
+    If no course ids are given, all courses are updated.
+    Return dict with course ids and counts of all modified counters.
+    """
+    database = current_app.data.driver.db
+    course_filter = {} if course_ids is None else \
+        {'_id': {'$in': [ObjectId(_id) for _id in course_ids]}}
+
+    signup_filter = {'status': {'$ne': 'waiting'}}
+    if course_ids is not None:
+        signup_filter['course'] = course_filter['_id']
+
+    counts = {item['_id']: item['count'] for item in
+              database['signups'].aggregate([
+                  {'$match': signup_filter},
+                  {'$group': {'_id': '$course', 'count': {'$sum': 1}}},
+              ])}
+
+    modified = {}
+    for course in database['courses'].find(course_filter, ['taken']):
+        count = counts.get(course['_id'], 0)
+        if course.get('taken') != count:
+            modified[course['_id']] = count
+
+    if modified:
+        database['courses'].bulk_write([
+            UpdateOne({'_id': _id}, {'$set': {'taken': count}})
+            for _id, count in modified.items()
+        ])
+
+    return modified
+
+
+def init_spot_counters(app):
+    """Count the taken spots of all courses without counter."""
+    with app.app_context():
+        course_ids = app.data.driver.db['courses'].distinct(
+            '_id', {'taken': {'$exists': False}})
+        if course_ids:
+            recount_spots(course_ids)
+
+
 def update_signups(course_id):
-    """Update waiting list for a course.
+    """Update waiting list for a single course.
 
     The course id can be given as string or ObjectId.
 
-    We can assume that the course exists, otherwise Eve stops earlier.
-
     Return list of ids of all reserved signups.
     """
-    course_id = ObjectId(course_id)  # Ensure we are working with ObjectId
+    return update_waiting_lists([course_id])
 
-    # Determine how many spots the course has
-    total_spots = (current_app.data.driver.db['courses']
-                   .find_one({'_id': course_id}, projection={'spots': 1})
-                   .get('spots', 0))
 
-    # Next, count current signups not on waiting list
-    signups = current_app.data.driver.db['signups']
-    taken_spots = signups.count({'course': course_id,
-                                 'status': {'$ne': 'waiting'}})
+def update_waiting_lists(course_ids):
+    """Update the waiting lists of several courses at once.
+
+    The course ids can be given as string or ObjectId.
 
-    available_spots = total_spots - taken_spots
+    We can assume that the courses exist, otherwise Eve stops earlier.
 
-    if available_spots <= 0:
+    Regardless of the number of courses, this needs:
+    1. One aggregation to find the signups to reserve for all courses
+    2. One bulk write to take the spots of all courses
+    3. One update to reserve all chosen signups
+
+    Spots are only taken if the counter has not changed since the
+    aggregation. Courses changed by concurrent requests in the meantime
+    are updated one by one afterwards (this requires one more query).
+
+    Return list of ids of all reserved signups.
+    """
+    course_ids = list(set(ObjectId(_id) for _id in course_ids))
+    if not course_ids:
         return []
 
-    # Finally, get as many signups on the waiting list as spots available
-    # sort by _updated, use nethz as tie breaker
-    chosen_signups = signups.find({'course': course_id,
-                                   'status': 'waiting'},
-                                  projection=['_id'],
-                                  sort=[('_updated', 1), ('nethz', 1)],
-                                  limit=available_spots)
+    database = current_app.data.driver.db
+
+    promotions = list(database['signups'].aggregate([
+        {'$match': {'course': {'$in': course_ids}, 'status': 'waiting'}},
+        # sort by _updated, use nethz as tie breaker (matches the index)
+        {'$sort': {'course': 1, 'status': 1, '_updated': 1, 'nethz': 1}},
+        {'$group': {'_id': '$course', 'waiting': {'$push': '$_id'}}},
+        {'$lookup': {'from': 'courses', 'localField': '_id',
+                     'foreignField': '_id', 'as': 'course'}},
+        {'$unwind': '$course'},
+        {'$project': {'waiting': 1,
+                      'taken': {'$ifNull': ['$course.taken', 0]},
+                      'free': {'$subtract': [
+                          '$course.spots',
+                          {'$ifNull': ['$course.taken', 0]}]}}},
+        {'$match': {'free': {'$gt': 0}}},
+        {'$project': {'taken': 1,
+                      'chosen': {'$slice': ['$waiting', '$free']}}},
+    ]))
+
+    if not promotions:
+        return []
 
-    signup_ids = [item['_id'] for item in chosen_signups]
+    # Take spots, but only if nobody else has changed the counter.
+    # Every update marks the course with a unique claim id, such that we
+    # can find out afterwards which updates succeeded.
+    claim = ObjectId()
+    result = database['courses'].bulk_write([
+        UpdateOne({
+            '_id': item['_id'],
+            '$expr': {'$eq': [_taken(), item['taken']]},
+        }, {
+            '$inc': {'taken': len(item['chosen'])},
+            '$set': {'_claim': claim},
+        }) for item in promotions
+    ], ordered=False)
+
+    conflicts = []
+    if result.modified_count < len(promotions):
+        claimed = set(course['_id'] for course in database['courses'].find(
+            {'_id': {'$in': [item['_id'] for item in promotions]},
+             '_claim': claim},
+            ['_id']))
+        conflicts = [item['_id'] for item in promotions
+                     if item['_id'] not in claimed]
+        promotions = [item for item in promotions
+                      if item['_id'] in claimed]
+
+    signup_ids = [_id for item in promotions for _id in item['chosen']]
+    if signup_ids:
+        result = database['signups'].update_many(
+            {'_id': {'$in': signup_ids}, 'status': 'waiting'},
+            {'$set': {'status': 'reserved'}})
+        if result.modified_count < len(signup_ids):
+            # Some signups were reserved by a concurrent request in the
+            # meantime, the spots were counted twice
+            recount_spots([item['_id'] for item in promotions])
+
+    reserved = [str(_id) for _id in signup_ids]
+    for course_id in conflicts:
+        reserved.extend(_update_waiting_list(course_id))
+    return reserved
+
+
+def _update_waiting_list(course_id):
+    """Update the waiting list of a single course.
+
+    Retries until the spots could be taken without conflict.
+    """
+    signups = current_app.data.driver.db['signups']
 
-    signups.update_many({'_id': {'$in': signup_ids}},
-                        {'$set': {'status': 'reserved'}})
+    while True:
+        # Determine how many spots are available
+        course = current_app.data.driver.db['courses'].find_one(
+            {'_id': course_id}, projection={'spots': 1, 'taken': 1})
+        available_spots = course.get('spots', 0) - course.get('taken', 0)
+
+        if available_spots <= 0:
+            return []
+
+        # Get as many signups on the waiting list as spots available
+        # sort by _updated, use nethz as tie breaker
+        chosen_signups = signups.find({'course': course_id,
+                                       'status': 'waiting'},
+                                      projection=['_id'],
+                                      sort=[('_updated', 1), ('nethz', 1)],
+                                      limit=available_spots)
+        signup_ids = [item['_id'] for item in chosen_signups]
+
+        if not signup_ids:
+            return []
+
+        # If this fails, another request has taken spots in the meantime
+        if claim_spots(course_id, len(signup_ids)):
+            break
+
+    # Signups may have been reserved by another request in the meantime,
+    # so we only update those still waiting and free the remaining spots
+    result = signups.update_many({'_id': {'$in': signup_ids},
+                                  'status': 'waiting'},
+                                 {'$set': {'status': 'reserved'}})
+    release_spots(course_id, len(signup_ids) - result.modified_count)
 
     return [str(item) for item in signup_ids]
 
 
-def mark_as_paid(payments):
-    """After successful payment, set status to `accepted`."""
+def _signup_ids(payments):
+    """Return the ids of all signups of one or several payments."""
     # Check if payments is not a list
     if not isinstance(payments, list):
         payments = [payments]
 
-    for payment in payments:
+    return [ObjectId(signup) for payment in payments
+            for signup in payment['signups']]
+
 
-        for signup in payment['signups']:
-            data = {'status': 'accepted'}
-            patch_internal('signups',
-                           _id=str(signup),
-                           payload=data,
-                           concurrency_check=False,
-                           skip_validation=True)
+def mark_as_paid(payments):
+    """After successful payment, set status to `accepted`."""
+    set_status(_signup_ids(payments), 'accepted')
 
 
 def mark_as_unpaid(payments):
     """Before a payment is deleted, set status to `reserved`."""
-    # Check if payments is not a list
-    if not isinstance(payments, list):
-        payments = [payments]
+    set_status(_signup_ids(payments), 'reserved')
+
+
+def set_status(signup_ids, status):
+    """Change the status of many signups with a single bulk write.
+
+    Works like a PATCH of every signup without validation and concurrency
+    check: `_updated` and `_etag` are updated and the `on_update` and
+    `on_updated` hooks are called for every signup. But the whole batch
+    only needs one query and one write.
+    """
+    signups = current_app.data.driver.db['signups']
+    now = datetime.utcnow().replace(microsecond=0)  # Same precision as Eve
+
+    changes = []
+    for original in signups.find({'_id': {'$in': list(signup_ids)}}):
+        updates = {'status': status, '_updated': now}
+        current_app.on_update('signups', updates, original)
+        current_app.on_update_signups(updates, original)
+
+        updated = deepcopy(original)
+        updated.update(updates)
+        resolve_document_etag(updated, 'signups')
+        updates['_etag'] = updated['_etag']
+
+        changes.append((updates, original))
+
+    if not changes:
+        return
 
-    for payment in payments:
+    signups.bulk_write([UpdateOne({'_id': original['_id']},
+                                  {'$set': updates})
+                        for (updates, original) in changes],
+                       ordered=False)
 
-        for signup in payment['signups']:
-            data = {'status': 'reserved'}
-            patch_internal('signups',
-                           _id=str(signup),
-                           payload=data,
-                           concurrency_check=False,
-                           skip_validation=True)
+    for (updates, original) in changes:
+        current_app.on_updated('signups', updates, original)
+        current_app.on_updated_signups(updates, original)
@@ -0,0 +1,33 @@
+"""Runtime Statistics.
+
+Admins can check how well the caches and connection pools work, e.g.
+during signup opening, without having to attach a profiler to the server.
+"""
+
+from flask import current_app
+from eve.render import send_response
+
+from backend.security import admin_only, pool_stats
+
+
+@admin_only
+def stats():
+    """Endpoint to return cache and connection pool statistics.
+
+    Every cache hit is a request to AMIVAPI that was not necessary.
+    """
+    data = {
+        'user_cache': current_app.user_cache.stats(),
+        'rejected_tokens': current_app.rejected_tokens.stats(),
+        'amivapi_lookups': current_app.amivapi_lookups.stats(),
+        'amivapi_pool': pool_stats(current_app.amivapi),
+        'amivapi_breaker': current_app.amivapi_breaker.stats(),
+        'revalidating': len(current_app.revalidating),
+        'catalog_cache': current_app.catalog_cache.stats(),
+        'schedule_cache': current_app.schedule_cache.stats(),
+        'planning_cache': current_app.planning_cache.stats(),
+        'pricing_cache': current_app.pricing_cache.stats(),
+        'charge_workers': current_app.charge_workers.stats(),
+        'stripe_calls': current_app.stripe_calls.stats(),
+    }
+    return send_response(None, (data,))
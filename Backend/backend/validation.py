@@ -9,14 +9,77 @@ TODO: Several validation rules still need to be implemented. See `settings.py`.
 
 """
 
-from itertools import combinations, chain
+from itertools import chain
 
-from flask import request, current_app
+from bson import ObjectId
+from flask import g, request, current_app
 from eve.io.mongo import Validator
 
+from backend.intervals import find_overlap, describe, to_interval
+from backend.occupancy import find_booking_conflict
+from backend.schedules import course_times, get_schedule
 from backend.security import is_admin, get_user
 
 
+def _payload_ids(data):
+    """Return all valid ObjectIds contained anywhere in the request data."""
+    if isinstance(data, dict):
+        data = data.values()
+    elif not isinstance(data, list):
+        return {ObjectId(data)} if ObjectId.is_valid(data) else set()
+    return set().union(*(_payload_ids(item) for item in data))
+
+
+def get_documents(resource, ids):
+    """Return a dict mapping the ids to documents of resource (or None).
+
+    Documents are kept for the rest of the request, so that validation rules
+    and hooks looking at the same documents do not query them again.
+    """
+    documents = g.setdefault('documents', {}).setdefault(resource, {})
+    missing = [_id for _id in ids if _id not in documents]
+    if missing:
+        collection = current_app.data.driver.db[resource]
+        documents.update(dict.fromkeys(missing))
+        for document in collection.find({'_id': {'$in': missing}}):
+            documents[document['_id']] = document
+    return {_id: documents[_id] for _id in ids}
+
+
+def get_document(resource, _id):
+    """Get a document, prefetching everything the request refers to.
+
+    Every id in the payload (e.g. all signups of a payment) is loaded with
+    the first lookup, using a single query per resource.
+    """
+    if _id not in g.get('documents', {}).get(resource, {}):
+        ids = _payload_ids(request.get_json(silent=True))
+        get_documents(resource, ids | {_id})
+    return get_documents(resource, [_id])[_id]
+
+
+def clear_documents(_=None):
+    """Forget all documents loaded during the request (teardown)."""
+    g.pop('documents', None)
+
+
+def unique_index(resource, fields):
+    """Return the name of a unique index on exactly these fields, if any."""
+    for (name, index) in current_app.config['DOMAIN'][resource][
+            'mongo_indexes'].items():
+        (keys, options) = index if isinstance(index, tuple) else (index, {})
+        if (options.get('unique') and
+                {key for (key, _) in keys} == set(fields)):
+            return name
+    return None
+
+
+def combination_error(unique_combination):
+    """Error message if a unique combination already exists."""
+    return ("value already exists in the database in combination with "
+            "values for: %s" % unique_combination)
+
+
 class APIValidator(Validator):
     """Provide a rule to check nethz of current user."""
 
@@ -49,18 +112,24 @@ class APIValidator(Validator):
     def _validate_unique_combination(self, unique_combination, field, value):
         """Validate that a combination of fields is unique.
 
+        If a unique index exists for the combination, new documents are not
+        checked here, the database rejects duplicates without an additional
+        query and without races (see `data.py`).
+
         Code is copy-pasted from amivapi, see there for more explanation.
         https://github.com/amiv-eth/amivapi/blob/master/amivapi/utils.py
         """
+        resource = self.resource
+        if (request.method == 'POST' and
+                unique_index(resource, [field] + unique_combination)):
+            return
+
         lookup = {field: value}  # self
         for other_field in unique_combination:
             lookup[other_field] = self._get_field(other_field)
 
-        resource = self.resource
         if current_app.data.find_one(resource, None, **lookup) is not None:
-            self._error(field, "value already exists in the database in " +
-                        "combination with values for: %s" %
-                        unique_combination)
+            self._error(field, combination_error(unique_combination))
 
     def _validate_not_patchable(self, enabled, field, _):
         """Inhibit patching of the field, also copied from AMIVAPI."""
@@ -72,20 +141,42 @@ class APIValidator(Validator):
         if only_admin_empty and not value and not is_admin():
             self._error(field, "only admins may leave this field empty")
 
+    def _validate_data_relation(self, data_relation, field, value):
+        """Check that referenced documents exist, using the prefetch."""
+        if data_relation.get('version') or data_relation['field'] != '_id':
+            super(APIValidator, self)._validate_data_relation(
+                data_relation, field, value)
+            return
+
+        resource = data_relation['resource']
+        for item in value if isinstance(value, list) else [value]:
+            if get_document(resource, item) is None:
+                self._error(field, "value '%s' must exist in resource "
+                                   "'%s', field '_id'." % (item, resource))
+
     def _validate_no_waiting(self, no_waiting, field, value):
         """Disallow signups which are on waiting list status."""
-        signup = current_app.data.driver.db['signups'].find_one({'_id': value})
-        if no_waiting and signup['status'] == 'waiting':
+        signup = get_document('signups', value)
+        if no_waiting and signup and signup['status'] == 'waiting':
             self._error(field, "this field may not contain signups " +
                         "which are still on the waiting list")
 
     def _validate_no_accepted(self, no_accepted, field, value):
         """Disallow signups that have already been paid."""
-        signup = current_app.data.driver.db['signups'].find_one({'_id': value})
-        if no_accepted and signup['status'] == 'accepted':
+        signup = get_document('signups', value)
+        if no_accepted and signup and signup['status'] == 'accepted':
             self._error(field, "this field may not contain signups " +
                         "which have already been paid")
 
+    def _validate_no_pending(self, no_pending, field, value):
+        """Disallow signups for which a payment is still in progress."""
+        payments = current_app.data.driver.db['payments']
+        if no_pending and value and payments.find_one(
+                {'signups': {'$in': value},
+                 'status': {'$in': ['pending', 'processing']}}, {'_id': 1}):
+            self._error(field, "this field may not contain signups " +
+                        "with a payment in progress")
+
     def _validate_no_copies(self, no_copies, field, value):
         """Ensure that each item only appears once in the list."""
         if no_copies and len(set(value)) != len(value):
@@ -104,21 +195,15 @@ class APIValidator(Validator):
         room = self._get_field('room')
         timespans = self._get_field('datetimes')
 
-        # Get _id of current course and filter to ignore it
-        course_id = self._get_field('_id')
-        id_filter = {'_id': {'$ne': course_id}} if course_id else {}
-
         if enabled and timespans and room:
-            # Get all other courses with the same room
-            course_db = current_app.data.driver.db['courses']
-            courses = course_db.find({'room': room, **id_filter})
-            # chain all timespan lists into one list of other timespans
-            other_timespans = chain.from_iterable(course['datetimes']
-                                                  for course in courses)
-
-            if has_overlap(*timespans, *other_timespans):
+            # Ignore the current course itself (PATCH)
+            intervals = [to_interval(timespan) for timespan in timespans]
+            conflict = find_booking_conflict('room', room, intervals,
+                                             self._get_field('_id'))
+            if conflict:
                 self._error(field, "the room '%s' is already occupied by "
-                                   "another course at the same time" % value)
+                                   "another course at the same time (%s)"
+                            % (value, _conflict(conflict)))
 
     def _validate_unique_assistant_booking(self, enabled, field, value):
         """An assistant can not hold several courses simultaneously."""
@@ -126,63 +211,48 @@ class APIValidator(Validator):
         assistant = self._get_field('assistant')
         timespans = self._get_field('datetimes')
 
-        course_id = self._get_field('_id')
-        id_filter = {'_id': {'$ne': course_id}} if course_id else {}
-
         if enabled and timespans and assistant:
-            course_db = current_app.data.driver.db['courses']
-            courses = course_db.find({'assistant': assistant, **id_filter})
-            other_timespans = chain.from_iterable(course['datetimes']
-                                                  for course in courses)
-
-            if has_overlap(*timespans, *other_timespans):
+            intervals = [to_interval(timespan) for timespan in timespans]
+            conflict = find_booking_conflict('assistant', assistant,
+                                             intervals, self._get_field('_id'))
+            if conflict:
                 self._error(field, "the assistant '%s' is giving "
-                                   "another course at the same time" % value)
+                                   "another course at the same time (%s)"
+                            % (value, _conflict(conflict)))
 
     def _validate_no_time_overlap(self, enabled, field, value):
         """Multiple timeslots of the same course must not overlap."""
         # value will be a list of timeslots
-        if enabled and has_overlap(*value):
-            self._error(field, "time slots must not overlap")
+        overlap = (find_overlap(to_interval(timespan) for timespan in value)
+                   if enabled else None)
+        if overlap:
+            self._error(field, "time slots must not overlap (%s)"
+                        % _conflict(overlap))
 
     def _validate_no_course_overlap(self, resource, field, value):
-        """Ensure that a user cannot select/sign up for parallel courses."""
+        """Ensure that a user cannot select/sign up for parallel courses.
+
+        The time slots of the user's courses are cached, see `schedules.py`.
+        """
         nethz = self._get_field('nethz')
 
-        # Get timespan of current course
-        course_db = current_app.data.driver.db['courses']
-        timespans = course_db.find_one({'_id': value}).get('datetimes')
+        # Get time spans of current course (as intervals)
+        timespans = course_times(value)
 
         if nethz and timespans:
-            # Find ids from all other courses for this nethz
-            resource_db = current_app.data.driver.db[resource]
-            items = resource_db.find({'nethz': nethz})
-            course_ids = [item['course'] for item in items
-                          if item['course'] != value]
-
-            # Get all courses and extract time spans
-            courses = course_db.find({'_id': {'$in': course_ids}})
-            # chain all timespan lists into one list of other timespans
-            other_timespans = chain.from_iterable(course['datetimes']
-                                                  for course in courses)
-
-            if has_overlap(*timespans, *other_timespans):
+            # Time spans of all other courses for this nethz
+            schedule = get_schedule(resource, nethz)
+            other_timespans = chain.from_iterable(
+                times for (course, times) in schedule.items()
+                if course != value)
+
+            overlap = find_overlap(timespans, other_timespans)
+            if overlap:
                 self._error(field, 'this course has a timing conflict with an '
-                                   'already chosen course')
-
-
-def has_overlap(*timeslots):
-    """Return True if any two timeslots overlap, False otherwise."""
-    def has_one_overlap(first, second):
-        """Compare two timeslots."""
-        # All data is UTC, but some has tzinfo, some doesnt => Normalize
-        s_1 = first['start'].replace(tzinfo=None)
-        e_1 = first['end'].replace(tzinfo=None)
-        s_2 = second['start'].replace(tzinfo=None)
-        e_2 = second['end'].replace(tzinfo=None)
-        # Overlap if one course is "(not before) and (not after)" the other
-        return (e_1 > s_2) and (s_1 < e_2)
-
-    # Return if *any* combination of elements overlaps
-    return any(has_one_overlap(first, second)
-               for (first, second) in combinations(timeslots, 2))
+                                   'already chosen course (%s)'
+                            % _conflict(overlap))
+
+
+def _conflict(overlap):
+    """Describe a pair of overlapping time slots for an error message."""
+    return "%s overlaps with %s" % tuple(describe(slot) for slot in overlap)
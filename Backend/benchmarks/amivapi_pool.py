@@ -0,0 +1,96 @@
+"""Benchmark: AMIVAPI requests with and without connection pool.
+
+A local stub of AMIVAPI is started, which answers session lookups like the
+real API. Then the same lookup is sent repeatedly, once with a new
+connection per request (the old `requests.get`), once with the pooled
+session of the app.
+
+Run from the Backend directory:
+
+> python benchmarks/amivapi_pool.py [NUMBER_OF_REQUESTS]
+
+Note that the stub uses plain HTTP on localhost, so the gain is only the TCP
+handshake. With TLS and a real network, the difference is much larger.
+"""
+
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+from time import perf_counter
+
+import requests
+
+from backend.app import create_app
+from backend.security import api_get, pool_stats
+
+
+SESSION = json.dumps({'_items': [{'user': {
+    '_id': 'userid',
+    'nethz': 'pablo',
+    'membership': 'regular',
+}}]}).encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answer every GET with a session, keep connections alive."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Return the same session for every request."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(SESSION)))
+        self.end_headers()
+        self.wfile.write(SESSION)
+
+    def log_message(self, *_):
+        """Be quiet."""
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Threaded server, such that kept-alive connections don't block."""
+
+    daemon_threads = True
+
+
+def measure(function, number):
+    """Return the average time of a function call in milliseconds."""
+    start = perf_counter()
+    for _ in range(number):
+        function()
+    return (perf_counter() - start) / number * 1000
+
+
+def main():
+    """Start the stub and compare both variants."""
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%s/' % server.server_address[1]
+
+    app = create_app(AMIVAPI_URL=url, ADMIN_GROUP_REFRESH=0)
+    params = {'where': json.dumps({'token': 'token'})}
+
+    def new_connection():
+        requests.get(url + 'sessions', params=params,
+                     headers={'Authorization': 'Token token'})
+
+    def pooled():
+        api_get('sessions', token='token', where={'token': 'token'})
+
+    with app.app_context():
+        print('New connection per request: %.3f ms' %
+              measure(new_connection, number))
+        print('Pooled session:             %.3f ms' %
+              measure(pooled, number))
+        print('Pool statistics:', pool_stats(app.amivapi))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
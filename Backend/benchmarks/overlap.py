@@ -0,0 +1,69 @@
+"""Benchmark: Overlap detection for time slots.
+
+Compares the old check of all pairs of time slots with the sweep over the
+sorted intervals in `backend.intervals`, for a room with many courses that
+already have several time slots each, and a new course for this room.
+
+The intervals are precomputed, like they are stored in the occupancy and
+the cached schedules.
+
+Run from the Backend directory:
+
+> python benchmarks/overlap.py [NUMBER_OF_COURSES]
+"""
+
+import sys
+from datetime import datetime, timedelta
+from itertools import chain, combinations
+from timeit import timeit
+
+sys.path.insert(0, '.')
+
+from backend.intervals import find_overlap, to_interval  # noqa: E402
+
+
+def has_overlap(*timeslots):
+    """Old: Compare all pairs of time slots."""
+    def has_one_overlap(first, second):
+        s_1 = first['start'].replace(tzinfo=None)
+        e_1 = first['end'].replace(tzinfo=None)
+        s_2 = second['start'].replace(tzinfo=None)
+        e_2 = second['end'].replace(tzinfo=None)
+        return (e_1 > s_2) and (s_1 < e_2)
+
+    return any(has_one_overlap(first, second)
+               for (first, second) in combinations(timeslots, 2))
+
+
+def make_courses(number, slots=4):
+    """Courses without any conflicts, every course in its own 2h block."""
+    start = datetime(2018, 6, 1, 8)
+    return [[{'start': start + timedelta(hours=2 * (slot * number + course)),
+              'end': start + timedelta(hours=2 * (slot * number + course) + 2)}
+             for slot in range(slots)]
+            for course in range(number)]
+
+
+def main():
+    """Time both variants for a course that fits (worst case: no overlap)."""
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    repeat = 5
+
+    courses = make_courses(number + 1)
+    new, others = courses[0], list(chain.from_iterable(courses[1:]))
+    new_intervals = [to_interval(slot) for slot in new]
+    other_intervals = [to_interval(slot) for slot in others]
+    assert not has_overlap(*new, *others)
+    assert find_overlap(new_intervals, other_intervals) is None
+
+    old = timeit(lambda: has_overlap(*new, *others), number=repeat) / repeat
+    new_time = timeit(lambda: find_overlap(new_intervals, other_intervals),
+                      number=repeat) / repeat
+
+    print("%d courses, %d time slots" % (number, len(others)))
+    print("pairwise:   %8.2f ms" % (old * 1000))
+    print("sweep line: %8.2f ms" % (new_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
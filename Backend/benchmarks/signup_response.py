@@ -0,0 +1,76 @@
+"""Benchmark: Updating the signup status in the response.
+
+Compares the old approach (parse the rendered response, update the status,
+render again) with updating the documents before they are rendered, using
+a large list of signups like a bulk POST would return.
+
+Run from the Backend directory:
+
+> python benchmarks/signup_response.py [NUMBER_OF_SIGNUPS]
+"""
+
+import json
+import sys
+from timeit import timeit
+
+
+def make_signups(number):
+    """Create signup documents as they would appear in the response."""
+    return [{
+        '_id': '%024x' % index,
+        '_etag': '%040x' % index,
+        '_created': '2018-01-01T10:00:00Z',
+        '_updated': '2018-01-01T10:00:00Z',
+        '_links': {'self': {'title': 'Signup',
+                            'href': 'signups/%024x' % index}},
+        '_status': 'OK',
+        'nethz': 's%d' % index,
+        'course': '%024x' % (index % 50),
+        'status': 'waiting',
+    } for index in range(number)]
+
+
+def reserve(signups):
+    """Reserve every second signup, like the waiting list would."""
+    for signup in signups[::2]:
+        signup['status'] = 'reserved'
+
+
+def decode_and_encode(rendered):
+    """Old: the response is decoded, modified and encoded again."""
+    payload = json.loads(rendered)
+    reserve(payload['_items'])
+    return json.dumps(payload)
+
+
+def update_before_render(signups):
+    """New: documents are modified, then the response is rendered once."""
+    reserve(signups)
+    return json.dumps({'_status': 'OK', '_items': signups})
+
+
+def main():
+    """Time both variants."""
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeat = 20
+
+    def old():
+        # The response is rendered once by Eve in any case
+        rendered = json.dumps({'_status': 'OK',
+                               '_items': make_signups(number)})
+        decode_and_encode(rendered)
+
+    def new():
+        update_before_render(make_signups(number))
+
+    baseline = timeit(lambda: make_signups(number), number=repeat)
+    old_time = (timeit(old, number=repeat) - baseline) / repeat * 1000
+    new_time = (timeit(new, number=repeat) - baseline) / repeat * 1000
+
+    print('%d signups' % number)
+    print('Decode and encode response: %.2f ms' % old_time)
+    print('Update before rendering:    %.2f ms' % new_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,8 +11,13 @@ to allow easier assertion of status_codes and make json handling easier.
 
 import json
 from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import count
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
 
 import pytest
+import stripe
 
 from flask import g
 from flask.testing import FlaskClient
@@ -24,6 +29,8 @@ TEST_SETTINGS = {
     'MONGO_DBNAME': 'pvk_test',
     'MONGO_USERNAME': 'pvk_user',
     'MONGO_PASSWORD': 'pvk_pass',
+    'ADMIN_GROUP_REFRESH': 0,  # no AMIVAPI requests at startup
+    'STRIPE_ASYNC': False,  # charge during the request
 }
 
 
@@ -127,9 +134,13 @@ def admin(self, **kwargs):
 
 
 @pytest.fixture
-def app():
-    """Create app, instantiate test client, drop DB after use."""
-    application = create_app(**TEST_SETTINGS)
+def app(request):
+    """Create app, instantiate test client, drop DB after use.
+
+    Additional settings can be passed with indirect parametrization.
+    """
+    settings = dict(TEST_SETTINGS, **getattr(request, 'param', {}))
+    application = create_app(**settings)
     application.test_client_class = TestClient
     application.client = application.test_client()
 
@@ -139,3 +150,130 @@ def app():
 
     yield application
     drop_database(application)
+
+
+class StripeStub(BaseHTTPRequestHandler):
+    """Answers charge requests like the Stripe test API.
+
+    'tok_chargeDeclined' is declined, every other token succeeds. Requests
+    with a known idempotency key get the same response as the first time.
+    Charges can be listed, at most `page_size` per page.
+    """
+
+    charges = []  # All charges that have been made
+    responses = {}  # Responses by idempotency key
+    ids = count()
+    page_size = 2
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Create a charge."""
+        length = int(self.headers['Content-Length'])
+        params = {key: values[0] for (key, values) in
+                  parse_qs(self.rfile.read(length).decode()).items()}
+
+        key = self.headers.get('Idempotency-Key')
+        if key not in self.responses:
+            if params['source'] == 'tok_chargeDeclined':
+                self.responses[key] = (402, {'error': {
+                    'type': 'card_error',
+                    'code': 'card_declined',
+                    'message': 'Your card was declined.',
+                }})
+            else:
+                charge = {
+                    'id': 'ch_%d' % next(self.ids),
+                    'object': 'charge',
+                    'amount': int(params['amount']),
+                    'currency': params['currency'],
+                    'metadata': {name[len('metadata['):-1]: value
+                                 for (name, value) in params.items()
+                                 if name.startswith('metadata[')},
+                    'paid': True,
+                    'refunded': False,
+                    'status': 'succeeded',
+                }
+                self.charges.append(charge)
+                self.responses[key] = (200, charge)
+
+        self._respond(*self.responses[key])
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """List charges, newest first."""
+        params = {key: values[0] for (key, values) in
+                  parse_qs(urlparse(self.path).query).items()}
+        charges = self.charges[::-1]
+        if 'starting_after' in params:
+            ids = [charge['id'] for charge in charges]
+            charges = charges[ids.index(params['starting_after']) + 1:]
+        limit = min(int(params.get('limit', 10)), self.page_size)
+
+        self._respond(200, {
+            'object': 'list',
+            'url': '/v1/charges',
+            'data': charges[:limit],
+            'has_more': len(charges) > limit,
+        })
+
+    def _respond(self, status, response):
+        """Send the response as JSON."""
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        """Keep the test output clean."""
+
+
+@pytest.fixture
+def stripe_stub(app):  # pylint: disable=redefined-outer-name,unused-argument
+    """Start a local Stripe stub, return the list of charges made.
+
+    Requires the app, since creating the app configures Stripe.
+    """
+    StripeStub.charges = []
+    StripeStub.responses = {}
+    server = HTTPServer(('127.0.0.1', 0), StripeStub)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    original = stripe.api_base
+    stripe.api_base = 'http://127.0.0.1:%d' % server.server_port
+    yield StripeStub.charges
+    stripe.api_base = original
+    server.shutdown()
+
+
+@pytest.fixture
+def course(app):  # pylint: disable=redefined-outer-name
+    """Create a course, return its id."""
+    with app.admin():
+        return str(app.data.driver.db['courses'].insert({'spots': 10}))
+
+
+@pytest.fixture
+def lecture_course(app):  # pylint: disable=redefined-outer-name
+    """Create a lecture with a course, return the course."""
+    with app.admin():
+        lecture = app.client.post('lectures', data={
+            'title': 'Awesome Lecture',
+            'department': 'itet',
+            'year': 3,
+        }, assert_status=201)
+        return app.client.post('courses', data={
+            'lecture': lecture['_id'],
+            'room': 'ETZ F 6',
+            'spots': 20,
+            'signup': {
+                'start': '2021-05-01T10:00:00Z',
+                'end': '2021-05-05T23:59:59Z',
+            },
+            'datetimes': [{
+                'start': '2021-06-05T10:00:00Z',
+                'end': '2021-06-05T12:00:00Z',
+            }, {
+                'start': '2021-06-06T10:00:00Z',
+                'end': '2021-06-06T12:00:00Z',
+            }],
+        }, assert_status=201)
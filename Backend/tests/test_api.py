@@ -17,9 +17,15 @@ for their in- and outputs.
 So we just put the provided token into g and see if the functions work.
 """
 
+from threading import Event, Thread
+from unittest.mock import patch
+
+import pytest
+import requests
 from flask import g
+from werkzeug.exceptions import ServiceUnavailable
 
-from backend.security import get_user, is_admin
+from backend.security import get_user, is_admin, api_get, APIUnavailable
 
 
 def test_user_found(app, usertoken):
@@ -56,3 +62,185 @@ def test_admin(app, admintoken):
     with app.app_context():
         g.token = admintoken
         assert is_admin() is True
+
+
+# Cache tests, AMIVAPI is mocked, so no tokens are required
+
+USER = {'_id': 'userid', 'nethz': 'pablo', 'membership': 'regular'}
+SESSION_RESPONSE = {'_items': [{'user': USER}]}
+GROUP_RESPONSE = {'_items': [{'_id': 'groupid'}]}
+MEMBERSHIP_RESPONSE = {'_items': [{'_id': 'membershipid'}]}
+
+
+def _request(app, token):
+    """Simulate a new request, i.e. clear g."""
+    with app.test_request_context():
+        g.token = token
+        return get_user(), is_admin()
+
+
+def test_user_cached(app):
+    """The user is only requested once from AMIVAPI for the same token."""
+    responses = [SESSION_RESPONSE, GROUP_RESPONSE, MEMBERSHIP_RESPONSE]
+    with patch('backend.security.api_get', side_effect=responses) as api:
+        assert _request(app, 'token') == (USER, True)
+        assert _request(app, 'token') == (USER, True)
+
+    assert api.call_count == 3
+    assert app.user_cache.hits > 0
+
+
+def test_invalid_token_cached(app):
+    """Invalid tokens are evicted and remembered as rejected."""
+    app.user_cache.set('token', {'user': USER})
+    app.user_cache.pop('token')  # e.g. expired
+
+    with patch('backend.security.api_get', return_value=None) as api:
+        assert _request(app, 'token') == (None, False)
+        assert _request(app, 'token') == (None, False)
+
+    assert api.call_count == 1
+    assert app.user_cache.get('token') is None
+    assert app.rejected_tokens.hits == 1
+
+
+def test_unavailable_api_not_cached(app):
+    """If AMIVAPI is unavailable, the token is not rejected permanently."""
+    with patch('backend.security.api_get', side_effect=APIUnavailable):
+        with pytest.raises(ServiceUnavailable):
+            _request(app, 'token')
+
+    with patch('backend.security.api_get',
+               side_effect=[SESSION_RESPONSE, APIUnavailable]):
+        assert _request(app, 'token') == (USER, False)
+
+    assert app.rejected_tokens.get('token') is None
+    assert 'admin' not in app.user_cache.get('token')
+
+
+def test_logout_evicts_token(app):
+    """After logout, the token is checked with AMIVAPI again."""
+    app.user_cache.set('token', {'user': USER, 'admin': False})
+
+    app.client.post('/logout',
+                    headers={'Authorization': 'Token token'},
+                    assert_status=204)
+
+    assert app.user_cache.get('token') is None
+
+
+def test_admin_group_resolved_once(app):
+    """With a known admin group, only the membership is requested."""
+    app.admin_group_id = 'groupid'
+    responses = [SESSION_RESPONSE, MEMBERSHIP_RESPONSE]
+    with patch('backend.security.api_get', side_effect=responses) as api:
+        assert _request(app, 'token') == (USER, True)
+
+    assert api.call_count == 2
+
+
+def test_admin_group_lookup_fails(app):
+    """If the admin group can't be found, nobody is admin."""
+    responses = [SESSION_RESPONSE, None]
+    with patch('backend.security.api_get', side_effect=responses):
+        assert _request(app, 'token') == (USER, False)
+    assert app.admin_group_id is None
+
+
+@pytest.mark.parametrize('app', [{'ADMIN_GROUP_REFRESH': 3600}],
+                         indirect=True)
+def test_admin_group_in_background(app):
+    """Creating the app does not resolve the group, the first request does."""
+    assert app.admin_group_id is None
+    with patch('backend.security._start_admin_group_refresh') as start:
+        app.client.get('/stats')
+        app.client.get('/stats')
+    start.assert_called_once_with(app)
+
+
+def test_session_is_reused(app):
+    """Requests use the session of the app with a timeout."""
+    with patch.object(app.amivapi, 'get') as get, app.app_context():
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = SESSION_RESPONSE
+
+        assert api_get('sessions', token='token') == SESSION_RESPONSE
+
+    assert get.call_args[1]['timeout'] == app.config['AMIVAPI_TIMEOUT']
+
+
+def test_timeout(app):
+    """If AMIVAPI does not respond in time, it's unavailable."""
+    with patch.object(app.amivapi, 'get', side_effect=requests.Timeout), \
+            app.app_context():
+        with pytest.raises(APIUnavailable):
+            api_get('sessions', token='token')
+
+
+def test_stats_admin_only(app):
+    """Only admins can see the statistics."""
+    app.client.get('/stats', assert_status=401)
+
+    with app.user():
+        app.client.get('/stats', assert_status=403)
+
+    with app.admin():
+        response = app.client.get('/stats', assert_status=200)
+        assert 'hits' in response['user_cache']
+
+
+def test_parallel_lookups_coalesced(app):
+    """Parallel requests with the same token only send one request."""
+    release = Event()
+
+    def _slow_api(*_, **__):
+        release.wait()
+        return SESSION_RESPONSE
+
+    results = []
+
+    def _parallel_request():
+        with app.test_request_context():
+            g.token = 'token'
+            results.append(get_user())
+
+    with patch('backend.security.api_get', side_effect=_slow_api) as api:
+        threads = [Thread(target=_parallel_request) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while app.amivapi_lookups.shared < 2:
+            pass  # Wait until all requests are waiting for the first
+        release.set()
+        for thread in threads:
+            thread.join()
+
+    assert api.call_count == 1
+    assert results == [USER] * 3
+
+
+def test_circuit_breaker(app):
+    """After too many failures, no requests are sent for some time."""
+    threshold = app.config['AMIVAPI_BREAKER_THRESHOLD']
+    with patch.object(app.amivapi, 'get', side_effect=requests.Timeout) \
+            as get, app.app_context():
+        for _ in range(threshold + 3):
+            with pytest.raises(APIUnavailable):
+                api_get('sessions', token='token')
+
+    assert get.call_count == threshold
+    assert app.amivapi_breaker.stats()['state'] == 'open'
+    assert app.amivapi_breaker.stats()['rejected'] == 3
+
+
+def test_stale_user_if_unavailable(app):
+    """Known users can continue if AMIVAPI is unavailable."""
+    with patch('backend.cache.monotonic', return_value=0):
+        app.user_cache.set('token', {'user': USER, 'admin': True})
+
+    expired = app.config['AMIVAPI_CACHE_TTL'] + 1
+    with patch('backend.cache.monotonic', return_value=expired), \
+            patch('backend.security.api_get', side_effect=APIUnavailable), \
+            patch('backend.security.revalidate_later') as revalidate:
+        assert _request(app, 'token') == (USER, True)
+
+    revalidate.assert_called_once_with(app, 'token')
@@ -0,0 +1,163 @@
+"""Tests for the in-process caches."""
+
+from threading import Event, Thread
+from unittest.mock import patch
+
+import pytest
+
+from backend.cache import TTLCache, LoaderCache, SingleFlight
+
+
+def test_get_and_set():
+    """Values can be retrieved, hits and misses are counted."""
+    cache = TTLCache(ttl=60, maxsize=10)
+    assert cache.get('key') is None
+    assert cache.get('key', 'default') == 'default'
+
+    cache.set('key', 'value')
+    assert cache.get('key') == 'value'
+
+    assert cache.hits == 1
+    assert cache.misses == 2
+
+
+def test_expiry():
+    """Entries are removed after their lifetime."""
+    cache = TTLCache(ttl=60, maxsize=10)
+    with patch('backend.cache.monotonic', return_value=0):
+        cache.set('key', 'value')
+    with patch('backend.cache.monotonic', return_value=59):
+        assert cache.get('key') == 'value'
+    with patch('backend.cache.monotonic', return_value=60):
+        assert cache.get('key') is None
+    assert len(cache) == 0
+
+
+def test_stale():
+    """Expired entries can still be retrieved explicitly for a while."""
+    cache = TTLCache(ttl=60, maxsize=10, stale=30)
+    with patch('backend.cache.monotonic', return_value=0):
+        cache.set('key', 'value')
+    with patch('backend.cache.monotonic', return_value=70):
+        assert cache.get('key') is None
+        assert cache.get_stale('key') == 'value'
+    with patch('backend.cache.monotonic', return_value=90):
+        assert cache.get_stale('key') is None
+    assert cache.stale_hits == 1
+    assert len(cache) == 0
+
+
+def test_lru_entry_removed():
+    """If the cache is full, the least recently used entry is removed."""
+    cache = TTLCache(ttl=60, maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')  # Now b is the least recently used
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_pop_and_clear():
+    """Entries can be removed explicitly."""
+    cache = TTLCache(ttl=60, maxsize=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    cache.pop('a')
+    cache.pop('not there')
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_loader_cache():
+    """Values are loaded once, unless the cache changes while loading."""
+    cache = LoaderCache(ttl=60, maxsize=10)
+    assert cache.get_or_load('key', lambda: 'value') == 'value'
+    assert cache.get_or_load('key', lambda: 'other') == 'value'
+
+    def _load():
+        cache.clear()  # e.g. a course has been modified in the meantime
+        return 'outdated'
+
+    assert cache.get_or_load('other', _load) == 'outdated'
+    assert cache.get('other') is None
+
+
+def _parallel(flight, key, function, number):
+    """Start several threads calling the same key, return result list."""
+    results = []
+
+    def _call():
+        try:
+            results.append(flight.call(key, function))
+        except ValueError as error:
+            results.append(error)
+
+    threads = [Thread(target=_call) for _ in range(number)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def _wait_for_waiters(flight, number):
+    """Block until the given number of calls are waiting."""
+    while flight.shared < number:
+        pass
+
+
+def test_flight_shares_result():
+    """Concurrent calls with the same key only call the function once."""
+    flight = SingleFlight()
+    release = Event()
+    calls = []
+
+    def _slow():
+        calls.append(1)
+        release.wait()
+        return 'result'
+
+    threads, results = _parallel(flight, 'key', _slow, 5)
+    _wait_for_waiters(flight, 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+    assert results == ['result'] * 5
+    assert flight.stats() == {'running': 0, 'calls': 1, 'shared': 4}
+
+
+def test_flight_shares_error():
+    """If the call fails, all waiting callers get the exception."""
+    flight = SingleFlight()
+    release = Event()
+    error = ValueError('failed')
+
+    def _failing():
+        release.wait()
+        raise error
+
+    threads, results = _parallel(flight, 'key', _failing, 3)
+    _wait_for_waiters(flight, 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [error] * 3
+
+
+def test_flight_sequential():
+    """Calls which do not overlap are executed separately."""
+    flight = SingleFlight()
+    assert flight.call('key', lambda: 1) == 1
+    assert flight.call('key', lambda: 2) == 2
+
+    with pytest.raises(ValueError):
+        flight.call('key', int, 'not a number')
+    assert flight.stats()['running'] == 0
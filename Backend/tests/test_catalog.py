@@ -0,0 +1,65 @@
+"""Tests for the cache of public resources."""
+
+
+def test_response_cached(app):
+    """Public reads are served from the cache."""
+    with app.app_context():
+        app.data.driver.db['lectures'].insert({'title': 'First'})
+
+    first = app.client.get('/lectures', assert_status=200)
+
+    # Bypass the API, the cache doesn't notice
+    with app.app_context():
+        app.data.driver.db['lectures'].insert({'title': 'Second'})
+
+    second = app.client.get('/lectures', assert_status=200)
+
+    assert first == second
+    assert len(second['_items']) == 1
+    assert app.catalog_cache.hits == 1
+
+
+def test_changes_clear_cache(app):
+    """Changes through the API clear the cache."""
+    app.client.get('/lectures', assert_status=200)
+
+    with app.admin():
+        lecture = {
+            'title': 'Awesome Lecture',
+            'department': 'itet',
+            'year': 3,
+        }
+        app.client.post('/lectures', data=lecture, assert_status=201)
+
+    response = app.client.get('/lectures', assert_status=200)
+    assert len(response['_items']) == 1
+
+
+def test_different_queries(app):
+    """Every query is cached separately."""
+    with app.app_context():
+        app.data.driver.db['lectures'].insert({'title': 'First'})
+
+    app.client.get('/lectures', assert_status=200)
+    response = app.client.get('/lectures?where={"title": "Other"}',
+                              assert_status=200)
+
+    assert response['_items'] == []
+
+
+def test_cors_cached_separately(app):
+    """Requests with and without origin get different headers."""
+    client = app.test_client()
+    client.get('/lectures')
+    response = client.get('/lectures',
+                          headers={'Origin': 'https://pvk.amiv.ethz.ch'})
+
+    assert 'Access-Control-Allow-Origin' in response.headers
+
+
+def test_private_not_cached(app):
+    """Only public resources are cached."""
+    with app.admin():
+        app.client.get('/signups', assert_status=200)
+
+    assert len(app.catalog_cache) == 0
@@ -0,0 +1,149 @@
+"""Tests for command line maintenance tasks."""
+
+from datetime import datetime
+
+import pytest
+from click.testing import CliRunner
+from flask.cli import ScriptInfo
+
+from backend.commands import (
+    indexes,
+    recount_spots_command,
+    update_waiting_lists_command,
+    rebuild_occupancy_command,
+    normalize_timespans_command,
+    reconcile_command,
+    duplicates_command,
+)
+
+
+def invoke(app, command, *args):
+    """Run a command with the test app, return the result."""
+    info = ScriptInfo(create_app=lambda _: app)
+    return CliRunner().invoke(command, args, obj=info)
+
+
+def test_indexes_created(app):
+    """All configured indexes are created when the app starts."""
+    with app.app_context():
+        for resource, settings in app.config['DOMAIN'].items():
+            existing = app.data.driver.db[resource].index_information()
+            for name in settings['mongo_indexes']:
+                assert name in existing
+
+
+def test_indexes_command(app):
+    """The command verifies all indexes."""
+    result = invoke(app, indexes)
+    assert result.exit_code == 0, result.output
+    assert 'signups.course_status_updated_nethz' in result.output
+    assert 'winning plan: ' in result.output
+
+
+def test_indexes_command_missing(app):
+    """If an index is missing, the command fails."""
+    with app.app_context():
+        app.data.driver.db['signups'].drop_index('nethz')
+
+    result = invoke(app, indexes)
+    assert result.exit_code != 0
+
+
+def test_recount_spots_command(app):
+    """The command reports corrected counters."""
+    with app.app_context():
+        course = app.data.driver.db['courses'].insert({'spots': 5})
+        app.data.driver.db['signups'].insert({'course': course,
+                                              'status': 'reserved'})
+
+    result = invoke(app, recount_spots_command)
+    assert result.exit_code == 0, result.output
+    assert '1 counter(s) corrected.' in result.output
+
+
+def test_update_waiting_lists(app):
+    """All waiting lists can be updated at once."""
+    with app.app_context():
+        for _ in range(3):
+            course = app.data.driver.db['courses'].insert({'spots': 5})
+            app.data.driver.db['signups'].insert({'course': course,
+                                                  'status': 'waiting'})
+
+    result = invoke(app, update_waiting_lists_command)
+    assert result.exit_code == 0, result.output
+    assert '3 signup(s) reserved.' in result.output
+
+
+def test_rebuild_occupancy_command(app):
+    """Occupancy of courses in the database can be initialized."""
+    with app.app_context():
+        slot = {'start': datetime(2018, 1, 1, 10),
+                'end': datetime(2018, 1, 1, 12)}
+        app.data.driver.db['courses'].insert({'room': 'HG F 1',
+                                              'datetimes': [slot, slot]})
+
+    result = invoke(app, rebuild_occupancy_command)
+    assert result.exit_code == 0, result.output
+    assert '2 time slot(s) booked.' in result.output
+
+
+def test_normalize_timespans(app):
+    """Existing time slots are stored in whole seconds."""
+    with app.app_context():
+        courses = app.data.driver.db['courses']
+        slot = {'start': datetime(2018, 1, 1, 10, 0, 0, 500000),
+                'end': datetime(2018, 1, 1, 12)}
+        course = courses.insert({'room': 'HG F 1', 'datetimes': [slot]})
+        courses.insert({'room': 'HG F 2', 'datetimes': []})
+
+    result = invoke(app, normalize_timespans_command)
+    assert result.exit_code == 0, result.output
+    assert '1 course(s) normalized.' in result.output
+    assert '1 time slot(s) booked.' in result.output
+
+    with app.app_context():
+        stored = courses.find_one({'_id': course})['datetimes'][0]
+        assert stored['start'].replace(tzinfo=None) == \
+            datetime(2018, 1, 1, 10)
+
+
+@pytest.mark.usefixtures('stripe_stub')
+def test_reconcile_command(app):
+    """The command reports problems and repairs them if requested."""
+    with app.app_context():
+        app.data.driver.db['payments'].insert_one({
+            'signups': [],
+            'status': 'succeeded',
+            'charge_id': 'ch_unknown',
+        })
+
+    result = invoke(app, reconcile_command, '--repair')
+    assert result.exit_code == 0, result.output
+    assert 'payment without charge' in result.output
+    assert '1 problem(s) found.' in result.output
+
+
+def test_duplicates_command(app):
+    """Duplicates are reported and deleted, except the best and paid ones."""
+    with app.app_context():
+        database = app.data.driver.db
+        database['signups'].drop_index('course_nethz')
+        course = database['courses'].insert({'spots': 5})
+        (_, accepted, reserved) = [database['signups'].insert({
+            'course': course, 'nethz': 'pablito', 'status': status,
+        }) for status in ('waiting', 'accepted', 'reserved')]
+        database['payments'].insert({'signups': [reserved]})
+
+    result = invoke(app, duplicates_command)
+    assert result.exit_code == 0, result.output
+    assert ('signups course=%s, nethz=pablito: 3 document(s), keeping %s'
+            % (course, accepted)) in result.output
+    assert '0 document(s) deleted.' in result.output
+
+    result = invoke(app, duplicates_command, '--delete')
+    assert result.exit_code == 0, result.output
+    assert '1 document(s) deleted.' in result.output
+
+    with app.app_context():
+        assert set(database['signups'].distinct('_id')) == \
+            {accepted, reserved}
@@ -0,0 +1,72 @@
+"""Test that unique combinations are enforced by the database."""
+
+from unittest.mock import patch
+
+import pytest
+from bson import ObjectId
+
+from backend.app import create_app
+from backend.validation import APIValidator, unique_index
+
+
+@pytest.mark.parametrize('resource', ['signups', 'selections'])
+def test_duplicate(app, resource, course):
+    """A second signup/selection for the same course is a validation error."""
+    data = {'nethz': 'pablito', 'course': course}
+    with app.admin():
+        app.client.post(resource, data=data, assert_status=201)
+        response = app.client.post(resource, data=data, assert_status=422)
+
+    assert response['_status'] == 'ERR'
+    assert response['_issues'] == {
+        'course': "value already exists in the database in combination "
+                  "with values for: ['nethz']",
+    }
+    assert response['_error']['code'] == 422
+
+
+@pytest.mark.parametrize('resource', ['signups', 'selections'])
+def test_no_check_before_insert(app, resource, course):
+    """Even if validation misses a duplicate, the database rejects it."""
+    data = {'nethz': 'pablito', 'course': course}
+    with app.admin():
+        app.client.post(resource, data=data, assert_status=201)
+
+        # Simulate a parallel request, which has passed validation as well
+        with patch.object(APIValidator, '_validate_unique_combination'):
+            app.client.post(resource, data=data, assert_status=422)
+
+        assert app.data.driver.db[resource].count() == 1
+
+
+def test_other_users_and_courses(app, course):
+    """The combination is unique, not the single fields."""
+    with app.admin():
+        other_course = str(app.data.driver.db['courses'].insert({'spots': 1}))
+        for (nethz, course_id) in [('pablito', course),
+                                   ('pablo', course),
+                                   ('pablito', other_course)]:
+            app.client.post('selections',
+                            data={'nethz': nethz, 'course': course_id},
+                            assert_status=201)
+
+
+def test_duplicates_at_startup(app):
+    """If the database contains duplicates, the app starts without index."""
+    with app.app_context():
+        signups = app.data.driver.db['signups']
+        signups.drop_index('course_nethz')
+        course = ObjectId()
+        signups.insert_many([{'course': course, 'nethz': 'pablito'},
+                             {'course': course, 'nethz': 'pablito'}])
+
+    # Same database as the test app
+    application = create_app(**{key: app.config[key] for key in [
+        'MONGO_DBNAME', 'MONGO_USERNAME', 'MONGO_PASSWORD',
+        'ADMIN_GROUP_REFRESH', 'STRIPE_ASYNC']})
+
+    with application.app_context():
+        assert 'course_nethz' not in signups.index_information()
+        # Validation checks the database instead
+        assert unique_index('signups', ['course', 'nethz']) is None
+        assert unique_index('selections', ['course', 'nethz']) is None
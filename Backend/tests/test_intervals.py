@@ -0,0 +1,99 @@
+"""Tests for time slots and overlap detection."""
+from datetime import datetime, timedelta, timezone
+from itertools import combinations
+from random import Random
+
+import pytest
+
+from backend.intervals import (
+    to_interval,
+    find_overlap,
+    describe,
+    normalize,
+)
+
+
+def slot(start_hour, end_hour, tzinfo=None):
+    """Create a time slot on a fixed day."""
+    day = datetime(2018, 1, 1, tzinfo=tzinfo)
+    return {'start': day + timedelta(hours=start_hour),
+            'end': day + timedelta(hours=end_hour)}
+
+
+def pairwise(intervals, others):
+    """Reference: compare all pairs involving at least one of intervals."""
+    def overlaps(first, second):
+        return first[1] > second[0] and first[0] < second[1]
+    own = list(combinations(intervals, 2))
+    mixed = [(a, b) for a in intervals for b in others]
+    return any(overlaps(a, b) for (a, b) in own + mixed)
+
+
+def test_to_interval():
+    """Naive datetimes are UTC, aware datetimes are converted."""
+    assert to_interval(slot(0, 1)) == (1514764800, 1514768400)
+    assert to_interval(slot(0, 1, timezone.utc)) == (1514764800, 1514768400)
+    zurich = timezone(timedelta(hours=1))
+    assert to_interval(slot(1, 2, zurich)) == (1514764800, 1514768400)
+
+
+@pytest.mark.parametrize('intervals, expected', [
+    ([], None),
+    ([(10, 12)], None),
+    ([(10, 12), (12, 14)], None),  # Touching is fine
+    ([(14, 16), (10, 12)], None),
+    ([(10, 12), (11, 13)], ((10, 12), (11, 13))),
+    ([(11, 13), (10, 12)], ((10, 12), (11, 13))),
+    ([(10, 18), (11, 12), (13, 14)], ((10, 18), (11, 12))),
+    ([(10, 11), (12, 16), (13, 14)], ((12, 16), (13, 14))),
+    ([(10, 12), (12, 12)], None),  # Empty interval at the end
+    ([(10, 12), (11, 11)], ((10, 12), (11, 11))),  # Empty interval inside
+])
+def test_find_overlap(intervals, expected):
+    """The conflicting pair is returned, earlier interval first."""
+    assert find_overlap(intervals) == expected
+
+
+def test_others_not_compared():
+    """Overlaps between other intervals are not reported."""
+    others = [(10, 12), (11, 13)]
+    assert find_overlap([(14, 16)], others) is None
+    assert find_overlap([(12, 14)], others) == ((11, 13), (12, 14))
+
+
+def test_same_result_as_pairwise():
+    """Random intervals give the same answer as comparing all pairs."""
+    rng = Random(42)
+
+    def random_intervals(number):
+        intervals = []
+        for _ in range(number):
+            start = rng.randint(0, 100)
+            intervals.append((start, start + rng.randint(0, 10)))
+        return intervals
+
+    for _ in range(500):
+        intervals = random_intervals(rng.randint(0, 6))
+        others = random_intervals(rng.randint(0, 20))
+        result = find_overlap(intervals, others)
+        assert (result is not None) == pairwise(intervals, others)
+
+
+def test_describe():
+    """Intervals are readable in error messages."""
+    assert describe(to_interval(slot(10, 12))) == \
+        '2018-01-01 10:00:00 to 2018-01-01 12:00:00'
+
+
+def test_normalize():
+    """All time slots of a course are stored in UTC, whole seconds."""
+    zurich = timezone(timedelta(hours=1))
+    course = {
+        'signup': slot(1, 2, zurich),
+        'datetimes': [{'start': datetime(2018, 1, 1, 10, 0, 0, 5000),
+                       'end': datetime(2018, 1, 1, 12)}],
+    }
+    assert normalize(course) == {
+        'signup': slot(0, 1),
+        'datetimes': [slot(10, 12)],
+    }
@@ -0,0 +1,86 @@
+"""Test the optional timing of validation rules."""
+
+import json
+
+import pytest
+from flask.testing import FlaskClient
+
+from backend.metrics import Histogram
+
+METRICS = [{'VALIDATION_METRICS': True}]
+
+
+def test_disabled_by_default(app):
+    """Without the setting, there is no endpoint."""
+    with app.admin():
+        app.client.get('/metrics', assert_status=404)
+
+
+def test_histogram():
+    """Durations are sorted into buckets."""
+    histogram = Histogram()
+    for duration in [0.1, 0.7, 3, 3, 5000]:
+        histogram.add(duration, 1)
+
+    stats = histogram.stats()
+    assert stats['count'] == 5
+    assert stats['queries'] == 5
+    assert stats['max_ms'] == 5000
+    assert stats['buckets_ms']['<=0.5'] == 1
+    assert stats['buckets_ms']['<=1'] == 1
+    assert stats['buckets_ms']['<=5'] == 2
+    assert stats['buckets_ms']['>1000'] == 1
+
+
+@pytest.mark.parametrize('app', METRICS, indirect=True)
+def test_metrics(app, course):
+    """Rules are timed per resource and their queries counted."""
+    with app.admin():
+        app.client.post('signups',
+                        data={'nethz': 'pablito', 'course': course},
+                        assert_status=201)
+        metrics = app.client.get('/metrics', assert_status=200)
+
+    overlap = metrics['signups']['no_course_overlap']
+    assert overlap['count'] == 1
+    assert overlap['queries'] >= 1
+    assert sum(overlap['buckets_ms'].values()) == 1
+
+
+@pytest.mark.parametrize('app', METRICS, indirect=True)
+def test_metrics_admin_only(app):
+    """Users can not see the metrics."""
+    with app.user():
+        app.client.get('/metrics', assert_status=403)
+
+
+def _post_signup(app, course):
+    """Post a signup and return the full response, not only the json."""
+    client = FlaskClient(app, app.response_class)
+    response = client.post('signups',
+                           data=json.dumps({'nethz': 'nethz',
+                                            'course': course}),
+                           content_type='application/json',
+                           headers={'Authorization': 'Token Trolololo'})
+    assert response.status_code == 201, response.get_data(as_text=True)
+    return response
+
+
+@pytest.mark.parametrize('app', METRICS, indirect=True)
+def test_header_for_admins(app, course):
+    """Admins see the timing of each request."""
+    with app.admin():
+        response = _post_signup(app, course)
+
+    timing = response.headers['X-Validation-Timing']
+    assert 'signups.no_course_overlap=' in timing
+    assert 'signups.unique_combination=' in timing
+
+
+@pytest.mark.parametrize('app', METRICS, indirect=True)
+def test_no_header_for_users(app, course):
+    """Users don't see the timing."""
+    with app.user():
+        response = _post_signup(app, course)
+
+    assert 'X-Validation-Timing' not in response.headers
@@ -0,0 +1,100 @@
+"""Test that the room and assistant occupancy follows the courses."""
+# pylint: disable=redefined-outer-name
+
+import pytest
+
+from backend.occupancy import init_occupancy
+
+
+@pytest.fixture
+def course(app):
+    """Create a course with two time slots."""
+    with app.admin():
+        assistant = str(app.data.driver.db['assistants'].insert({}))
+        lecture = str(app.data.driver.db['lectures'].insert({}))
+        data = {
+            'lecture': lecture,
+            'room': 'HG E 1',
+            'assistant': assistant,
+            'spots': 10,
+            'datetimes': [{
+                'start': '2018-12-06T10:00:00Z',
+                'end': '2018-12-06T12:00:00Z',
+            }, {
+                'start': '2018-12-07T10:00:00Z',
+                'end': '2018-12-07T12:00:00Z',
+            }],
+        }
+        return app.client.post('courses', data=data, assert_status=201)
+
+
+def test_post(app, course):
+    """Every time slot is booked."""
+    with app.app_context():
+        items = list(app.data.driver.db['occupancy'].find())
+
+    assert len(items) == 2
+    assert {str(item['course']) for item in items} == {course['_id']}
+    assert {item['room'] for item in items} == {'HG E 1'}
+    assert {str(item['assistant']) for item in items} == {course['assistant']}
+    assert sorted(item['start'] for item in items) == [
+        1544090400, 1544176800]  # 2018-12-06 and 07, 10:00 UTC
+
+
+def test_patch(app, course):
+    """Changing room or time slots updates the occupancy."""
+    with app.admin():
+        app.client.patch('courses/' + course['_id'],
+                         data={'room': 'HG E 2',
+                               'datetimes': [{
+                                   'start': '2018-12-08T10:00:00Z',
+                                   'end': '2018-12-08T12:00:00Z',
+                               }]},
+                         headers={'If-Match': course['_etag']},
+                         assert_status=200)
+
+        items = list(app.data.driver.db['occupancy'].find())
+
+    assert len(items) == 1
+    assert items[0]['room'] == 'HG E 2'
+    assert items[0]['start'] == 1544263200  # 2018-12-08 10:00 UTC
+
+
+def test_delete(app, course):
+    """A deleted course frees its room."""
+    with app.admin():
+        app.client.delete('courses/' + course['_id'],
+                          headers={'If-Match': course['_etag']},
+                          assert_status=204)
+
+        assert app.data.driver.db['occupancy'].count() == 0
+
+
+def test_conflict_message(app, course):
+    """The conflicting time slots are reported."""
+    with app.admin():
+        data = {
+            'lecture': course['lecture'],
+            'room': course['room'],
+            'spots': 10,
+            'datetimes': [{
+                'start': '2018-12-07T11:00:00Z',
+                'end': '2018-12-07T13:00:00Z',
+            }],
+        }
+        response = app.client.post('courses', data=data, assert_status=422)
+
+    assert response['_issues']['room'] == (
+        "the room 'HG E 1' is already occupied by another course at the "
+        "same time (2018-12-07 11:00:00 to 2018-12-07 13:00:00 overlaps "
+        "with 2018-12-07 10:00:00 to 2018-12-07 12:00:00)")
+
+
+def test_built_at_startup(app, course):  # pylint: disable=unused-argument
+    """An empty occupancy is built from the existing courses."""
+    with app.app_context():
+        occupancy = app.data.driver.db['occupancy']
+        occupancy.delete_many({})
+
+        init_occupancy(app)
+        assert occupancy.count() == 2
@@ -1,43 +1,34 @@
 """Tests for the Stripe payment backend"""
+# pylint: disable=redefined-outer-name
+from datetime import datetime
+from unittest.mock import Mock, patch
+
 import pytest
+from bson import ObjectId
+from pymongo.collection import Collection
+import stripe
+
+from backend.payments import (
+    StripeCalls,
+    ChargeWorkers,
+    charge_payment,
+    claim_payment,
+)
 
 
 @pytest.fixture(autouse=True)
-def base_data(app):
-    """Build test data for the tests."""
-    with app.admin():
-        lecture_data = {
-            'title': 'Awesome Lecture',
-            'department': 'itet',
-            'year': 3,
-        }
-        lecture = app.client.post('lectures',
-                                  data=lecture_data,
-                                  assert_status=201)
+def stripe_charges(stripe_stub):
+    """Use the local Stripe stub for all tests."""
+    return stripe_stub
 
-        course = {
-            'lecture': lecture['_id'],
-            'room': 'ETZ F 6',
-            'spots': 20,
-            'signup': {
-                'start': '2021-05-01T10:00:00Z',
-                'end': '2021-05-05T23:59:59Z',
-            },
-            'datetimes': [{
-                'start': '2021-06-05T10:00:00Z',
-                'end': '2021-06-05T12:00:00Z',
-            }, {
-                'start': '2021-06-06T10:00:00Z',
-                'end': '2021-06-06T12:00:00Z',
-            }],
-        }
-        response = app.client.post('courses',
-                                   data=course,
-                                   assert_status=201)
 
+@pytest.fixture(autouse=True)
+def base_data(app, lecture_course):
+    """Build test data for the tests."""
+    with app.admin():
         signup = {
             'nethz': 'nethz',  # default dummy value for user nethz
-            'course': response['_id']
+            'course': lecture_course['_id']
         }
         app.client.post('signups',
                         data=signup,
@@ -136,13 +127,13 @@ def test_users_require_token(app):
                         assert_status=422)
 
 
-def test_valid_card(app):
+def test_valid_card(app, stripe_charges):
     """Test that payment succeeds with a valid card.
 
     'tok_visa' always corresponds to a valid Visa card.
     """
     with app.user():
-        # Fetch the signups we want to pay
+        # Fetch the _ids of the signups we want to pay for
         signups = [signup['_id'] for signup in app.client.get('signups')['_items']]
 
         # Try to create a payment with the Visa test token
@@ -151,18 +142,27 @@ def test_valid_card(app):
             'signups': signups,
             'token': 'tok_visa',
         }
-        app.client.post('payments',
-                        data=payment,
-                        assert_status=201)
+        response = app.client.post('payments',
+                                   data=payment,
+                                   assert_status=201)
+        assert response['status'] == 'succeeded'
+        assert response['charge_id'] == stripe_charges[0]['id']
+        assert stripe_charges[0]['amount'] == response['amount']
 
-        # Check that the signups were marked as paid
+        # The response contains the current etag
+        stored = app.client.get('payments/' + response['_id'],
+                                assert_status=200)
+        assert stored['_etag'] == response['_etag']
+        assert stored['status'] == 'succeeded'
+
+        # Check that the signups have been marked as paid
         signups = app.client.get('signups')['_items']
         for signup in signups:
             assert signup['status'] == 'accepted'
 
 
 def test_invalid_card(app):
-    """Test that invalid cards yield a status code of 422.
+    """Test that payments with invalid cards fail.
 
     'tok_chargeDeclined' always causes the transaction to fail.
     """
@@ -171,14 +171,16 @@ def test_invalid_card(app):
         signups = [signup['_id'] for signup in app.client.get('signups')['_items']]
 
         # Try to create a payment with the charge declined token
-        # We expect this to fail
+        # We expect the payment to be stored, but failed
         payment = {
             'signups': signups,
             'token': 'tok_chargeDeclined',
         }
-        app.client.post('payments',
-                        data=payment,
-                        assert_status=422)
+        response = app.client.post('payments',
+                                   data=payment,
+                                   assert_status=201)
+        assert response['status'] == 'failed'
+        assert response['error'] == 'Card declined'
 
         # Check that the signups were NOT marked as paid
         signups = app.client.get('signups')['_items']
@@ -213,6 +215,41 @@ def test_users_cannot_delete(app):
             assert signup['status'] == 'accepted'
 
 
+def test_delete_failed_payment(app):
+    """Deleting a failed payment does not unpay the signups."""
+    with app.admin():
+        signups = [signup['_id'] for signup in app.client.get('signups')['_items']]
+        failed = app.client.post('payments',
+                                 data={'signups': signups,
+                                       'token': 'tok_chargeDeclined'},
+                                 assert_status=201)
+        app.client.post('payments', data={'signups': signups, 'token': None},
+                        assert_status=201)
+
+        app.client.delete('payments/' + failed['_id'],
+                          headers={'If-Match': failed['_etag']},
+                          assert_status=204)
+        for signup in app.client.get('signups')['_items']:
+            assert signup['status'] == 'accepted'
+
+
+@pytest.mark.parametrize('status', ['pending', 'processing'])
+def test_no_deletion_while_charging(app, status):
+    """Payments that may still be charged can't be deleted."""
+    with app.admin():
+        signups = [signup['_id'] for signup in app.client.get('signups')['_items']]
+        payment = app.client.post('payments',
+                                  data={'signups': signups,
+                                        'token': 'tok_visa'},
+                                  assert_status=201)
+        app.data.driver.db['payments'].update_one(
+            {'_id': ObjectId(payment['_id'])}, {'$set': {'status': status}})
+
+        app.client.delete('payments/' + payment['_id'],
+                          headers={'If-Match': payment['_etag']},
+                          assert_status=409)
+
+
 def test_signup_unique_per_payment(app):
     """Test that the same signup only appears once per payment"""
     with app.admin():
@@ -231,3 +268,197 @@ def test_signup_unique_per_payment(app):
         app.client.post('payments',
                         data=payment,
                         assert_status=422)
+
+
+def test_signups_prefetched(app):
+    """Signups of a payment are loaded at once, not for every signup."""
+    def count_queries(number):
+        """Pay for `number` new signups and count the signup queries."""
+        with app.admin():
+            signups = app.data.driver.db['signups']
+            payment = {
+                'signups': [str(signups.insert({'nethz': 'other',
+                                                'status': 'reserved'}))
+                            for _ in range(number)],
+                'token': None,
+            }
+
+            original_find = Collection.find
+            original_find_one = Collection.find_one
+            with patch.object(Collection, 'find', autospec=True,
+                              side_effect=original_find) as find, \
+                    patch.object(Collection, 'find_one', autospec=True,
+                                 side_effect=original_find_one) as find_one:
+                app.client.post('payments', data=payment, assert_status=201)
+
+            return [sum(args[0].name == 'signups'
+                        for (args, _) in mock.call_args_list)
+                    for mock in (find, find_one)]
+
+    assert count_queries(1) == count_queries(5)
+
+
+def test_charged_only_once(app, stripe_charges):
+    """If a payment is charged again, Stripe returns the same charge."""
+    with app.user():
+        signups = [signup['_id'] for signup in app.client.get('signups')['_items']]
+        payment = app.client.post('payments',
+                                  data={'signups': signups,
+                                        'token': 'tok_visa'},
+                                  assert_status=201)
+
+        # The server crashed before the result of the charge was stored
+        payments = app.data.driver.db['payments']
+        payments.update_one({'_id': ObjectId(payment['_id'])},
+                            {'$set': {'status': 'pending'}})
+        updates = charge_payment(payment['_id'])
+
+        assert updates['charge_id'] == payment['charge_id']
+        assert len(stripe_charges) == 1
+
+        # Payments that are not pending are not charged again
+        assert charge_payment(payment['_id']) is None
+
+
+def test_no_payment_while_pending(app):
+    """Signups with a pending payment can't be paid again."""
+    with app.user():
+        signups = [signup['_id'] for signup in app.client.get('signups')['_items']]
+        app.data.driver.db['payments'].insert({
+            'signups': [ObjectId(signup) for signup in signups],
+            'status': 'pending',
+        })
+
+        app.client.post('payments',
+                        data={'signups': signups, 'token': 'tok_visa'},
+                        assert_status=422)
+
+
+@pytest.mark.parametrize('app', [{'STRIPE_ASYNC': True}], indirect=True)
+def test_async(app, stripe_charges):
+    """Charges are made in the background, clients poll the payment."""
+    with app.user():
+        signups = [signup['_id'] for signup in app.client.get('signups')['_items']]
+        with patch('backend.payments.charge_payment',
+                   side_effect=charge_payment) as charge:
+            payment = app.client.post('payments',
+                                      data={'signups': signups,
+                                            'token': 'tok_visa'},
+                                      assert_status=201)
+            assert payment['status'] == 'pending'
+
+            app.charge_workers.queue.join()
+            # The first payment is not queued again when the workers start
+            assert charge.call_count == 1
+
+        payment = app.client.get('payments/' + payment['_id'],
+                                 assert_status=200)
+        assert payment['status'] == 'succeeded'
+        assert payment['charge_id'] == stripe_charges[0]['id']
+        assert len(stripe_charges) == 1
+        for signup in app.client.get('signups')['_items']:
+            assert signup['status'] == 'accepted'
+
+
+@pytest.mark.parametrize('app', [{'STRIPE_ASYNC': True}], indirect=True)
+def test_async_claimed_once(app, stripe_charges):
+    """A payment claimed by one worker is not charged by another one."""
+    with app.user():
+        signups = [signup['_id'] for signup in app.client.get('signups')['_items']]
+        with patch.object(app.charge_workers, 'submit'):
+            payment = app.client.post('payments',
+                                      data={'signups': signups,
+                                            'token': 'tok_visa'},
+                                      assert_status=201)
+
+        assert claim_payment(payment['_id'])['status'] == 'processing'
+        app.charge_workers.submit(payment['_id'])
+        app.charge_workers.queue.join()
+        assert stripe_charges == []
+
+        # Until the claim expires, e.g. because the server crashed
+        app.data.driver.db['payments'].update_one(
+            {'_id': ObjectId(payment['_id'])},
+            {'$set': {'_updated': datetime(2018, 1, 1)}})
+        app.charge_workers.submit(payment['_id'])
+        app.charge_workers.queue.join()
+
+        payment = app.client.get('payments/' + payment['_id'],
+                                 assert_status=200)
+        assert payment['status'] == 'succeeded'
+        assert len(stripe_charges) == 1
+
+
+@pytest.mark.parametrize('app', [{'STRIPE_ASYNC': True}], indirect=True)
+def test_async_after_restart(app, stripe_charges):
+    """Payments claimed by a crashed server are charged once expired."""
+    # The workers have been started by the first request
+    assert app.charge_workers.stats()['threads'] == \
+        app.config['STRIPE_WORKERS']
+
+    with app.user():
+        signups = [signup['_id'] for signup in app.client.get('signups')['_items']]
+        with patch.object(app.charge_workers, 'submit'):
+            payment = app.client.post('payments',
+                                      data={'signups': signups,
+                                            'token': 'tok_visa'},
+                                      assert_status=201)
+        claim_payment(payment['_id'])
+
+    # The workers of the restarted server
+    workers = ChargeWorkers(app, 1)
+    with patch('backend.payments.Timer') as timer:
+        workers.start()
+        workers.queue.join()
+    assert stripe_charges == []
+
+    # Not dropped, but queued again once the claim expires
+    (delay, function, args) = timer.call_args[0]
+    assert 0 < delay <= app.config['STRIPE_CLAIM_TIMEOUT'] + 1
+    with app.app_context():
+        app.data.driver.db['payments'].update_one(
+            {'_id': ObjectId(payment['_id'])},
+            {'$set': {'_updated': datetime(2018, 1, 1)}})
+    function(*args)
+    workers.queue.join()
+
+    with app.user():
+        payment = app.client.get('payments/' + payment['_id'],
+                                 assert_status=200)
+        assert payment['status'] == 'succeeded'
+        assert len(stripe_charges) == 1
+
+
+def test_retry_rate_limited():
+    """Rate limited calls are retried, other errors are not."""
+    calls = StripeCalls(1, retries=2, backoff=0, max_backoff=0)
+    function = Mock(side_effect=[stripe.error.RateLimitError('Slow down'),
+                                 'charge'])
+    assert calls.call(function, amount=10) == 'charge'
+    assert function.call_count == 2
+    function.assert_called_with(amount=10)
+
+    declined = Mock(side_effect=stripe.error.CardError('Declined', None, 0))
+    with pytest.raises(stripe.error.CardError):
+        calls.call(declined)
+    assert declined.call_count == 1
+
+    assert calls.stats() == {'calls': 2, 'retried': 1, 'succeeded': 1,
+                             'failed': 1, 'exhausted': 0}
+
+
+def test_retries_exhausted():
+    """After all retries, the error is raised."""
+    calls = StripeCalls(1, retries=2, backoff=0, max_backoff=0)
+    function = Mock(side_effect=stripe.error.RateLimitError('Slow down'))
+    with pytest.raises(stripe.error.RateLimitError):
+        calls.call(function)
+    assert function.call_count == 3
+    assert calls.stats()['exhausted'] == 1
+
+
+def test_backoff():
+    """The delay grows exponentially, but is bounded."""
+    calls = StripeCalls(1, retries=10, backoff=1, max_backoff=8)
+    for retry in range(10):
+        assert 0 <= calls.delay(retry) <= min(8, 2 ** retry)
@@ -0,0 +1,100 @@
+"""Test the conflict report for semester planning."""
+# pylint: disable=redefined-outer-name
+
+import pytest
+
+from backend.planning import conflict_matrix
+
+
+def test_conflict_matrix():
+    """Courses conflict if any of their intervals overlap."""
+    matrix = conflict_matrix([
+        [(0, 10)],
+        [(20, 30), (5, 6)],
+        [(10, 20)],  # Touching is fine
+        [],
+    ])
+    assert matrix.tolist() == [
+        [False, True, False, False],
+        [True, False, False, False],
+        [False, False, False, False],
+        [False, False, False, False],
+    ]
+
+
+def test_conflict_matrix_empty():
+    """Works without any courses."""
+    assert conflict_matrix([]).shape == (0, 0)
+
+
+@pytest.fixture
+def courses(app):
+    """Two parallel courses of the same lecture year, one of another year."""
+    with app.admin():
+        def _lecture(title, year):
+            data = {'title': title, 'department': 'itet', 'year': year}
+            return app.client.post('lectures', data=data,
+                                   assert_status=201)['_id']
+
+        first, second = _lecture('Signals', 2), _lecture('Physics', 3)
+
+        def _course(lecture, room):
+            data = {
+                'lecture': lecture,
+                'room': room,
+                'spots': 10,
+                'datetimes': [{
+                    'start': '2018-12-06T10:00:00Z',
+                    'end': '2018-12-06T12:00:00Z',
+                }],
+            }
+            return app.client.post('courses', data=data,
+                                   assert_status=201)['_id']
+
+        return (_course(first, 'A'), _course(first, 'B'),
+                _course(second, 'C'))
+
+
+def test_report(app, courses):
+    """Only conflicts within the same department and year are reported."""
+    with app.admin():
+        report = app.client.get('/planning/conflicts', assert_status=200)
+
+    assert report['courses'] == 3
+    assert report['groups'] == [{
+        'department': 'itet',
+        'year': 2,
+        'courses': [courses[0], courses[1]],
+        'conflicts': [[0, 1]],
+    }, {
+        'department': 'itet',
+        'year': 3,
+        'courses': [courses[2]],
+        'conflicts': [],
+    }]
+
+
+def test_report_admin_only(app):
+    """Users can not see the report."""
+    with app.user():
+        app.client.get('/planning/conflicts', assert_status=403)
+
+
+def test_report_cached(app, courses):
+    """The report is cached until a course changes."""
+    with app.admin():
+        app.client.get('/planning/conflicts', assert_status=200)
+        app.client.get('/planning/conflicts', assert_status=200)
+        assert app.planning_cache.hits == 1
+
+        course = app.client.get('courses/' + courses[1], assert_status=200)
+        app.client.patch('courses/' + courses[1],
+                         data={'datetimes': [{
+                             'start': '2018-12-07T10:00:00Z',
+                             'end': '2018-12-07T12:00:00Z',
+                         }]},
+                         headers={'If-Match': course['_etag']},
+                         assert_status=200)
+
+        report = app.client.get('/planning/conflicts', assert_status=200)
+        assert report['groups'][0]['conflicts'] == []
@@ -0,0 +1,92 @@
+"""Test the prices of courses and payments."""
+# pylint: disable=redefined-outer-name
+
+from unittest.mock import patch
+
+import pytest
+from bson import ObjectId
+
+from backend.pricing import get_prices
+
+
+@pytest.fixture
+def courses(app):
+    """Courses of lectures with and without price, one with discount."""
+    with app.admin():
+        def _lecture(title, department, price=None):
+            data = {'title': title, 'department': department, 'year': 1,
+                    'price': price}
+            return app.client.post('lectures', data=data,
+                                   assert_status=201)['_id']
+
+        def _course(lecture, discount=None):
+            data = {
+                'lecture': lecture,
+                'spots': 10,
+                'discount': discount,
+                'signup': {
+                    'start': '2021-05-01T10:00:00Z',
+                    'end': '2021-05-05T23:59:59Z',
+                },
+            }
+            return app.client.post('courses', data=data,
+                                   assert_status=201)['_id']
+
+        priced = _lecture('Signals', 'itet', price=2000)
+        itet = _lecture('Networks', 'itet')
+        mavt = _lecture('Mechanics', 'mavt')
+        return {
+            'lecture': _course(priced),
+            'discount': _course(priced, discount=25),
+            'department': _course(mavt),
+            'default': _course(itet),
+        }
+
+
+@pytest.mark.parametrize('app', [{'DEPARTMENT_PRICES': {'mavt': 1500}}],
+                         indirect=True)
+def test_prices(app, courses):
+    """Lecture prices come first, then department prices, then default."""
+    with app.app_context():
+        prices = get_prices()
+
+    assert prices[ObjectId(courses['lecture'])] == 2000
+    assert prices[ObjectId(courses['discount'])] == 1500
+    assert prices[ObjectId(courses['department'])] == 1500
+    assert prices[ObjectId(courses['default'])] == app.config['COURSE_PRICE']
+
+
+def test_prices_cached(app, courses):
+    """Prices are computed once until courses or lectures change."""
+    with app.app_context(), patch('backend.pricing.compute_prices',
+                                  return_value={}) as compute:
+        get_prices()
+        get_prices()
+        assert compute.call_count == 1
+
+    with app.admin():
+        course = app.client.get('courses/' + courses['default'])
+        app.client.patch('courses/' + courses['default'],
+                         data={'discount': 50},
+                         headers={'If-Match': course['_etag']},
+                         assert_status=200)
+
+    with app.app_context():
+        prices = get_prices()
+    assert prices[ObjectId(courses['default'])] == \
+        app.config['COURSE_PRICE'] // 2
+
+
+def test_payment_amount(app, courses):
+    """The amount of a payment is the sum of the course prices."""
+    with app.admin():
+        signups = [app.client.post('signups', data={
+            'nethz': 'nethz',
+            'course': courses[key],
+        }, assert_status=201)['_id'] for key in ('lecture', 'discount')]
+
+        payment = app.client.post('payments', data={
+            'signups': signups,
+            'token': None,
+        }, assert_status=201)
+        assert payment['amount'] == 3500
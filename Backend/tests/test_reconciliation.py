@@ -0,0 +1,112 @@
+"""Tests for the reconciliation of payments with Stripe."""
+
+import pytest
+from bson import ObjectId
+
+from backend.reconciliation import reconcile
+
+
+@pytest.fixture(name='payments')
+def fixture_payments(app, lecture_course, stripe_stub):  # pylint: disable=unused-argument
+    """Create three users with a paid signup each."""
+    with app.admin():
+        for nethz in ('alice', 'bob', 'carol'):
+            app.client.post('signups', data={
+                'nethz': nethz,
+                'course': lecture_course['_id'],
+            }, assert_status=201)
+
+    paid = []
+    for nethz in ('alice', 'bob', 'carol'):
+        with app.user(nethz=nethz):
+            signup = app.client.get('signups')['_items'][0]
+            paid.append(app.client.post('payments', data={
+                'signups': [signup['_id']],
+                'token': 'tok_visa_%s' % nethz,
+            }, assert_status=201))
+    return paid
+
+
+def check(app, **kwargs):
+    """Run the reconciliation with the app."""
+    with app.app_context():
+        return list(reconcile(**kwargs))
+
+
+def test_consistent(app, payments):  # pylint: disable=unused-argument
+    """Without mismatches, nothing is reported."""
+    calls = app.stripe_calls.stats()['calls']
+    assert check(app, batch_size=1) == []
+    # Every page of charges is a call to Stripe, the stub sends two per page
+    assert app.stripe_calls.stats()['calls'] == calls + 2
+
+
+def test_charge_refunded(app, payments, stripe_stub):
+    """Refunded payments are marked as failed, the signups as unpaid."""
+    stripe_stub[0]['refunded'] = True
+
+    assert check(app, repair=True) == [{
+        'problem': 'charge refunded',
+        'payment': payments[0]['_id'],
+        'charge': stripe_stub[0]['id'],
+        'repaired': True,
+    }]
+
+    with app.app_context():
+        database = app.data.driver.db
+        payment = database['payments'].find_one(ObjectId(payments[0]['_id']))
+        assert payment['status'] == 'failed'
+        signup = database['signups'].find_one(payment['signups'][0])
+        assert signup['status'] == 'reserved'
+
+    assert check(app) == []
+
+
+def test_charge_without_payment(app, payments, stripe_stub):
+    """Charges for processing payments are found with their metadata."""
+    payment_id = ObjectId(payments[1]['_id'])
+    with app.app_context():
+        database = app.data.driver.db
+        # The server crashed after charging
+        database['payments'].update_one({'_id': payment_id}, {
+            '$set': {'status': 'processing'},
+            '$unset': {'charge_id': ''},
+        })
+        database['signups'].update_many({}, {'$set': {'status': 'reserved'}})
+
+    problems = check(app, batch_size=2, repair=True)
+    assert problems[0] == {
+        'problem': 'charge without payment',
+        'payment': str(payment_id),
+        'charge': stripe_stub[1]['id'],
+        'repaired': True,
+    }
+    # The signups of the other payments are repaired as well
+    assert [problem['problem'] for problem in problems[1:]] == \
+        ['signups not paid'] * 2
+
+    with app.app_context():
+        payment = app.data.driver.database['payments'].find_one(payment_id)
+        assert payment['status'] == 'succeeded'
+        assert payment['charge_id'] == stripe_stub[1]['id']
+
+    assert check(app) == []
+
+
+def test_payment_without_charge(app, payments, stripe_stub):
+    """Payments with unknown charges are reported, but not repaired."""
+    with app.app_context():
+        app.data.driver.database['payments'].update_one(
+            {'_id': ObjectId(payments[2]['_id'])},
+            {'$set': {'charge_id': 'ch_unknown'}})
+
+    problems = check(app, repair=True)
+    assert {'problem': 'payment without charge',
+            'payment': payments[2]['_id'],
+            'charge': None,
+            'repaired': False} in problems
+    # The real charge of the payment needs to be refunded by hand
+    assert {'problem': 'duplicate charge',
+            'payment': payments[2]['_id'],
+            'charge': stripe_stub[2]['id'],
+            'repaired': False} in problems
@@ -0,0 +1,87 @@
+"""Test the cached schedules for the course overlap check."""
+# pylint: disable=redefined-outer-name
+
+import pytest
+
+
+@pytest.fixture
+def courses(app):
+    """Create three courses: the first two overlap, the last does not."""
+    with app.admin():
+        lecture = str(app.data.driver.db['lectures'].insert({}))
+
+        def _create(room, start, end):
+            data = {
+                'lecture': lecture,
+                'room': room,
+                'spots': 10,
+                'datetimes': [{'start': start, 'end': end}],
+            }
+            return app.client.post('courses', data=data, assert_status=201)
+
+        return (_create('A', '2018-12-06T10:00:00Z', '2018-12-06T12:00:00Z'),
+                _create('B', '2018-12-06T11:00:00Z', '2018-12-06T13:00:00Z'),
+                _create('C', '2018-12-06T14:00:00Z', '2018-12-06T16:00:00Z'))
+
+
+@pytest.mark.parametrize('resource', ['signups', 'selections'])
+def test_schedule_cached(app, resource, courses):
+    """Choosing several courses in a row uses the cached schedule."""
+    with app.admin():
+        for course in (courses[0], courses[2]):
+            app.client.post(resource,
+                            data={'nethz': 'pablito', 'course': course['_id']},
+                            assert_status=201)
+        # The schedule was removed by the last POST, load it once
+        app.client.post(resource,
+                        data={'nethz': 'pablito', 'course': courses[1]['_id']},
+                        assert_status=422)
+        hits = app.schedule_cache.hits
+
+        app.client.post(resource,
+                        data={'nethz': 'pablito', 'course': courses[1]['_id']},
+                        assert_status=422)
+        # Schedule and course time slots were both served from memory
+        assert app.schedule_cache.hits == hits + 2
+
+
+@pytest.mark.parametrize('resource', ['signups', 'selections'])
+def test_removed_on_delete(app, resource, courses):
+    """After deleting a course choice, the time is free again."""
+    with app.admin():
+        item = app.client.post(resource,
+                               data={'nethz': 'pablito',
+                                     'course': courses[0]['_id']},
+                               assert_status=201)
+        app.client.post(resource,
+                        data={'nethz': 'pablito', 'course': courses[1]['_id']},
+                        assert_status=422)
+
+        app.client.delete('%s/%s' % (resource, item['_id']),
+                          headers={'If-Match': item['_etag']},
+                          assert_status=204)
+        app.client.post(resource,
+                        data={'nethz': 'pablito', 'course': courses[1]['_id']},
+                        assert_status=201)
+
+
+def test_removed_on_course_change(app, courses):
+    """If the time of a course changes, the new time is checked."""
+    with app.admin():
+        app.client.post('signups',
+                        data={'nethz': 'pablito', 'course': courses[0]['_id']},
+                        assert_status=201)
+        app.client.post('signups',
+                        data={'nethz': 'pablito', 'course': courses[1]['_id']},
+                        assert_status=422)
+
+        app.client.patch('courses/' + courses[1]['_id'],
+                         data={'datetimes': [{
+                             'start': '2018-12-07T11:00:00Z',
+                             'end': '2018-12-07T13:00:00Z',
+                         }]},
+                         headers={'If-Match': courses[1]['_etag']},
+                         assert_status=200)
+        app.client.post('signups',
+                        data={'nethz': 'pablito', 'course': courses[1]['_id']},
+                        assert_status=201)
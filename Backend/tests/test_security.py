@@ -1,24 +1,36 @@
 """Tests for all security function."""
 
+from unittest.mock import patch
+
 import pytest
 
 from backend.settings import DOMAIN
 
-ALL_RESOURCES = DOMAIN.keys()
+# Internal resources have no endpoints
+ALL_RESOURCES = [resource for (resource, settings) in DOMAIN.items()
+                 if not settings.get('internal_resource')]
 ADMIN_RESOURCES = ['lectures', 'courses']  # only admin can write
 PERSONAL_RESOURCES = ['signups', 'selections']  # users can only see their own
+PUBLIC_RESOURCES = ['lectures', 'courses', 'assistants']  # everyone can read
+PRIVATE_RESOURCES = [resource for resource in ALL_RESOURCES
+                     if resource not in PUBLIC_RESOURCES]
 
 
 @pytest.mark.parametrize('resource', ALL_RESOURCES)
-@pytest.mark.parametrize('method', ['get', 'post'])
-def test_auth_required_for_resource(app, resource, method):
-    """Without auth header, we get get 401 for all methods."""
-    getattr(app.client, method)('/' + resource, data={}, assert_status=401)
+def test_resource_write_needs_auth(app, resource):
+    """Without auth header, we get get 401 for all writes."""
+    app.client.post('/' + resource, data={}, assert_status=401)
+
+
+@pytest.mark.parametrize('resource', PRIVATE_RESOURCES)
+def test_resource_read_needs_auth(app, resource):
+    """Without auth header, we get get 401 for non-public resources."""
+    app.client.get('/' + resource, assert_status=401)
 
 
 @pytest.mark.parametrize('resource', ALL_RESOURCES)
-@pytest.mark.parametrize('method', ['get', 'patch', 'delete'])
-def test_auth_required_for_item(app, resource, method):
+@pytest.mark.parametrize('method', ['patch', 'delete'])
+def test_item_write_needs_auth(app, resource, method):
     """Without auth provided, we can access any item either."""
     # Bypass validation and put a empty item directly into db
     with app.app_context():
@@ -29,6 +41,28 @@ def test_auth_required_for_item(app, resource, method):
                                 assert_status=401)
 
 
+@pytest.mark.parametrize('resource', PRIVATE_RESOURCES)
+def test_item_read_needs_auth(app, resource):
+    """Without auth provided, we can not read non-public items."""
+    with app.app_context():
+        _id = app.data.driver.db[resource].insert({})
+
+    app.client.get('/%s/%s' % (resource, _id), assert_status=401)
+
+
+@pytest.mark.parametrize('resource', PUBLIC_RESOURCES)
+def test_public_read(app, resource):
+    """Everyone can read public resources without contacting AMIVAPI."""
+    with app.app_context():
+        _id = app.data.driver.db[resource].insert({})
+
+    with patch('backend.security.api_get') as api:
+        app.client.get('/' + resource, assert_status=200)
+        app.client.get('/%s/%s' % (resource, _id), assert_status=200)
+
+    api.assert_not_called()
+
+
 @pytest.mark.parametrize('resource', ADMIN_RESOURCES)
 def test_user_can_read(app, resource):
     """Users should be able to to GET requests on resource and item.
@@ -0,0 +1,87 @@
+"""Tests for bulk settlements of payments."""
+# pylint: disable=redefined-outer-name
+
+from unittest.mock import patch
+
+import pytest
+from pymongo.collection import Collection
+
+
+@pytest.fixture
+def signups(app):
+    """Create reserved signups for two users, return their ids."""
+    with app.app_context():
+        collection = app.data.driver.db['signups']
+        return {nethz: [str(collection.insert({'nethz': nethz,
+                                               'status': 'reserved'}))
+                        for _ in range(number)]
+                for (nethz, number) in (('alice', 2), ('bob', 1))}
+
+
+def test_admin_only(app):
+    """Only admins can settle payments."""
+    app.client.post('/settlements', data={}, assert_status=401)
+
+    with app.user():
+        app.client.post('/settlements', data={}, assert_status=403)
+
+
+def test_settle(app, signups):
+    """All payments are stored and signups marked as paid at once."""
+    settlements = [{'nethz': nethz, 'signups': ids}
+                   for (nethz, ids) in sorted(signups.items())]
+
+    original = Collection.insert_many
+    with app.admin(), patch.object(Collection, 'insert_many', autospec=True,
+                                   side_effect=original) as insert_many:
+        response = app.client.post('/settlements',
+                                   data={'settlements': settlements},
+                                   assert_status=201)
+    assert insert_many.call_count == 1
+
+    payments = response['_items']
+    assert [payment['signups'] for payment in payments] == \
+        [signups['alice'], signups['bob']]
+    assert [payment['amount'] for payment in payments] == \
+        [2 * app.config['COURSE_PRICE'], app.config['COURSE_PRICE']]
+
+    with app.admin():
+        for payment in payments:
+            stored = app.client.get('payments/' + payment['_id'],
+                                    assert_status=200)
+            assert stored['status'] == 'succeeded'
+            assert stored['_etag'] == payment['_etag']
+
+        for signup in app.client.get('signups')['_items']:
+            assert signup['status'] == 'accepted'
+
+
+def test_invalid_settlements(app, signups):
+    """If any settlement is invalid, nothing is stored."""
+    settlements = [
+        {'nethz': 'alice', 'signups': signups['alice']},
+        {'nethz': 'alice', 'signups': signups['bob'] + signups['alice'][:1]},
+    ]
+
+    with app.admin():
+        response = app.client.post('/settlements',
+                                   data={'settlements': settlements},
+                                   assert_status=422)
+        assert list(response['_issues']) == ['1']
+        assert len(response['_issues']['1']['signups']) == 2
+
+        assert app.client.get('payments')['_items'] == []
+        for signup in app.client.get('signups')['_items']:
+            assert signup['status'] == 'reserved'
+
+
+@pytest.mark.parametrize('data', [
+    {},
+    {'settlements': []},
+    {'settlements': [{'nethz': 'alice', 'signups': []}]},
+    {'settlements': [{'nethz': 'alice', 'signups': ['invalid']}]},
+])
+def test_malformed_settlements(app, data):
+    """Malformed requests are rejected."""
+    with app.admin():
+        app.client.post('/settlements', data=data, assert_status=400)
@@ -7,10 +7,19 @@
 
 from datetime import datetime as dt
 
-from unittest.mock import patch, call
+from unittest.mock import patch, MagicMock
 import pytest
+from bson import ObjectId
+from pymongo.collection import Collection
 
-from backend.signups import update_signups
+from backend.signups import (
+    update_signups,
+    update_waiting_lists,
+    recount_spots,
+    init_spot_counters,
+    mark_as_paid,
+    mark_as_unpaid,
+)
 
 
 def test_success(app):
@@ -190,37 +199,38 @@ def course(app):
 @pytest.fixture
 def mock_update():
     """Mock the actual updating of spots for a test."""
-    with patch('backend.signups.update_signups', return_value=[]) as update:
+    with patch('backend.signups.update_waiting_lists',
+               return_value=[]) as update:
         yield update
 
 
-def test_post_signups_triggers_update(app, course, mock_update):
-    """Test the the update of spots gets triggered correctly."""
+def test_post_signups_claims_spot(app, course):
+    """New signups try to take a spot of the course."""
     data = {
         'course': str(course),
         'nethz': 'bli'
     }
-    app.client.post('signups', data=data, assert_status=201)
+    with patch('backend.signups.claim_spots', return_value=False) as claim:
+        app.client.post('signups', data=data, assert_status=201)
 
-    # Note: With post, the course comes from the request, not the db,
-    #       so the update will be called with a string
-    mock_update.assert_called_with(str(course))
+    claim.assert_called_with(course)
 
 
 def test_patch_signup_triggers_update(app, course, mock_update):
     """Test the the update of spots gets triggered correctly."""
+    old_course = ObjectId()
     fake = app.data.driver.db['signups'].insert({
         '_etag': 'tag',
         'nethz': 'lala',
-        'course': 'oldcourse'
+        'course': old_course
     })
     app.client.patch('/signups/%s' % fake,
                      data={'course': str(course)},
                      headers={'If-Match': 'tag'},
                      assert_status=200)
 
-    # Both the signups of the old and new course are updated
-    mock_update.assert_has_calls([call(course), call('oldcourse')])
+    # Both the signups of the old and new course are updated at once
+    mock_update.assert_called_once_with([course, old_course])
 
 
 def test_delete_signup_triggers_update(app, course, mock_update):
@@ -232,7 +242,7 @@ def test_delete_signup_triggers_update(app, course, mock_update):
     app.client.delete('/signups/%s' % fake,
                       headers={'If-Match': 'tag'},
                       assert_status=204)
-    mock_update.assert_called_with(course)
+    mock_update.assert_called_with([course])
 
 
 def test_patch_course_without_update(app, course, mock_update):
@@ -250,7 +260,7 @@ def test_patch_course_with_update(app, course, mock_update):
                      data={'spots': '10'},
                      headers={'If-Match': 'tag'},
                      assert_status=200)
-    mock_update.assert_called_with(course)
+    mock_update.assert_called_with([course])
 
 
 def test_block_delete_ok(app, course):
@@ -278,3 +288,192 @@ def test_embed_course(app, course):
     app.client.post('signups?embedded={"course": 1}',
                     data=data,
                     assert_status=201)
+
+
+def _taken(app, course):
+    """Return the spot counter of a course."""
+    return app.data.driver.db['courses'].find_one({'_id': course})['taken']
+
+
+def test_counter(app):
+    """The counter keeps track of signups which are not waiting."""
+    with app.admin():
+        course = app.data.driver.db['courses'].insert({'spots': 1})
+
+        first = app.client.post('/signups',
+                                data={'nethz': 'first', 'course': str(course)},
+                                assert_status=201)
+        second = app.client.post('/signups',
+                                 data={'nethz': 'second',
+                                       'course': str(course)},
+                                 assert_status=201)
+        assert _taken(app, course) == 1
+        assert second['status'] == 'waiting'
+
+        # Deleting the first signup frees the spot for the second
+        app.client.delete('/signups/' + first['_id'],
+                          headers={'If-Match': first['_etag']},
+                          assert_status=204)
+        assert _taken(app, course) == 1
+        assert app.client.get('/signups/' + second['_id'],
+                              assert_status=200)['status'] == 'reserved'
+
+
+def test_counter_not_public(app):
+    """The counter is not visible through the API."""
+    with app.admin():
+        course = app.data.driver.db['courses'].insert({'spots': 1,
+                                                       'taken': 1})
+        response = app.client.get('/courses/%s' % course, assert_status=200)
+        assert 'taken' not in response
+
+
+def test_no_spots_reserved_twice(app):
+    """If the counter says all spots are taken, nobody gets one."""
+    with app.admin():
+        course = app.data.driver.db['courses'].insert({'spots': 1,
+                                                       'taken': 1})
+        response = app.client.post('/signups',
+                                   data={'nethz': 'a', 'course': str(course)},
+                                   assert_status=201)
+        assert response['status'] == 'waiting'
+
+
+def test_move_to_full_course(app):
+    """A signup moved to a full course keeps its status, nothing is lost."""
+    with app.admin():
+        database = app.data.driver.db
+        old = database['courses'].insert({'spots': 1, 'taken': 1})
+        full = database['courses'].insert({'spots': 1, 'taken': 1})
+        signup = database['signups'].insert({'nethz': 'a', 'course': old,
+                                             'status': 'accepted'})
+        etag = app.client.get('/signups/%s' % signup,
+                              assert_status=200)['_etag']
+
+        app.client.patch('/signups/%s' % signup,
+                         data={'course': str(full)},
+                         headers={'If-Match': etag},
+                         assert_status=200)
+        response = app.client.get('/signups/%s' % signup, assert_status=200)
+        assert response['status'] == 'accepted'
+
+        # The new course is overbooked, the old one has a free spot
+        assert _taken(app, full) == 2
+        assert _taken(app, old) == 0
+
+
+def test_init_spot_counters(app):
+    """Courses without counter are counted at startup."""
+    with app.app_context():
+        database = app.data.driver.db
+        course = database['courses'].insert({'spots': 5})
+        counted = database['courses'].insert({'spots': 5, 'taken': 1})
+        database['signups'].insert({'course': course, 'status': 'reserved'})
+
+    init_spot_counters(app)
+
+    with app.app_context():
+        assert _taken(app, course) == 1
+        assert _taken(app, counted) == 1
+
+
+def test_recount_spots(app):
+    """Counters can be recomputed from the signups."""
+    with app.app_context():
+        database = app.data.driver.db
+        full = database['courses'].insert({'spots': 5, 'taken': 0})
+        empty = database['courses'].insert({'spots': 5, 'taken': 3})
+        correct = database['courses'].insert({'spots': 5, 'taken': 1})
+
+        for status in ['reserved', 'accepted', 'waiting']:
+            database['signups'].insert({'course': full, 'status': status})
+        database['signups'].insert({'course': correct, 'status': 'reserved'})
+
+        assert recount_spots() == {full: 2, empty: 0}
+        assert _taken(app, full) == 2
+        assert _taken(app, empty) == 0
+        assert _taken(app, correct) == 1
+
+
+def test_update_many_courses(app):
+    """The waiting lists of several courses are updated at once."""
+    with app.app_context():
+        database = app.data.driver.db
+        courses = {spots: database['courses'].insert({'spots': spots})
+                   for spots in [0, 1, 3]}
+        ids = {}
+        for spots, course in courses.items():
+            for index in range(2):
+                ids[spots, index] = database['signups'].insert({
+                    'course': course,
+                    'status': 'waiting',
+                    '_updated': dt(2020, 10, 10 + index),
+                    'nethz': 'n%s' % index,
+                })
+
+        reserved = update_waiting_lists(list(courses.values()))
+
+        assert sorted(reserved) == sorted(
+            str(ids[key]) for key in [(1, 0), (3, 0), (3, 1)])
+        assert _taken(app, courses[1]) == 1
+        assert _taken(app, courses[3]) == 2
+        assert 'taken' not in database['courses'].find_one(
+            {'_id': courses[0]})
+
+
+def test_update_with_concurrent_change(app):
+    """If a counter changes in the meantime, the course is updated again."""
+    with app.app_context():
+        database = app.data.driver.db
+        course = database['courses'].insert({'spots': 3, 'taken': 0})
+        signup = database['signups'].insert({'course': course,
+                                             'status': 'waiting'})
+
+        original_bulk_write = Collection.bulk_write
+
+        def _concurrent_bulk_write(collection, *args, **kwargs):
+            # Another request takes spots just before the bulk write
+            collection.update_one({'_id': course}, {'$inc': {'taken': 2}})
+            return original_bulk_write(collection, *args, **kwargs)
+
+        with patch.object(Collection, 'bulk_write', autospec=True,
+                          side_effect=_concurrent_bulk_write):
+            reserved = update_waiting_lists([course])
+
+        assert reserved == [str(signup)]
+        assert _taken(app, course) == 3
+
+
+def test_mark_as_paid_and_unpaid(app):
+    """All signups of a payment are updated like with a PATCH."""
+    with app.admin():
+        course = app.data.driver.db['courses'].insert({'spots': 5})
+        signups = [app.client.post('/signups',
+                                   data={'nethz': nethz,
+                                         'course': str(course)},
+                                   assert_status=201)
+                   for nethz in ['a', 'b']]
+        payment = {'signups': [item['_id'] for item in signups]}
+
+        hook = MagicMock()
+        app.on_updated_signups += hook
+
+        mark_as_paid(payment)
+
+        for signup in signups:
+            updated = app.client.get('/signups/' + signup['_id'],
+                                     assert_status=200)
+            assert updated['status'] == 'accepted'
+            assert updated['_etag'] != signup['_etag']
+
+            # The new etag is valid
+            app.client.patch('/signups/' + signup['_id'],
+                             data={},
+                             headers={'If-Match': updated['_etag']},
+                             assert_status=200)
+        assert hook.call_count == 2
+
+        mark_as_unpaid([payment])
+        for signup in signups:
+            assert app.client.get('/signups/' + signup['_id'],
+                                  assert_status=200)['status'] == 'reserved'
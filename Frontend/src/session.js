@@ -2,7 +2,7 @@
 
 import m from 'mithril';
 import ls from 'local-storage';
-import { amivApiUrl, adminGroupName } from 'config';
+import { amivApiUrl, pvkApiUrl, adminGroupName } from 'config';
 
 const storedSession = ls('session');
 
@@ -67,28 +67,38 @@ export default {
   },
   logout() {
     if (this.data.token) {
+      const { token } = this.data;
       return m.request({
         method: 'DELETE',
         url: `${amivApiUrl}/sessions/${this.data._id}`,
         headers: {
-          Authorization: `Token ${this.data.token}`,
+          Authorization: `Token ${token}`,
           'If-Match': this.data._etag,
         },
-      }).then(() => {
+      }).then(() => this.forget(token)).then(() => {
         this.clear();
       }).catch((err) => {
         if (err._error.code === 401) {
           // Token already no valid anymore, clear session
-          this.clear();
-        } else {
-          throw err._error;
+          return this.forget(token).then(() => { this.clear(); });
         }
+        throw err._error;
       });
     }
     // Otherwise nothing to do, return a promise that always resolves
     return Promise.resolve();
   },
 
+  // Remove the token from the cache of the PVK backend, such that it is not
+  // accepted anymore. Errors are ignored, the cached token expires anyway.
+  forget(token) {
+    return m.request({
+      method: 'POST',
+      url: `${pvkApiUrl}/logout`,
+      headers: { Authorization: `Token ${token}` },
+    }).catch(() => {});
+  },
+
   check_admin(token) {
     // First: Look for Admin Group
     let query = m.buildQueryString({
@@ -9,6 +9,17 @@ import { userCourses, request } from './backend';
 import logo from './amiv_logo_no_text.svg';
 
 
+// Charges are made in the background, poll the payment until it's done
+function waitForCharge(payment, delay = 1000) {
+  if (payment.status !== 'pending' && payment.status !== 'processing') {
+    return Promise.resolve(payment);
+  }
+  return new Promise(resolve => setTimeout(resolve, delay))
+    .then(() => request({ resource: 'payments', id: payment._id }))
+    .then(updated => waitForCharge(updated, Math.min(2 * delay, 5000)));
+}
+
+
 const handler = StripeCheckout.configure({
   key: stripeKey,
   image: logo,
@@ -22,15 +33,23 @@ const handler = StripeCheckout.configure({
         signups: userCourses.reserved.map(signup => signup._id),
         token: token.id,
       },
-    }).then(() => {
+    }).then(waitForCharge).then((payment) => {
       // Update the sidebar
       userCourses.getAll();
-      // Show a confirmation dialog
-      Dialog.show({
-        title: 'Thanks for your payment!',
-        body: 'You will receive a confirmation e-mail within the next ' +
-              'few minutes.',
-      });
+      if (payment.status === 'succeeded') {
+        // Show a confirmation dialog
+        Dialog.show({
+          title: 'Thanks for your payment!',
+          body: 'You will receive a confirmation e-mail within the next ' +
+                'few minutes.',
+        });
+      } else {
+        // The card has been declined, or similar
+        Dialog.show({
+          title: 'Payment failed',
+          body: payment.error,
+        });
+      }
     }).catch((err) => {
       // Show an error dialog
       Dialog.show({